@@ -0,0 +1,222 @@
+"""
+Load benchmark for the htmx and API endpoints.
+
+Seeds ITEMS items for each of TENANTS users (the demo item list, scaled up), then runs
+CONCURRENCY workers that each play ROUNDS rounds of: open /app/, scroll the table,
+type a search, edit a row and insert a small batch through the API. Workers share the users,
+so a search may be cut short by another worker's search for the same user; those are counted
+as superseded, apart from the completed requests and their latencies.
+
+    python -m benchmarks.load --backend memory --tenants 4 --items 2000 --concurrency 16
+    python -m benchmarks.load --url http://localhost:8000 --output bench.json --baseline baseline.json
+
+Without --url the app runs in process, on the storage picked by --backend.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import re
+import sys
+from random import Random
+from time import perf_counter
+
+import httpx
+
+
+ROW_ID = re.compile(r'id="item-row-(\w+)"')
+AFTER = re.compile(r'after=([\w-]+)')
+
+
+def synthetic_items(count: int, rng: Random) -> list[dict]:
+    """
+    Scale the demo item list up to `count` distinct items.
+    """
+    from routers.demo import item_list
+
+    items = []
+    for index in range(count):
+        base = item_list[index % len(item_list)]
+        items.append({**base,
+                      "name": f"{base['name']} {index}",
+                      "quantity": rng.randint(0, 500),
+                      })
+    return items
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of already sorted samples.
+    """
+    if not samples:
+        return 0.0
+    rank = min(len(samples), max(1, math.ceil(pct / 100 * len(samples))))
+    return samples[rank - 1]
+
+
+class Recorder:
+    """
+    Collects per-endpoint latencies, error counts and superseded request counts.
+    """
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.superseded: dict[str, int] = {}
+
+    async def call(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+        started = perf_counter()
+        response = await client.request(method, url, **kwargs)
+        if response.status_code == 204:
+            # a search cancelled by a newer one of the same user: it did no full work, so it is
+            # neither a completed request nor an error
+            self.superseded[endpoint] = self.superseded.get(endpoint, 0) + 1
+            self.latencies.setdefault(endpoint, [])
+            return response
+        self.latencies.setdefault(endpoint, []).append(perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return response
+
+    def summary(self, seconds: float) -> dict:
+        result = {}
+        for endpoint, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            result[endpoint] = {"count": len(samples),
+                                "errors": self.errors.get(endpoint, 0),
+                                "superseded": self.superseded.get(endpoint, 0),
+                                "rps": round(len(samples) / seconds, 1),
+                                "p50_ms": round(percentile(samples, 50) * 1000, 2),
+                                "p95_ms": round(percentile(samples, 95) * 1000, 2),
+                                "p99_ms": round(percentile(samples, 99) * 1000, 2),
+                                }
+        return result
+
+
+async def seed(client: httpx.AsyncClient, tenants: list[str], items: int, rng: Random, batch: int = 1000):
+    for tenant in tenants:
+        data = synthetic_items(items, rng)
+        for start in range(0, len(data), batch):
+            response = await client.post(f"/api/insert/?user_id={tenant}", json=data[start:start + batch])
+            response.raise_for_status()
+
+
+async def worker(client: httpx.AsyncClient, recorder: Recorder, tenants: list[str], rounds: int, pages: int,
+                 rng: Random):
+    from routers.demo import item_list
+
+    for _ in range(rounds):
+        tenant = rng.choice(tenants)
+        headers = {"Cookie": f"user_id={tenant}"}
+
+        response = await recorder.call(client, "GET /app/", "GET", "/app/", headers=headers)
+        row_ids = ROW_ID.findall(response.text)
+        for _ in range(pages):
+            after = AFTER.search(response.text)
+            if not after:
+                break
+            response = await recorder.call(client, "GET /app/items", "GET", f"/app/items?after={after.group(1)}&search=",
+                                           headers=headers)
+
+        word = rng.choice(item_list)["name"].split()[0]
+        for length in range(1, len(word) + 1):
+            await recorder.call(client, "POST /app/search", "POST", "/app/search", headers=headers,
+                                data={"search": word[:length]})
+
+        if row_ids:
+            await recorder.call(client, "PUT /app/update-item/{item_id}", "PUT", f"/app/update-item/{rng.choice(row_ids)}",
+                                headers=headers, data={"description_in": "benchmark edit", "drawing_in": "bench.dwg",
+                                                       "quantity_in": rng.randint(0, 500), "status_in": "Active"})
+
+        await recorder.call(client, "POST /api/insert/", "POST", f"/api/insert/?user_id={tenant}",
+                            json=synthetic_items(5, rng))
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    List the endpoints whose p95 latency or throughput regressed beyond `tolerance` against the baseline.
+    """
+    regressions = []
+    for endpoint, stats in result["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(endpoint)
+        if not base:
+            continue
+        if stats["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{endpoint}: p95 {stats['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if stats["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{endpoint}: {stats['rps']} req/s vs baseline {base['rps']} req/s")
+    return regressions
+
+
+async def run(args) -> dict:
+    rng = Random(args.seed)
+    tenants = [f"bench-{args.seed}-{index}" for index in range(args.tenants)]
+    if args.url:
+        transport, base_url = None, args.url
+    else:
+        os.environ["STORAGE_BACKEND"] = args.backend
+        from database import storage
+        from main import app
+
+        # ASGITransport does not run the lifespan
+        await storage.open()
+        await storage.ensure_indexes()
+        transport, base_url = httpx.ASGITransport(app=app), "http://bench"
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, limits=limits, timeout=60) as client:
+        await seed(client, tenants, args.items, rng)
+        recorder = Recorder()
+        started = perf_counter()
+        await asyncio.gather(*(worker(client, recorder, tenants, args.rounds, args.pages, Random(rng.random()))
+                               for _ in range(args.concurrency)))
+        seconds = perf_counter() - started
+    if not args.url:
+        await storage.close()
+
+    return {"config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+            "python": platform.python_version(),
+            "seconds": round(seconds, 3),
+            "endpoints": recorder.summary(seconds),
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of the app in process")
+    parser.add_argument("--backend", choices=["memory", "mongo"], default="memory",
+                        help="storage for the in-process app (default: memory)")
+    parser.add_argument("--tenants", type=int, default=4)
+    parser.add_argument("--items", type=int, default=1000, help="items seeded per tenant")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=10, help="scenario rounds per worker")
+    parser.add_argument("--pages", type=int, default=5, help="infinite scroll pages per round")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against a results file from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression ratio (default: 0.2)")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+
+    print(f"{'endpoint':<34}{'count':>8}{'errors':>8}{'supersd':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}")
+    for endpoint, stats in result["endpoints"].items():
+        print(f"{endpoint:<34}{stats['count']:>8}{stats['errors']:>8}{stats['superseded']:>8}{stats['rps']:>10}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
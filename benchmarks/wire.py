@@ -0,0 +1,125 @@
+"""
+Bytes on the wire and time to first byte of the htmx pages.
+
+Starts the app under uvicorn on the in-memory store, once with TEMPLATE_STREAMING on and once
+with it off, seeds a user with ITEMS items and fetches the first page and an active search
+ROUNDS times with each content coding the server offers. Reports the body bytes received,
+the mean time to first byte and the mean time to the last byte.
+
+    python -m benchmarks.wire --items 500 --rounds 50
+    python -m benchmarks.wire --url http://localhost:8000
+
+With --url the running server is measured as it is configured.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+from random import Random
+from statistics import mean
+from time import perf_counter
+
+import httpx
+
+from benchmarks.load import synthetic_items
+
+
+USER = "wire-bench"
+ENCODINGS = ("identity", "gzip", "br")
+
+
+async def fetch(client: httpx.AsyncClient, method: str, path: str, encoding: str, **kwargs) -> dict:
+    """
+    One request, timed to its first and last body byte; `bytes` is the body as sent, before decoding.
+    """
+    started = perf_counter()
+    first = None
+    size = 0
+    async with client.stream(method, path, headers={"Accept-Encoding": encoding}, **kwargs) as response:
+        async for chunk in response.aiter_raw():
+            if first is None:
+                first = perf_counter() - started
+            size += len(chunk)
+        coding = response.headers.get("content-encoding", "identity")
+    return {"ttfb": first or 0.0, "total": perf_counter() - started, "bytes": size, "coding": coding}
+
+
+async def measure(url: str, items: int, rounds: int) -> list[dict]:
+    async with httpx.AsyncClient(base_url=url, cookies={"user_id": USER}, timeout=30) as client:
+        rows = synthetic_items(items, Random(1))
+        for start in range(0, len(rows), 500):
+            response = await client.post(f"/api/insert/?user_id={USER}", json=rows[start:start + 500])
+            response.raise_for_status()
+        requests = {"GET /app/": ("GET", "/app/", {}),
+                    "POST /app/search": ("POST", "/app/search", {"data": {"search": "a"}})}
+        results = []
+        for name, (method, path, kwargs) in requests.items():
+            for encoding in ENCODINGS:
+                samples = [await fetch(client, method, path, encoding, **kwargs) for _ in range(rounds)]
+                if encoding != "identity" and samples[0]["coding"] != encoding:
+                    continue
+                results.append({"request": name, "encoding": encoding,
+                                "bytes": samples[-1]["bytes"],
+                                "ttfb_ms": round(mean(sample["ttfb"] for sample in samples) * 1000, 2),
+                                "total_ms": round(mean(sample["total"] for sample in samples) * 1000, 2),
+                                })
+        return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(url: str):
+    async with httpx.AsyncClient(base_url=url) as client:
+        for _ in range(100):
+            try:
+                await client.get("/health")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"server at {url} did not start")
+
+
+def serve_and_measure(streaming: str, items: int, rounds: int) -> list[dict]:
+    """
+    Measure a fresh server started with the given TEMPLATE_STREAMING setting.
+    """
+    port = free_port()
+    env = {**os.environ, "STORAGE_BACKEND": "memory", "TEMPLATE_STREAMING": streaming, "RETENTION_MODE": "off"}
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                               "--log-level", "warning"], env=env)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        asyncio.run(wait_ready(url))
+        return asyncio.run(measure(url, items, rounds))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="measure a running server instead of starting one")
+    parser.add_argument("--items", type=int, default=500, help="items seeded for the benchmark user")
+    parser.add_argument("--rounds", type=int, default=50, help="requests per page and content coding")
+    args = parser.parse_args()
+
+    if args.url:
+        runs = {"server": asyncio.run(measure(args.url, args.items, args.rounds))}
+    else:
+        runs = {f"streaming {mode}": serve_and_measure(mode, args.items, args.rounds) for mode in ("on", "off")}
+
+    print(f"{'mode':<16}{'request':<20}{'encoding':<10}{'bytes':>9}{'ttfb ms':>10}{'total ms':>10}")
+    for mode, results in runs.items():
+        for result in results:
+            print(f"{mode:<16}{result['request']:<20}{result['encoding']:<10}{result['bytes']:>9}"
+                  f"{result['ttfb_ms']:>10}{result['total_ms']:>10}")
+
+
+if __name__ == "__main__":
+    main()
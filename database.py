@@ -1,149 +1,1035 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from os import getenv
+from time import perf_counter
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError, WriteError
 
-from models import Item, UpdateItem
+from models import BulkOperation, Item, UpdateItem
+from utils.cache import QueryCache, cached
+from utils.coalesce import Coalescer
+from utils.indexes import ensure_indexes, ensure_job_indexes, ensure_tombstone_indexes
+from utils.live import LiveHub, watch_changes
+from utils.inflight import SingleFlight, collect, single_flight
+from utils.memory_store import MemoryCollection
+from utils.metrics import Snapshot, registry, timed_operation
+from utils.pagination import ChangeKey, PageKey
+from utils.pool import PoolStats
+from utils.retention import Retention
+from utils.summary import read_summary, summary_changes, summary_key
+from utils.trigram import SEARCH_FIELDS, TrigramIndexes
 
 
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 mongo_connection = getenv("MONGO_CONNECT")
+# MongoDB connection pool; the client is opened and warmed up by the app lifespan
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(getenv("MONGO_MAX_POOL_SIZE", 100)),
+    "minPoolSize": int(getenv("MONGO_MIN_POOL_SIZE", 10)),
+    "connectTimeoutMS": int(getenv("MONGO_CONNECT_TIMEOUT_MS", 20_000)),
+    "serverSelectionTimeoutMS": int(getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30_000)),
+}
+if getenv("MONGO_MAX_IDLE_TIME_MS"):
+    MONGO_CLIENT_OPTIONS["maxIdleTimeMS"] = int(getenv("MONGO_MAX_IDLE_TIME_MS"))
+if getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS"):
+    MONGO_CLIENT_OPTIONS["waitQueueTimeoutMS"] = int(getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS"))
+# "mongo" (default) or "memory" (in-process store for tests and benchmarks)
+STORAGE_BACKEND = getenv("STORAGE_BACKEND", "mongo")
+# "regex" (substring match, default), "text" (text index, ranked by relevance)
+# or "trigram" (in-process trigram index per user)
+SEARCH_MODE = getenv("SEARCH_MODE", "regex")
+TRIGRAM_MAX_BYTES = int(getenv("TRIGRAM_MAX_BYTES", 64 * 1024 * 1024))
+# seconds before a trigram index is loaded again, picking up other workers' writes; 0 keeps it
+TRIGRAM_TTL = float(getenv("TRIGRAM_TTL", 60))
+# read cache; a TTL of 0 turns it off
+QUERY_CACHE_TTL = float(getenv("QUERY_CACHE_TTL", 0))
+QUERY_CACHE_MAX_ENTRIES = int(getenv("QUERY_CACHE_MAX_ENTRIES", 10_000))
+QUERY_CACHE_MAX_BYTES = int(getenv("QUERY_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# retention of items not updated for RETENTION_DAYS: "batched" (chunked deletes, default),
+# "ttl" (MongoDB TTL index) or "off" (only on request); RETENTION_INTERVAL of 0 turns off the scheduler
+RETENTION_MODE = getenv("RETENTION_MODE", "batched")
+RETENTION_DAYS = float(getenv("RETENTION_DAYS", 14))
+RETENTION_INTERVAL = float(getenv("RETENTION_INTERVAL", 3600))
+RETENTION_BATCH_SIZE = int(getenv("RETENTION_BATCH_SIZE", 1000))
+RETENTION_BATCHES_PER_SECOND = float(getenv("RETENTION_BATCHES_PER_SECOND", 5))
+# in "ttl" mode the summaries are recounted once a day, by the first cleanup from this hour (local time) on
+RETENTION_REBUILD_HOUR = int(getenv("RETENTION_REBUILD_HOUR", 3))
+# how long finished cleanup job reports can still be looked up
+JOB_REPORT_DAYS = 7
+# how long deletes are remembered for delta sync; clients whose cursor is older must sync in full
+TOMBSTONE_DAYS = float(getenv("TOMBSTONE_DAYS", 30))
+# delta sync leaves out changes stamped this recently, since their writes may not have landed yet;
+# inserts and bulk writes are stamped as they are sent, at most SYNC_STAMP_BATCH_SIZE documents at
+# a time, so that every stamp lands well within this
+SYNC_SETTLE_SECONDS = float(getenv("SYNC_SETTLE_SECONDS", 2))
+SYNC_STAMP_BATCH_SIZE = int(getenv("SYNC_STAMP_BATCH_SIZE", 1000))
+# where live table updates come from: "auto" (MongoDB change streams when the server supports them,
+# else this worker's own writes), "changestream", "local" or "off"
+LIVE_SOURCE = getenv("LIVE_SOURCE", "auto")
+LIVE_QUEUE_SIZE = int(getenv("LIVE_QUEUE_SIZE", 100))
+# group commit for single-item adds and updates: hold each write up to this long (0 = off) so
+# concurrent ones go to the database together, in batches of at most WRITE_BATCH_MAX
+WRITE_BATCH_WINDOW_MS = float(getenv("WRITE_BATCH_WINDOW_MS", 0))
+WRITE_BATCH_MAX = int(getenv("WRITE_BATCH_MAX", 64))
 
-db_client = AsyncIOMotorClient(mongo_connection)
-inv_collection = db_client.InventoryApp["Item"]
+# callables run as hook(op, docs) after every write; op is "insert", "update", "delete" or "cleanup"
+write_hooks = []
 
+trigram_indexes = TrigramIndexes(TRIGRAM_MAX_BYTES, TRIGRAM_TTL)
+if SEARCH_MODE == "trigram":
+    write_hooks.append(trigram_indexes.on_write)
 
-async def get_all_items(user_id: str):
-    """
-    Retrieve all items from the inventory collection.
+query_cache = QueryCache(QUERY_CACHE_TTL, QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_BYTES)
+registry.register(Snapshot("query_cache_hits_total", "Query cache hits.", "counter", lambda: query_cache.hits))
+registry.register(Snapshot("query_cache_misses_total", "Query cache misses.", "counter", lambda: query_cache.misses))
+registry.register(Snapshot("query_cache_evictions_total", "Query cache LRU evictions.", "counter",
+                           lambda: query_cache.evictions))
+registry.register(Snapshot("query_cache_bytes", "Estimated size of the query cache.", "gauge", lambda: query_cache.bytes))
 
-    This function asynchronously fetches all the documents (items) from the 'Main' collection
-    of the 'Inventory' database in MongoDB.
+# identical reads running at the same time share one database call
+reads = SingleFlight()
+registry.register(Snapshot("single_flight_calls_total", "Reads that went to the database.", "counter",
+                           lambda: reads.leaders))
+registry.register(Snapshot("single_flight_shared_total", "Reads answered by joining an identical read in flight.",
+                           "counter", lambda: reads.followers))
 
-    Returns:
-        list: A list of dictionaries, where each dictionary represents an item from the inventory.
-    """
-    items = await inv_collection.find({"user_id": user_id}).to_list(length=None)
-    return items
+pool_stats = PoolStats()
+registry.register(Snapshot("mongo_pool_connections", "Open MongoDB connections.", "gauge",
+                           lambda: pool_stats.total("open")))
+registry.register(Snapshot("mongo_pool_connections_in_use", "MongoDB connections checked out.", "gauge",
+                           lambda: pool_stats.total("in_use")))
+registry.register(Snapshot("mongo_pool_waiting", "Operations waiting for a MongoDB connection.", "gauge",
+                           lambda: pool_stats.total("waiting")))
 
+live = LiveHub(LIVE_QUEUE_SIZE)
+registry.register(Snapshot("live_subscribers", "Open live table streams.", "gauge", lambda: live.count))
+registry.register(Snapshot("live_events_total", "Item changes queued for live table streams.", "counter",
+                           lambda: live.published))
+registry.register(Snapshot("live_resyncs_total", "Live table streams told to reload, mostly for falling behind.",
+                           "counter", lambda: live.resyncs))
 
-async def fetch_inventory_page(page: int, items_per_page: int, user_id: str):
-    """
-    Fetch a specific page of items from the inventory collection.
+retention = Retention(RETENTION_MODE, timedelta(days=RETENTION_DAYS), RETENTION_BATCH_SIZE,
+                      RETENTION_BATCHES_PER_SECOND, rebuild_hour=RETENTION_REBUILD_HOUR)
 
-    This function performs pagination by skipping a certain number of documents and then
-    limiting the query to a specified number of items per page.
 
-    Args:
-        page (int): The page number to fetch.
-        items_per_page (int): The number of items per page.
+def notify_write(op: str, docs: list[dict]):
+    """
+    Pass a completed write on to every registered hook.
 
-    Returns:
-        list: A list of dictionaries, each representing an item for the specified page.
+    Args:
+        op (str): "insert", "update", "delete" or "cleanup".
+        docs (list[dict]): The written documents, or just their `_id` (and `user_id`) for deletes.
     """
-    skip = (page - 1) * items_per_page
-    items = await inv_collection.find({"user_id": user_id}).skip(skip).limit(items_per_page).to_list(items_per_page)
-    return items
+    for hook in write_hooks:
+        hook(op, docs)
 
 
-async def fetch_item(item_id: str):
+def invalidate_cache(op: str, docs: list[dict]):
     """
-    Fetch a single item from the inventory collection using its ID.
+    Write hook that drops the cached reads of every user and item touched by a write.
+    """
+    if op == "cleanup":
+        query_cache.clear()
+        return
+    for doc in docs:
+        query_cache.invalidate(f"item:{doc['_id']}")
+        if doc.get("user_id") is not None:
+            query_cache.invalidate(f"user:{doc['user_id']}")
 
-    Args:
-        item_id (str): The unique identifier of the item to fetch.
 
-    Returns:
-        dict: A dictionary representing the fetched item, or None if the item is not found.
-    """
-    item = await inv_collection.find_one({"_id": ObjectId(item_id)})
-    return item
+write_hooks.append(invalidate_cache)
 
 
-async def search_items(search_term: str, page, items_per_page:int, user_id: str):
+def forget_reads(op: str, docs: list[dict]):
+    """
+    Write hook that stops later reads from joining reads which started before the write.
     """
-    Search for items in the inventory collection matching a search term.
+    reads.forget()
 
-    This function supports pagination and searches for items based on their name, description,
-    or drawing fields.
 
-    Args:
-        search_term (str): The term to search within the items.
-        page (int): The page number of the search results to fetch.
-        items_per_page (int): The number of items per page in the search results.
+write_hooks.append(forget_reads)
+
 
-    Returns:
-        list: A list of dictionaries, each representing an item that matches the search term.
+def user_tags(args: dict, result) -> list[str]:
     """
-    query = {"$and": [
-                    {"$or": [{"name": {"$regex": search_term, "$options": "i"}}, 
-                     {"description": {"$regex": search_term, "$options": "i"}},
-                     {"drawing": {"$regex": search_term, "$options": "i"}}
-                    ]},
-                    {"user_id": user_id}
-                    ]}   
-    skip = (page - 1) * items_per_page
-    items = await inv_collection.find(query).skip(skip).limit(items_per_page).to_list(items_per_page)
-    return items
+    Cache tags for reads scoped to one user.
+    """
+    return [f"user:{args['user_id']}"]
 
 
-async def add_item(item: Item):
+def item_tags(args: dict, result) -> list[str]:
+    """
+    Cache tags for a single item read, including its owner once known.
     """
-    Add a new item to the inventory collection.
+    tags = [f"item:{args['item_id']}"]
+    if result is not None:
+        tags.append(f"user:{result.get('user_id')}")
+    return tags
 
-    Args:
-        item (Item): An instance of the Item class representing the item to be added.
 
-    Returns:
-        str: The unique identifier of the newly inserted item.
+def stored_datetime(value):
+    """
+    A datetime as MongoDB stores it, to the millisecond; other values are returned unchanged.
     """
-    result = await inv_collection.insert_one(item.model_dump())
-    return result.inserted_id
+    if isinstance(value, datetime):
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
 
 
-async def update_item(item_id:str, up_item: UpdateItem):
+def stamp(docs: list[dict]) -> list[dict]:
     """
-    Update an existing item in the inventory collection.
+    Set `update_date` on documents about to be sent, so delta sync sees them when they land rather
+    than when the request that carries them began.
+    """
+    now = stored_datetime(datetime.now())
+    for doc in docs:
+        doc["update_date"] = now
+    return docs
 
-    Args:
-        item_id (str): The unique identifier of the item to update.
-        up_item (UpdateItem): An instance of the UpdateItem class containing the updated values.
 
-    Returns:
-        bool: True if the update operation was successful, False otherwise.
+def as_write_error(details: dict) -> WriteError:
+    """
+    The error a single write would have raised, from one entry of a BulkWriteError's `writeErrors`.
     """
-    await inv_collection.update_one({"_id": ObjectId(item_id)}, {"$set": up_item.model_dump()})
-    return True
+    error_class = DuplicateKeyError if details.get("code") == 11000 else WriteError
+    return error_class(details.get("errmsg", ""), details.get("code"), details)
 
 
-async def delete_item(item_id:str):
+def page_query(query: dict, after: PageKey | None) -> dict:
     """
-    Delete an item from the inventory collection.
+    Restrict a query to the items sorted after the given `_id` key.
+    """
+    if after is None:
+        return query
+    return {**query, "_id": {"$gt": after.id}}
 
-    Args:
-        item_id (str): The unique identifier of the item to delete.
 
-    Returns:
-        bool: True if the deletion was successful, False otherwise.
+class Storage:
     """
-    await inv_collection.delete_one({"_id": ObjectId(item_id)})
-    return True
+    Inventory reads and writes over a Motor collection, or any object offering the same subset of its API.
+
+    Routers receive the active storage through the `get_storage` dependency, so it can be swapped out
+    (for example for a MemoryStorage in tests) with `app.dependency_overrides`.
+    """
+
+    def __init__(self, collection, tenants=None, tombstones=None, jobs=None):
+        """
+        Args:
+            collection: The item collection.
+            tenants (optional): Collection of per-user state, `{"_id": user_id, "version": int}`.
+                Without it list versions (and so list ETags) are not tracked.
+            tombstones (optional): Collection of deleted items, `{"_id": item_id, "user_id", "update_date"}`.
+                Without it delta sync does not report deletes.
+            jobs (optional): Collection of background job reports and of the leases that let one
+                worker at a time run them. Without it every worker runs its own jobs.
+        """
+        self.collection = collection
+        self.tenants = tenants
+        self.tombstones = tombstones
+        self.jobs = jobs
+        window = WRITE_BATCH_WINDOW_MS / 1000
+        self.inserts = Coalescer("insert", self._insert_batch, window, WRITE_BATCH_MAX)
+        self.updates = Coalescer("update", self._update_batch, window, WRITE_BATCH_MAX)
+
+    async def open(self):
+        """
+        Connect to the backend. Called by the app lifespan before the first request.
+        """
+
+    async def close(self):
+        """
+        Release the backend's connections. Called by the app lifespan at shutdown.
+        """
+        await self.inserts.drain()
+        await self.updates.drain()
+
+    async def health(self) -> dict:
+        """
+        Check that the backend answers and report its connection statistics.
+
+        Raises:
+            PyMongoError: If the backend cannot be reached.
+        """
+        return {"backend": type(self).__name__}
+
+    async def ensure_indexes(self):
+        """
+        Create the indexes the queries below rely on. Backends without indexes do nothing.
+        """
+
+    async def watch_changes(self, hub: LiveHub):
+        """
+        Feed item changes to the live table streams. This base version publishes this worker's own
+        writes; backends that can see every worker's writes keep running and publish those instead.
+        """
+        if hub.on_write not in write_hooks:
+            write_hooks.append(hub.on_write)
+
+    def iter_items(self, user_id: str, fields: list[str] | None = None, batch_size: int = 500):
+        """
+        Stream a user's items in `_id` order without loading them all into memory.
+
+        Args:
+            user_id (str): The owner of the items.
+            fields (list[str], optional): Only return these fields. Defaults to every field.
+            batch_size (int): The number of documents fetched per round trip.
+
+        Returns:
+            AsyncIOMotorCursor: An async iterator over the item documents.
+        """
+        projection = {"_id": 0, **{field: 1 for field in fields}} if fields else None
+        return self.collection.find({"user_id": user_id}, projection).sort("_id", 1).batch_size(batch_size)
+
+    @cached(query_cache, user_tags)
+    @single_flight(reads)
+    @timed_operation
+    async def fetch_inventory_page(self, items_per_page: int, user_id: str, after: PageKey | None = None,
+                                   fields: tuple[str, ...] | None = None, version: int | None = None):
+        """
+        Fetch a specific page of items from the inventory collection.
+
+        This function performs keyset pagination: items are sorted by `_id` and the page
+        starts right after the `after` key, so every page costs the same regardless of depth.
+
+        Args:
+            items_per_page (int): The number of items per page.
+            user_id (str): The owner of the items.
+            after (PageKey, optional): The sort key of the last item on the previous page.
+            fields (tuple[str], optional): Only return these fields and `_id`. Defaults to every field.
+            version (int, optional): The user's list version the page is read for. Not used in the
+                query, only in the cache key, so a page cached before a newer write is not reused.
+
+        Returns:
+            list: A list of dictionaries, each representing an item for the specified page.
+        """
+        query = page_query({"user_id": user_id}, after)
+        projection = {field: 1 for field in fields} if fields else None
+        items = await collect(self.collection.find(query, projection).sort("_id", 1).limit(items_per_page),
+                              items_per_page)
+        return items
+
+    @cached(query_cache, item_tags)
+    @single_flight(reads)
+    @timed_operation
+    async def fetch_item(self, item_id: str, fields: tuple[str, ...] | None = None):
+        """
+        Fetch a single item from the inventory collection using its ID.
+
+        Args:
+            item_id (str): The unique identifier of the item to fetch.
+            fields (tuple[str], optional): Only return these fields and `_id`. Defaults to every field.
+
+        Returns:
+            dict: A dictionary representing the fetched item, or None if the item is not found.
+        """
+        projection = {field: 1 for field in fields} if fields else None
+        item = await self.collection.find_one({"_id": ObjectId(item_id)}, projection)
+        return item
+
+    @cached(query_cache, user_tags)
+    @single_flight(reads)
+    @timed_operation
+    async def search_items(self, search_term: str, items_per_page: int, user_id: str, after: PageKey | None = None,
+                           version: int | None = None):
+        """
+        Search for items in the inventory collection matching a search term.
+
+        This function supports keyset pagination and searches for items based on their name,
+        description, or drawing fields. SEARCH_MODE selects the engine: "regex" matches any
+        substring, "text" uses the text index and ranks results by relevance.
+
+        Args:
+            search_term (str): The term to search within the items.
+            items_per_page (int): The number of items per page in the search results.
+            user_id (str): The owner of the items.
+            after (PageKey, optional): The sort key of the last item on the previous page.
+            version (int, optional): The user's list version the page is read for, as for
+                `fetch_inventory_page`.
+
+        Returns:
+            list: A list of dictionaries, each representing an item that matches the search term.
+        """
+        if SEARCH_MODE == "trigram":
+            return await self._search_trigram(search_term, items_per_page, user_id, after)
+        if SEARCH_MODE == "text":
+            try:
+                return await self._search_text(search_term, items_per_page, user_id, after)
+            except OperationFailure as err:
+                logger.warning("text search unavailable, falling back to regex: %s", err)
+        return await self._search_regex(search_term, items_per_page, user_id, after)
+
+    async def _search_regex(self, search_term: str, items_per_page: int, user_id: str, after: PageKey | None):
+        """
+        Case-insensitive substring search, in `_id` order.
+        """
+        query = {"$and": [
+                        {"$or": [{"name": {"$regex": search_term, "$options": "i"}}, 
+                         {"description": {"$regex": search_term, "$options": "i"}},
+                         {"drawing": {"$regex": search_term, "$options": "i"}}
+                        ]},
+                        page_query({"user_id": user_id}, after)
+                        ]}   
+        items = await collect(self.collection.find(query).sort("_id", 1).limit(items_per_page), items_per_page)
+        return items
+
+    async def _search_text(self, search_term: str, items_per_page: int, user_id: str, after: PageKey | None):
+        """
+        Text index search, best matches first. Each item carries its relevance in `score`.
+        """
+        pipeline = [
+            {"$match": {"user_id": user_id, "$text": {"$search": search_term}}},
+            {"$addFields": {"score": {"$meta": "textScore"}}},
+        ]
+        if after is not None and after.score is not None:
+            pipeline.append({"$match": {"$or": [{"score": {"$lt": after.score}},
+                                                {"score": after.score, "_id": {"$gt": after.id}}]}})
+        pipeline += [{"$sort": {"score": -1, "_id": 1}}, {"$limit": items_per_page}]
+        items = await collect(self.collection.aggregate(pipeline), items_per_page)
+        return items
+
+    async def _search_trigram(self, search_term: str, items_per_page: int, user_id: str, after: PageKey | None):
+        """
+        Resolve the matching ids from the in-process trigram index, then fetch only that page.
+
+        Users with too many items to index in TRIGRAM_MAX_BYTES are searched with the regex search.
+        """
+        index = await trigram_indexes.get(user_id, self._search_fields)
+        if index is None:
+            return await self._search_regex(search_term, items_per_page, user_id, after)
+        ids = index.search(search_term, items_per_page, after.id if after else None)
+        if not ids:
+            return []
+        items = await collect(self.collection.find({"_id": {"$in": ids}, "user_id": user_id}).sort("_id", 1),
+                              items_per_page)
+        return items
+
+    def _search_fields(self, user_id: str):
+        """
+        Stream the searchable fields of a user's items, for building their trigram index.
+        """
+        projection = {field: 1 for field in SEARCH_FIELDS}
+        return self.collection.find({"user_id": user_id}, projection)
+
+    async def list_version(self, user_id: str) -> int | None:
+        """
+        The write version of a user's items, bumped by every write that touches them.
+
+        Read it before the items themselves: a write lands before its version bump, so a list
+        read after the version can only be newer than it, never older.
+
+        Returns:
+            int: The version, or None when this storage does not track versions.
+        """
+        if self.tenants is None:
+            return None
+        tenant = await self.tenants.find_one({"_id": user_id}, {"version": 1})
+        return tenant["version"] if tenant else 0
+
+    async def get_summary(self, user_id: str) -> dict | None:
+        """
+        Item count and total quantity per status of a user's items, read from their counters document.
+
+        Returns:
+            dict: The summary, or None when this storage does not keep summaries.
+        """
+        if self.tenants is None:
+            return None
+        tenant = await self.tenants.find_one({"_id": user_id}, {"summary": 1})
+        return read_summary(tenant.get("summary", {}) if tenant else {})
+
+    async def rebuild_summary(self, user_id: str | None = None) -> int:
+        """
+        Recompute the summary counters from the items, for one user or for everyone.
+
+        Writes that land while the rebuild runs may be counted twice or not at all, so run it again
+        if the items were changing.
+
+        Returns:
+            int: The number of users whose summary was rewritten.
+        """
+        if self.tenants is None:
+            return 0
+        pipeline = [{"$match": {"user_id": user_id} if user_id is not None else {}},
+                    {"$group": {"_id": {"user_id": "$user_id", "status": "$status"},
+                                "count": {"$sum": 1},
+                                "quantity": {"$sum": "$quantity"}}}]
+        summaries = {user_id: {}} if user_id is not None else {}
+        async for row in self.collection.aggregate(pipeline):
+            if row["_id"].get("user_id") is not None:
+                # an empty and a missing status share one key, so their groups are added up
+                totals = summaries.setdefault(row["_id"]["user_id"], {}).setdefault(
+                    summary_key(row["_id"].get("status")), {"count": 0, "quantity": 0})
+                totals["count"] += row["count"]
+                totals["quantity"] += row["quantity"]
+        if user_id is None:
+            await self.tenants.update_many({"_id": {"$nin": list(summaries)}},
+                                           {"$set": {"summary": {}}, "$inc": {"version": 1}})
+        for owner, summary in summaries.items():
+            await self.tenants.update_one({"_id": owner}, {"$set": {"summary": summary}, "$inc": {"version": 1}},
+                                          upsert=True)
+        return len(summaries)
+
+    async def _bury(self, docs: list[dict]):
+        """
+        Record deleted items for delta sync.
+        """
+        now = datetime.now()
+        try:
+            await self.tombstones.insert_many([{"_id": doc["_id"], "user_id": doc.get("user_id"), "update_date": now}
+                                               for doc in docs], ordered=False)
+        except BulkWriteError as err:
+            # an item deleted twice (say by a bulk delete racing a cleanup) keeps its first tombstone
+            if any(error.get("code") != 11000 for error in err.details.get("writeErrors", [])):
+                raise
+
+    @timed_operation
+    async def fetch_changes(self, user_id: str, since: ChangeKey | None, until: datetime, limit: int):
+        """
+        The next items changed and deleted since a delta sync position, oldest change first.
+
+        Items and tombstones are both ordered by `update_date`, then `_id`; up to `limit` of each
+        are read past `since` and merged, and the first `limit` changes of the merge are returned.
+
+        Args:
+            user_id (str): The owner of the items.
+            since (ChangeKey, optional): The last change already seen. None starts from the beginning.
+            until (datetime): Only changes stamped before this are returned.
+            limit (int): The most changes returned.
+
+        Returns:
+            tuple: The changed items, the tombstones of the deleted ones, and whether more changes
+            before `until` remain.
+        """
+        query = {"user_id": user_id, "update_date": {"$lt": until}}
+        if since is not None:
+            query["$or"] = [{"update_date": {"$gt": since.stamp}},
+                            {"update_date": since.stamp, "_id": {"$gt": since.id}}]
+        sort = [("update_date", 1), ("_id", 1)]
+        items = await self.collection.find(query).sort(sort).limit(limit + 1).to_list(limit + 1)
+        tombstones = []
+        if self.tombstones is not None:
+            tombstones = await self.tombstones.find(query).sort(sort).limit(limit + 1).to_list(limit + 1)
+        changes = sorted([(doc, False) for doc in items] + [(doc, True) for doc in tombstones],
+                         key=lambda change: (change[0]["update_date"], change[0]["_id"]))
+        more = len(changes) > limit
+        changes = changes[:limit]
+        return ([doc for doc, deleted in changes if not deleted],
+                [doc for doc, deleted in changes if deleted],
+                more)
+
+    async def _written(self, op: str, docs: list[dict], before: list[dict] | None = None):
+        """
+        Run the write hooks, then bump the list version and adjust the summary counters of every
+        user the write touched, with one atomic `$inc` on each user's counters document.
+
+        Args:
+            op (str): "insert", "update", "delete" or "cleanup".
+            docs (list[dict]): The inserted, updated (as they are now) or deleted documents.
+            before (list[dict], optional): For updates, the same documents as they were before.
+        """
+        notify_write(op, docs)
+        if op == "delete" and docs and self.tombstones is not None:
+            await self._bury(docs)
+        if self.tenants is None:
+            return
+        if op == "cleanup":
+            await self.tenants.update_many({}, {"$inc": {"version": 1}})
+            return
+        changes = summary_changes(op, docs, before)
+        for user_id in {doc.get("user_id") for doc in docs + (before or [])} - {None}:
+            await self.tenants.update_one({"_id": user_id}, {"$inc": {"version": 1, **changes.get(user_id, {})}},
+                                          upsert=True)
+
+    @timed_operation
+    async def add_item(self, item: Item):
+        """
+        Add a new item to the inventory collection.
+
+        Args:
+            item (Item): An instance of the Item class representing the item to be added.
 
+        Returns:
+            str: The unique identifier of the newly inserted item.
+        """
+        doc = item.model_dump()
+        if self.inserts.enabled:
+            return await self.inserts.submit(doc)
+        result = await self.collection.insert_one(doc)
+        await self._written("insert", [doc])
+        return result.inserted_id
 
-async def insert_multiple_items(items: list[Item]):
+    async def _insert_batch(self, docs: list[dict]) -> list:
+        """
+        Insert the items added by concurrent `add_item` calls with one unordered `insert_many`.
+
+        Returns:
+            list: For each document, its new ObjectId or the error that rejected it.
+        """
+        errors = {}
+        try:
+            await self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError as err:
+            errors = {details["index"]: as_write_error(details) for details in err.details.get("writeErrors", [])}
+        await self._written("insert", [doc for index, doc in enumerate(docs) if index not in errors])
+        return [errors.get(index, doc["_id"]) for index, doc in enumerate(docs)]
+
+    @timed_operation
+    async def update_item(self, item_id: str, up_item: UpdateItem, user_id: str):
+        """
+        Update one of a user's items and return it as it is after the update, in one round trip.
+
+        The item is read back as it was before the update, which the summary counters need, and
+        the `$set` is applied to that copy to get the updated item. Dates are cut to the milliseconds
+        MongoDB stores, so the copy (and the ETag and row cache key taken from it) matches later reads.
+
+        Args:
+            item_id (str): The unique identifier of the item to update.
+            up_item (UpdateItem): An instance of the UpdateItem class containing the updated values.
+            user_id (str): The owner of the item. Items of other users are left untouched.
+
+        Returns:
+            dict: The updated item, or None if the user has no item with this ID.
+        """
+        fields = {key: stored_datetime(value) for key, value in up_item.model_dump().items()}
+        if self.updates.enabled:
+            return await self.updates.submit((ObjectId(item_id), fields, user_id))
+        before = await self.collection.find_one_and_update({"_id": ObjectId(item_id), "user_id": user_id},
+                                                           {"$set": fields}, return_document=ReturnDocument.BEFORE)
+        if before is None:
+            return None
+        item = {**before, **fields}
+        await self._written("update", [item], [before])
+        return item
+
+    async def _update_batch(self, updates: list[tuple[ObjectId, dict, str]]) -> list:
+        """
+        Apply the updates of concurrent `update_item` calls with one read of the items as they are
+        and one unordered `bulk_write`.
+
+        An item updated again within the batch waits for a second round, so every update sees the
+        one before it. Unlike `update_item`, the read and the write are separate round trips: a
+        change made in between by another worker is overwritten as usual, but the summary counters
+        are adjusted from the item as it was read.
+
+        Args:
+            updates (list[tuple]): `(item_id, fields, user_id)` per call.
+
+        Returns:
+            list: For each update, the updated item, None if the user has no such item, or the error
+            that rejected it.
+        """
+        results = [None] * len(updates)
+        rounds, seen = [], {}
+        for index, (item_id, _, _) in enumerate(updates):
+            depth = seen[item_id] = seen.get(item_id, -1) + 1
+            if depth == len(rounds):
+                rounds.append([])
+            rounds[depth].append(index)
+        for indexes in rounds:
+            current = {doc["_id"]: doc async for doc in self.collection.find(
+                {"_id": {"$in": [updates[index][0] for index in indexes]}})}
+            requests, positions = [], []
+            for index in indexes:
+                item_id, fields, user_id = updates[index]
+                before = current.get(item_id)
+                if before is None or before.get("user_id") != user_id:
+                    continue
+                requests.append(UpdateOne({"_id": item_id, "user_id": user_id}, {"$set": fields}))
+                positions.append(index)
+            if not requests:
+                continue
+            errors = {}
+            try:
+                await self.collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as err:
+                errors = {positions[details["index"]]: as_write_error(details)
+                          for details in err.details.get("writeErrors", [])}
+            items, before = [], []
+            for index in positions:
+                if index in errors:
+                    results[index] = errors[index]
+                    continue
+                item_id, fields, _ = updates[index]
+                results[index] = {**current[item_id], **fields}
+                items.append(results[index])
+                before.append(current[item_id])
+            if items:
+                await self._written("update", items, before)
+        return results
+
+    @timed_operation
+    async def delete_item(self, item_id:str):
+        """
+        Delete an item from the inventory collection.
+
+        Args:
+            item_id (str): The unique identifier of the item to delete.
+
+        Returns:
+            bool: True if the deletion was successful, False otherwise.
+        """
+        deleted = await self.collection.find_one_and_delete({"_id": ObjectId(item_id)},
+                                                            projection={"user_id": 1, "status": 1, "quantity": 1})
+        if deleted:
+            await self._written("delete", [deleted])
+        return True
+
+    @timed_operation
+    async def insert_multiple_items(self, items: list[Item]):
+        """
+        Insert multiple items into the inventory collection.
+
+        The items are sent in order, SYNC_STAMP_BATCH_SIZE at a time, each chunk stamped with its
+        own `update_date` as it is sent.
+
+        Args:
+            items (list[Item]): A list of Item instances representing the items to be added.
+
+        Returns:
+            list: A list of string identifiers for the newly inserted items.
+        """
+        items_dicts = [item.model_dump() for item in items]
+        ids = []
+        for start in range(0, len(items_dicts), SYNC_STAMP_BATCH_SIZE):
+            chunk = stamp(items_dicts[start:start + SYNC_STAMP_BATCH_SIZE])
+            result = await self.collection.insert_many(chunk)
+            await self._written("insert", chunk)
+            ids.extend(str(id) for id in result.inserted_ids)
+        return ids
+
+    @timed_operation
+    async def insert_item_batch(self, items: list[Item]):
+        """
+        Insert a batch of items without stopping at the first failure.
+
+        The batch is sent as one unordered `insert_many`, so documents after a failed one are
+        still inserted. Its `update_date` is stamped as it is sent.
+
+        Args:
+            items (list[Item]): A list of Item instances representing the items to be added.
+
+        Returns:
+            list: For each item, in order, its new ObjectId or the error message that rejected it.
+        """
+        items_dicts = stamp([item.model_dump() for item in items])
+        errors = {}
+        try:
+            await self.collection.insert_many(items_dicts, ordered=False)
+        except BulkWriteError as err:
+            errors = {write_error["index"]: write_error["errmsg"] for write_error in err.details.get("writeErrors", [])}
+        # insert_many assigns each document its _id before sending it
+        await self._written("insert", [doc for index, doc in enumerate(items_dicts) if index not in errors])
+        return [errors.get(index, doc["_id"]) for index, doc in enumerate(items_dicts)]
+
+    @timed_operation
+    async def bulk_write_items(self, user_id: str, operations: list[BulkOperation]):
+        """
+        Apply a batch of replace, set, quantity increment and delete operations to a user's items.
+
+        The writes are sent as unordered `bulk_write`s of SYNC_STAMP_BATCH_SIZE operations, so a failed
+        operation does not stop the others. Quantity increments use `$inc`, so concurrent adjustments
+        are never lost. Every changed item gets a new `update_date`, stamped as its chunk is sent.
+        Deletes follow, one `find_one_and_delete` per item,
+        so only the items this call removed are reported as deleted and counted.
+
+        Which items the user owns is read once before the write, and the written items are read back
+        after it; an item missing then was deleted by someone else, and its operation is reported as
+        not found. The summary counters are adjusted from those two reads, except for items that were
+        only incremented, whose adjustment is the exact sum of their deltas.
+
+        Args:
+            user_id (str): The owner of the items. Items of other users are reported as not found.
+            operations (list[BulkOperation]): The operations, applied in no particular order.
+
+        Returns:
+            list: For each operation, in order, None if it was applied or the error message that rejected it.
+        """
+        errors = {}
+        targets = {}
+        for index, operation in enumerate(operations):
+            if ObjectId.is_valid(operation.id):
+                targets[index] = ObjectId(operation.id)
+            else:
+                errors[index] = "invalid item id"
+        owned = {doc["_id"]: doc async for doc in self.collection.find(
+            {"_id": {"$in": list(set(targets.values()))}, "user_id": user_id},
+            {"user_id": 1, "status": 1, "quantity": 1})}
+
+        positions = []
+        for index, item_id in targets.items():
+            if item_id not in owned:
+                errors[index] = "item not found"
+            elif operations[index].op != "delete":
+                positions.append(index)
+
+        for start in range(0, len(positions), SYNC_STAMP_BATCH_SIZE):
+            chunk = positions[start:start + SYNC_STAMP_BATCH_SIZE]
+            now = stored_datetime(datetime.now())
+            requests = []
+            for index in chunk:
+                operation = operations[index]
+                query = {"_id": targets[index], "user_id": user_id}
+                if operation.op == "replace":
+                    requests.append(ReplaceOne(query, {**operation.item.model_dump(), "user_id": user_id,
+                                                       "update_date": now}))
+                elif operation.op == "set":
+                    fields = operation.fields.model_dump(exclude_unset=True, exclude_none=True)
+                    requests.append(UpdateOne(query, {"$set": {**fields, "update_date": now}}))
+                else:
+                    requests.append(UpdateOne(query, {"$inc": {"quantity": operation.quantity},
+                                                      "$set": {"update_date": now}}))
+            try:
+                await self.collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as err:
+                for write_error in err.details.get("writeErrors", []):
+                    errors[chunk[write_error["index"]]] = write_error["errmsg"]
+
+        applied = [index for index in positions if index not in errors]
+        if applied:
+            # the hooks need whole documents, and $set/$inc only name the fields they change; this is
+            # read before the deletes below, so an item both written and deleted is accounted in order
+            written = list({targets[index] for index in applied})
+            docs = await self.collection.find({"_id": {"$in": written}}).to_list(None)
+            found = {doc["_id"] for doc in docs}
+            increments, rewritten = {}, set()
+            for index in applied:
+                if targets[index] not in found:
+                    errors[index] = "item not found"
+                elif operations[index].op == "inc":
+                    increments[targets[index]] = increments.get(targets[index], 0) + operations[index].quantity
+                else:
+                    rewritten.add(targets[index])
+            before = [owned[doc["_id"]] if doc["_id"] in rewritten
+                      else {**doc, "quantity": doc.get("quantity", 0) - increments[doc["_id"]]}
+                      for doc in docs]
+            if docs:
+                await self._written("update", docs, before)
+
+        deletes = [index for index in targets if index not in errors and operations[index].op == "delete"]
+        removed = await asyncio.gather(*(
+            self.collection.find_one_and_delete({"_id": targets[index], "user_id": user_id},
+                                                projection={"user_id": 1, "status": 1, "quantity": 1})
+            for index in deletes))
+        for index, doc in zip(deletes, removed):
+            if doc is None:
+                errors[index] = "item not found"
+        if any(removed):
+            await self._written("delete", [doc for doc in removed if doc is not None])
+        return [errors.get(index) for index in range(len(operations))]
+
+    @timed_operation
+    async def delete_expired_batch(self, age: datetime, after: ObjectId | None, batch_size: int):
+        """
+        Delete the next chunk of items not updated since `age`, walking the collection in `_id` order.
+
+        Args:
+            age (datetime): Items last updated before this are deleted.
+            after (ObjectId, optional): The position returned for the previous chunk.
+            batch_size (int): The most items deleted by this call.
+
+        Returns:
+            tuple: The number of items deleted, and the position to continue from (None once done).
+        """
+        query = {"update_date": {"$lt": age}}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        projection = {"user_id": 1, "status": 1, "quantity": 1}
+        docs = await self.collection.find(query, projection).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not docs:
+            return 0, None
+        # each item is deleted on its own, checking its age again, so that only the items this call
+        # removed are counted and reported: not one updated since it was read, nor one another
+        # worker or an interactive delete removed first
+        deleted = await asyncio.gather(*(
+            self.collection.find_one_and_delete({"_id": doc["_id"], "update_date": {"$lt": age}}, projection=projection)
+            for doc in docs))
+        deleted = [doc for doc in deleted if doc is not None]
+        await self._written("delete", deleted)
+        # whether there is more to do depends on the chunk as read, not on how much of it was deleted
+        return len(deleted), docs[-1]["_id"] if len(docs) == batch_size else None
+
+    async def acquire_lease(self, name: str, owner: str, seconds: float, idle: float = 0, **fields) -> dict | None:
+        """
+        Take the named lease for `seconds`, unless another owner holds it, and store `fields` on it.
+
+        Args:
+            name (str): The lease.
+            owner (str): Who takes it; the same owner may take it again while holding it.
+            seconds (float): How long it is held unless renewed or released.
+            idle (float, optional): Also refuse it if it was last taken less than this many seconds ago.
+            fields: Stored on the lease, e.g. what the owner does with it.
+
+        Returns:
+            dict: The lease as it was before (`{}` the first time), or None if it was not taken.
+        """
+        if self.jobs is None:
+            return {}
+        now = datetime.now()
+        query = {"_id": f"lease:{name}", "$or": [{"expires": {"$lt": now}}, {"owner": owner}]}
+        if idle:
+            query["started"] = {"$lt": now - timedelta(seconds=idle)}
+        lease = {"owner": owner, "started": now, "expires": now + timedelta(seconds=seconds), **fields}
+        try:
+            before = await self.jobs.find_one_and_update(query, {"$set": lease})
+            if before is None:
+                # missed: either held by someone else, or never taken, which the insert tells apart
+                await self.jobs.insert_one({"_id": f"lease:{name}", **lease})
+                before = {}
+        except DuplicateKeyError:
+            return None
+        return before
+
+    async def read_lease(self, name: str) -> dict | None:
+        """
+        The named lease as stored, whoever holds it, or None if it was never taken.
+        """
+        if self.jobs is None:
+            return None
+        return await self.jobs.find_one({"_id": f"lease:{name}"})
+
+    async def renew_lease(self, name: str, owner: str, seconds: float, **fields) -> bool:
+        """
+        Extend a lease this owner holds by `seconds` from now, and store `fields` on it.
+        """
+        if self.jobs is None:
+            return True
+        result = await self.jobs.update_one({"_id": f"lease:{name}", "owner": owner},
+                                            {"$set": {"expires": datetime.now() + timedelta(seconds=seconds),
+                                                      **fields}})
+        return result.matched_count == 1
+
+    async def release_lease(self, name: str, owner: str, **fields):
+        """
+        Give up a lease this owner holds, storing `fields` on it for the next owner.
+        """
+        await self.renew_lease(name, owner, 0, **fields)
+
+    async def save_job(self, report: dict):
+        """
+        Store a background job's report, so any worker can answer for it.
+        """
+        if self.jobs is not None:
+            await self.jobs.update_one({"_id": report["job_id"]}, {"$set": {**report, "saved": datetime.now()}},
+                                       upsert=True)
+
+    async def find_job(self, job_id: str) -> dict | None:
+        if self.jobs is None:
+            return None
+        return await self.jobs.find_one({"_id": job_id, "job_id": job_id}, {"_id": 0, "saved": 0})
+
+    async def expired_by_server(self, rebuild: bool = True):
+        """
+        Drop whatever the write hooks hold for items the server's TTL monitor may have deleted.
+
+        Args:
+            rebuild (bool, optional): Also recount the summaries, which those deletes never reached.
+                This reads every item, so it is best done rarely and at a quiet time.
+        """
+        await self._written("cleanup", [])
+        if rebuild:
+            await self.rebuild_summary()
+
+
+class MongoStorage(Storage):
     """
-    Insert multiple items into the inventory collection.
+    Storage backed by the `InventoryApp.Item` collection of a MongoDB server.
 
-    Args:
-        items (list[Item]): A list of Item instances representing the items to be added.
+    The client is created by `open` rather than at import, so it belongs to the serving event loop,
+    and its pool is observed by `pool_stats`.
+    """
+
+    def __init__(self, connection: str | None, options: dict | None = None):
+        super().__init__(None)
+        self.connection = connection
+        self.options = options or {}
+        self.client = None
+
+    async def open(self):
+        self.client = AsyncIOMotorClient(self.connection, event_listeners=[pool_stats], **self.options)
+        database = self.client.InventoryApp
+        self.collection, self.tenants, self.tombstones = database["Item"], database["Tenant"], database["Tombstone"]
+        self.jobs = database["Job"]
+        await self.warm_up()
+
+    async def warm_up(self):
+        """
+        Open the minimum pool before traffic arrives, so early requests skip connection setup and TLS.
+
+        Concurrent pings each need their own connection; the driver's pool maintenance tops up any
+        that were served by a reused one.
+        """
+        pings = max(1, self.options.get("minPoolSize", 0))
+        try:
+            await asyncio.gather(*(self.client.admin.command("ping") for _ in range(pings)))
+        except PyMongoError as err:
+            logger.warning("MongoDB warm-up failed: %s", err)
 
-    Returns:
-        list: A list of string identifiers for the newly inserted items.
+    async def close(self):
+        await super().close()
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    async def health(self) -> dict:
+        started = perf_counter()
+        await self.client.admin.command("ping")
+        return {"backend": type(self).__name__,
+                "ping_ms": round((perf_counter() - started) * 1000, 2),
+                "pool": pool_stats.snapshot(),
+                }
+
+    async def watch_changes(self, hub: LiveHub):
+        if LIVE_SOURCE == "local":
+            await super().watch_changes(hub)
+            return
+        try:
+            await watch_changes(self.client.InventoryApp, hub, self.collection.name, self.tombstones.name)
+        except OperationFailure as err:
+            # watch_changes only gives up when the server has no change streams
+            if LIVE_SOURCE == "changestream":
+                logger.error("live updates are off, change streams are not available: %s", err)
+                return
+            logger.info("change streams need a replica set; live updates show this worker's writes only")
+            await super().watch_changes(hub)
+
+    async def ensure_indexes(self):
+        ttl = int(RETENTION_DAYS * 24 * 60 * 60) if RETENTION_MODE == "ttl" else None
+        await ensure_indexes(self.collection, SEARCH_MODE, ttl)
+        await ensure_tombstone_indexes(self.tombstones, int(TOMBSTONE_DAYS * 24 * 60 * 60))
+        await ensure_job_indexes(self.jobs, JOB_REPORT_DAYS * 24 * 60 * 60)
+
+
+class MemoryStorage(Storage):
+    """
+    Storage kept in process memory, with the same filtering, search, pagination and delete semantics.
+
+    Text search is not available, so SEARCH_MODE "text" falls back to the regex search.
+    """
+
+    def __init__(self):
+        super().__init__(MemoryCollection(), MemoryCollection(), MemoryCollection(), MemoryCollection())
+
+
+def create_storage(backend: str = STORAGE_BACKEND) -> Storage:
+    """
+    Build the storage selected by STORAGE_BACKEND.
     """
-    items_dicts = [item.model_dump() for item in items]
-    result = await inv_collection.insert_many(items_dicts)
-    return [str(id) for id in result.inserted_ids]
+    if backend == "memory":
+        return MemoryStorage()
+    return MongoStorage(mongo_connection, MONGO_CLIENT_OPTIONS)
 
 
-async def cleanup_old_records(age):
-    await inv_collection.delete_many({"update_date": {"$lt": age}})
+storage = create_storage()
+
+
+def get_storage() -> Storage:
+    """
+    FastAPI dependency returning the active storage.
+    """
+    return storage
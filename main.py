@@ -1,9 +1,75 @@
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from time import perf_counter
+IMPORT_STARTED = perf_counter()
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
+from pymongo.errors import PyMongoError
+from database import LIVE_SOURCE, RETENTION_INTERVAL, RETENTION_MODE, Storage, get_storage, live, retention
 from routers import api, webapp, demo
+from utils.compression import CompressionMiddleware
+from utils.metrics import MetricsMiddleware, Snapshot, registry
+
+
+logger = logging.getLogger(__name__)
+# responses smaller than COMPRESSION_MIN_SIZE bytes are sent uncompressed; "off" turns compression off
+COMPRESSION = os.getenv("COMPRESSION", "on")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", 4))
+# "import": seconds to import this module; "ready": seconds from the start of the import, or from the
+# fork of a preloaded app (see serve.py), to the end of lifespan startup
+startup = {"began": IMPORT_STARTED, "import": 0.0, "ready": 0.0}
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: startup.update(began=perf_counter()))
+registry.register(Snapshot("app_import_seconds", "Time this worker's app took to import.", "gauge",
+                           lambda: startup["import"]))
+registry.register(Snapshot("app_ready_seconds", "Time from this worker's import, or fork, to serving.", "gauge",
+                           lambda: startup["ready"]))
+
+
+def app_storage(app: FastAPI) -> Storage:
+    """
+    The storage the routes receive from `get_storage`, including one set in `app.dependency_overrides`,
+    so the lifespan opens, maintains and watches the same storage the requests use.
+    """
+    return app.dependency_overrides.get(get_storage, get_storage)()
+
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Open and warm up the storage, load the templates, build missing indexes in the background so a
+    long index build does not hold up startup, run the retention cleanup periodically and feed the live
+    table streams. Record how long the worker took to get here. Close it all at shutdown.
+    """
+    storage = app_storage(app)
+    await storage.open()
+    webapp.precompile_templates()
+    tasks = [asyncio.create_task(storage.ensure_indexes())]
+    if RETENTION_MODE != "off" and RETENTION_INTERVAL > 0:
+        tasks.append(asyncio.create_task(retention.schedule(storage, RETENTION_INTERVAL)))
+    if LIVE_SOURCE != "off":
+        tasks.append(asyncio.create_task(storage.watch_changes(live)))
+    startup["ready"] = perf_counter() - startup["began"]
+    logger.info("worker %d ready in %.3fs (app import took %.3fs)", os.getpid(), startup["ready"], startup["import"])
+    yield
+    for task in tasks:
+        task.cancel()
+    await retention.stop()
+    await storage.close()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
+if COMPRESSION != "off":
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE, gzip_level=COMPRESSION_GZIP_LEVEL,
+                       brotli_quality=COMPRESSION_BROTLI_QUALITY)
+# added last, so it wraps the compression and times the bytes as they leave
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(api.router)
 app.include_router(webapp.router)
@@ -14,6 +80,27 @@ async def root():
     return RedirectResponse("/app/")
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Request, storage and template timings in the Prometheus text format.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/health", include_in_schema=False)
+async def health(storage: Storage = Depends(get_storage)):
+    """
+    Storage reachability and connection pool statistics; 503 if the database does not answer.
+    """
+    try:
+        return {"status": "ok", **await asyncio.wait_for(storage.health(), timeout=5)}
+    except (PyMongoError, TimeoutError) as err:
+        return JSONResponse({"status": "unavailable", "error": str(err) or type(err).__name__}, status_code=503)
+
+
+startup["import"] = perf_counter() - IMPORT_STARTED
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", reload=True, log_level='debug')
\ No newline at end of file
+    uvicorn.run("main:app", reload=True, log_level='debug', timeout_graceful_shutdown=5)
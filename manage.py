@@ -0,0 +1,33 @@
+"""
+Maintenance commands, run against the storage configured in the environment.
+
+    python manage.py rebuild-summary
+    python manage.py rebuild-summary --user-id 1234
+"""
+import argparse
+import asyncio
+
+
+async def rebuild_summary(args):
+    from database import storage
+
+    await storage.open()
+    try:
+        users = await storage.rebuild_summary(args.user_id)
+    finally:
+        await storage.close()
+    print(f"rebuilt the summary of {users} users")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild = commands.add_parser("rebuild-summary", help="recount the per-user summaries from the items")
+    rebuild.add_argument("--user-id", help="only this user (default: everyone)")
+    rebuild.set_defaults(run=rebuild_summary)
+    args = parser.parse_args()
+    asyncio.run(args.run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 from datetime import datetime
+from typing import Annotated, Literal
 
 
 class Item(BaseModel):
@@ -37,6 +38,58 @@ class UpdateItem(BaseModel):
     update_date: datetime | None = None
 
 
+class ItemFields(BaseModel):
+    """
+    Any subset of an item's editable fields, for partial updates. Unknown fields are rejected.
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    name: str | None = None
+    description: str | None = None
+    drawing: str | None = None
+    quantity: int | None = None
+    status: str | None = None
+
+
+class ReplaceOperation(BaseModel):
+    """
+    Bulk operation replacing every field of an item.
+    """
+    op: Literal["replace"]
+    id: str
+    item: Item
+
+
+class SetOperation(BaseModel):
+    """
+    Bulk operation setting some fields of an item.
+    """
+    op: Literal["set"]
+    id: str
+    fields: ItemFields
+
+
+class IncOperation(BaseModel):
+    """
+    Bulk operation adjusting an item's quantity by a delta, atomically on the server.
+    """
+    op: Literal["inc"]
+    id: str
+    quantity: int
+
+
+class DeleteOperation(BaseModel):
+    """
+    Bulk operation deleting an item.
+    """
+    op: Literal["delete"]
+    id: str
+
+
+BulkOperation = Annotated[ReplaceOperation | SetOperation | IncOperation | DeleteOperation,
+                          Field(discriminator="op")]
+
+
 Input_Types = {
     "name": {
         "type": "text",
@@ -1,33 +1,102 @@
+import asyncio
 from datetime import datetime, timedelta
-from fastapi import APIRouter, HTTPException, status
+from time import perf_counter
+from typing import Literal
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo.errors import PyMongoError
 
-from models import Item
-from database import fetch_item, insert_multiple_items, get_all_items, cleanup_old_records
+from models import BulkOperation, Item, UpdateItem
+from database import SYNC_SETTLE_SECONDS, TOMBSTONE_DAYS, Storage, get_storage, query_cache, retention
+from utils.bulk_import import csv_records, ndjson_records
+from utils.etag import if_none_match, item_etag, list_tag, not_modified, tag_response, unchanged_item
+from utils.export import csv_lines, dumps, json_array, ndjson_lines, select_fields
+from utils.metrics import TimedRoute
+from utils.pagination import ChangeKey, decode_change_cursor, decode_cursor, encode_change_cursor, next_cursor
 
 
 router = APIRouter(
   prefix="/api",
   tags=["API"],
+  route_class=TimedRoute,
   )
 
+# Our own documents are written through Item, so reads are projected to its fields and encoded
+# directly instead of being validated again by the response_model (which only documents the schema).
+ITEM_FIELDS = tuple(Item.model_fields)
+
 
 @router.get("/items", response_model=list[Item])
-async def get_all(user_id: str):
+async def get_all(request: Request, user_id: str, limit: int | None = Query(None, gt=0), after: str | None = None,
+                  format: Literal["json", "ndjson", "csv"] = "json", fields: str | None = None,
+                  storage: Storage = Depends(get_storage)):
     """
     Retrieve a list of all items in the database.
 
+    When `limit` is given only one page is returned, and the token for the next page
+    is sent in the `X-Next-After` header (absent on the last page). Pages carry an ETag
+    of the user's write version; a matching `If-None-Match` gets an empty 304.
+
+    Without `limit`, or with `format` set to "ndjson" or "csv", the whole inventory is
+    streamed from the database cursor instead, in constant memory, and `after` is ignored.
+
+    Args:
+        user_id (str): The owner of the items.
+        limit (int, optional): The number of items per page.
+        after (str, optional): The "after" token returned with the previous page.
+        format (str, optional): "json" (default), "ndjson" or "csv".
+        fields (str, optional): Comma separated fields to export. Defaults to every Item field.
+
     Returns:
         list[Item]: A list of items, each item is an instance of the Item model.
+
+    Raises:
+        HTTPException: 400 error if the "after" token or a field name is invalid.
+    """
+    if format != "json":
+        return export_items(storage, user_id, format, fields)
+    if limit is None:
+        return StreamingResponse(json_array(storage.iter_items(user_id, ITEM_FIELDS), ITEM_FIELDS),
+                                 media_type="application/json")
+    try:
+        after_key = decode_cursor(after)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    version, etag = await list_tag(storage, user_id)
+    if if_none_match(request, etag):
+        return not_modified(etag)
+    items = await storage.fetch_inventory_page(limit, user_id, after_key, ITEM_FIELDS, version)
+    token = next_cursor(items, limit)
+    headers = {"X-Next-After": token} if token else None
+    return tag_response(Response(dumps([select_fields(item, ITEM_FIELDS) for item in items]),
+                                 media_type="application/json", headers=headers), etag)
+
+
+def export_items(storage: Storage, user_id: str, format: str, fields: str | None) -> StreamingResponse:
+    """
+    Stream a user's items as NDJSON or CSV.
     """
-    items = await get_all_items(user_id)
-    return items
+    selected = fields.split(",") if fields else list(Item.model_fields)
+    unknown = set(selected) - set(Item.model_fields)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown fields: {', '.join(sorted(unknown))}")
+    docs = storage.iter_items(user_id, selected)
+    if format == "csv":
+        return StreamingResponse(csv_lines(docs, selected), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="items.csv"'})
+    return StreamingResponse(ndjson_lines(docs), media_type="application/x-ndjson")
 
 
 @router.get("/item/{item_id}", response_model=Item)
-async def api_get_item(item_id: str):
+async def api_get_item(request: Request, item_id: str, storage: Storage = Depends(get_storage)):
     """
     Retrieve a single item by its name.
 
+    The response carries an ETag derived from the item's `update_date`; a matching
+    `If-None-Match` gets an empty 304.
+
     Args:
         name (str): The name of the item to be retrieved.
 
@@ -37,14 +106,42 @@ async def api_get_item(item_id: str):
     Raises:
         HTTPException: 404 error if the item is not found in the database.
     """
-    item = await fetch_item(item_id)
+    etag = await unchanged_item(request, storage, item_id)
+    if etag:
+        return not_modified(etag)
+    item = await storage.fetch_item(item_id, ITEM_FIELDS)
     if item:
-        return item
+        return tag_response(Response(dumps(select_fields(item, ITEM_FIELDS)), media_type="application/json"),
+                            item_etag(item))
     raise HTTPException(status_code=404, detail="item not found")
 
 
+@router.put("/item/{item_id}", response_model=Item)
+async def api_update_item(item_id: str, up_item: UpdateItem, user_id: str, storage: Storage = Depends(get_storage)):
+    """
+    Update one of a user's items and return it as updated.
+
+    Args:
+        item_id (str): The unique identifier of the item to update.
+        up_item (UpdateItem): The new values of the item.
+        user_id (str): The owner of the item.
+
+    Returns:
+        Item: The item after the update, with its new ETag.
+
+    Raises:
+        HTTPException: 404 error if the user has no item with this ID.
+    """
+    up_item = up_item.model_copy(update={"update_date": datetime.now(), "user_id": user_id})
+    item = await storage.update_item(item_id, up_item, user_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="item not found")
+    return tag_response(Response(dumps(select_fields(item, ITEM_FIELDS)), media_type="application/json"),
+                        item_etag(item))
+
+
 @router.post("/insert/", status_code=status.HTTP_201_CREATED)
-async def create_multiple_items(items: list[Item], user_id: str):
+async def create_multiple_items(items: list[Item], user_id: str, storage: Storage = Depends(get_storage)):
     """
     Insert multiple items into the database.
 
@@ -58,19 +155,249 @@ async def create_multiple_items(items: list[Item], user_id: str):
         HTTPException: 400 error if there is an error inserting the items.
     """
     new_items = []
-    update_fields = {"update_date": datetime.now(),
-                     "user_id": user_id,
-                    }
+    # update_date is stamped by the storage as the items are sent
+    update_fields = {"user_id": user_id}
     for item in items:
         new_item = item.model_copy(update=update_fields)
         new_items.append(new_item)
-    result = await insert_multiple_items(new_items)
+    result = await storage.insert_multiple_items(new_items)
     if result:
         return {"message": "Items added successfully", "item_ids": result}
     raise HTTPException(status_code=400, detail="Error inserting items")
 
-@router.post("/cleanup")
-async def cleanup_old():
-    two_weeks = datetime.now() - timedelta(weeks=2)
-    await cleanup_old_records(two_weeks)
-    return {"message": "Old Item removed"}
\ No newline at end of file
+
+@router.post("/bulk")
+async def bulk_write(operations: list[BulkOperation], user_id: str, storage: Storage = Depends(get_storage)):
+    """
+    Apply a batch of item operations in one database round trip.
+
+    Each operation is one of:
+
+    - `{"op": "replace", "id": ..., "item": {...}}` replaces every field of the item.
+    - `{"op": "set", "id": ..., "fields": {...}}` sets only the given fields.
+    - `{"op": "inc", "id": ..., "quantity": n}` adds `n` (which may be negative) to the quantity, atomically.
+    - `{"op": "delete", "id": ...}` deletes the item.
+
+    Operations run unordered and independently: one failing does not affect the others.
+
+    Args:
+        operations (list[BulkOperation]): The operations to apply.
+        user_id (str): The owner of the items.
+
+    Returns:
+        dict: The number of applied and failed operations, and each operation's outcome.
+
+    Raises:
+        HTTPException: 400 error if the batch has more than 10,000 operations.
+    """
+    if len(operations) > 10_000:
+        raise HTTPException(status_code=400, detail="at most 10000 operations per request")
+    outcomes = await storage.bulk_write_items(user_id, operations)
+    results = []
+    for index, (operation, error) in enumerate(zip(operations, outcomes)):
+        result = {"index": index, "op": operation.op, "id": operation.id, "ok": error is None}
+        if error is not None:
+            result["error"] = error
+        results.append(result)
+    applied = sum(result["ok"] for result in results)
+    return {"applied": applied,
+            "failed": len(results) - applied,
+            "results": results,
+            }
+
+
+@router.post("/import")
+async def import_items(request: Request, user_id: str, format: Literal["ndjson", "csv"] = "ndjson",
+                       batch_size: int = Query(500, gt=0, le=10_000), concurrency: int = Query(4, gt=0, le=32),
+                       storage: Storage = Depends(get_storage)):
+    """
+    Import items from a streamed NDJSON or CSV upload.
+
+    The body is parsed as it arrives and valid rows are inserted in unordered batches of
+    `batch_size`, with at most `concurrency` batches in flight. A bad row (including one that is not
+    valid UTF-8) only fails itself.
+
+    Args:
+        user_id (str): The owner of the imported items.
+        format (str, optional): "ndjson" (default) or "csv" with a header row.
+        batch_size (int, optional): Rows per insert. Defaults to 500.
+        concurrency (int, optional): Batches inserted at the same time. Defaults to 4.
+
+    Returns:
+        dict: Per-row outcomes (inserted id or error) and throughput stats.
+    """
+    started = perf_counter()
+    records = csv_records if format == "csv" else ndjson_records
+    # update_date is stamped by the storage as each batch is sent, so a delta sync running while
+    # a long upload is imported does not pass over the rows inserted after it
+    update_fields = {"update_date": None,
+                     "user_id": user_id,
+                    }
+    results = []
+    slots = asyncio.Semaphore(concurrency)
+    inserts = []
+
+    async def insert_batch(batch: list[tuple[int, Item]]):
+        try:
+            outcomes = await storage.insert_item_batch([item for _, item in batch])
+        except PyMongoError as err:
+            outcomes = [str(err)] * len(batch)
+        finally:
+            slots.release()
+        for (row, _), outcome in zip(batch, outcomes):
+            if isinstance(outcome, str):
+                results.append({"row": row, "error": outcome})
+            else:
+                results.append({"row": row, "id": str(outcome)})
+
+    async def schedule(batch: list[tuple[int, Item]]):
+        # waiting for a free slot stops reading the upload, so memory stays bounded
+        await slots.acquire()
+        inserts.append(asyncio.create_task(insert_batch(batch)))
+
+    batch = []
+    try:
+        async for row, record in records(request.stream()):
+            if isinstance(record, str):
+                results.append({"row": row, "error": record})
+                continue
+            record = {key: value for key, value in record.items() if key not in update_fields}
+            try:
+                item = Item.model_validate(record).model_copy(update=update_fields)
+            except ValidationError as err:
+                message = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in err.errors())
+                results.append({"row": row, "error": message})
+                continue
+            batch.append((row, item))
+            if len(batch) >= batch_size:
+                await schedule(batch)
+                batch = []
+        if batch:
+            await schedule(batch)
+    except BaseException:
+        # reading the upload failed (or the client went away): finish the batches already sent
+        # before the error is reported, rather than leave them writing unobserved
+        await asyncio.gather(*inserts, return_exceptions=True)
+        raise
+    await asyncio.gather(*inserts)
+
+    seconds = perf_counter() - started
+    inserted = sum("id" in result for result in results)
+    return {"inserted": inserted,
+            "failed": len(results) - inserted,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(len(results) / seconds, 1) if seconds else None,
+            "rows": sorted(results, key=lambda result: result["row"]),
+            }
+
+
+@router.get("/changes")
+async def get_changes(user_id: str, since: str | None = None, limit: int = Query(1000, gt=0, le=10000),
+                      storage: Storage = Depends(get_storage)):
+    """
+    Delta sync: the items changed and deleted since an earlier call, oldest change first.
+
+    Start without `since` to receive every item, then pass the returned `cursor` as `since` on
+    the next call. While `more` is true, call again right away for the rest. Changes are reported
+    a couple of seconds after they are made, so that slower concurrent writes are not skipped.
+
+    Args:
+        user_id (str): The owner of the items.
+        since (str, optional): The `cursor` returned by the previous call.
+        limit (int): The most changes (items and deletes together) returned.
+
+    Returns:
+        dict: `items` changed (with their `id`), `deleted` item ids, `cursor` for the next call,
+        `more`, and `expired_before` when retention runs: items last updated before that date have
+        been removed without being listed in `deleted` and should be dropped too.
+
+    Raises:
+        HTTPException: 400 error if `since` is malformed; 410 error if it is older than the deletes
+        are remembered, and a full sync (without `since`) is needed.
+    """
+    try:
+        since_key = decode_change_cursor(since)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    now = datetime.now()
+    if since_key is not None and since_key.stamp < now - timedelta(days=TOMBSTONE_DAYS):
+        raise HTTPException(status_code=410, detail="sync cursor expired, sync again without since")
+    until = now - timedelta(seconds=SYNC_SETTLE_SECONDS)
+    items, deleted, more = await storage.fetch_changes(user_id, since_key, until, limit)
+    last = max(items + deleted, key=lambda doc: (doc["update_date"], doc["_id"]), default=None)
+    if more:
+        cursor = ChangeKey(last["update_date"], last["_id"])
+    else:
+        # everything stamped before `until` has been returned; the zero id keeps changes stamped exactly then
+        cursor = ChangeKey(until, ObjectId("0" * 24))
+    body = {"items": [{"id": str(item["_id"]), **select_fields(item, ITEM_FIELDS)} for item in items],
+            "deleted": [str(doc["_id"]) for doc in deleted],
+            "cursor": encode_change_cursor(cursor),
+            "more": more,
+            "expired_before": (now - retention.max_age).isoformat() if retention.mode != "off" else None,
+            }
+    return Response(dumps(body), media_type="application/json")
+
+
+@router.get("/summary")
+async def get_summary(user_id: str, storage: Storage = Depends(get_storage)):
+    """
+    Report how many items a user has and their total quantity, per status and overall.
+
+    The figures are counters kept up to date by every write, so this never scans the items.
+
+    Returns:
+        dict: `count` and `quantity`, and `statuses` mapping each status to its own `count` and `quantity`.
+
+    Raises:
+        HTTPException: 404 error if the storage does not keep summaries.
+    """
+    summary = await storage.get_summary(user_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="summaries are not available")
+    return summary
+
+
+@router.post("/cleanup", status_code=status.HTTP_202_ACCEPTED)
+async def cleanup_old(storage: Storage = Depends(get_storage)):
+    """
+    Start removing items that have not been updated for the retention period, in the background.
+
+    If a cleanup is already running, in this or another worker, no new one is started and that
+    job is returned instead.
+
+    Returns:
+        dict: The job's id, status and progress. Poll `GET /api/cleanup/{job_id}` for updates.
+
+    Raises:
+        HTTPException: 409 error if another worker runs a cleanup whose report is not available yet.
+    """
+    job = await retention.start(storage)
+    if job is not None:
+        return job.report()
+    report = await retention.running(storage)
+    if report is None:
+        raise HTTPException(status_code=409, detail="a cleanup is already running")
+    return report
+
+
+@router.get("/cleanup/{job_id}")
+async def cleanup_status(job_id: str, storage: Storage = Depends(get_storage)):
+    """
+    Report the status and progress of a cleanup job, whichever worker runs it.
+
+    Raises:
+        HTTPException: 404 error if the job is unknown or too old to be kept.
+    """
+    report = await retention.report(storage, job_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="cleanup job not found")
+    return report
+
+
+@router.get("/cache")
+async def cache_stats():
+    """
+    Report the query cache's size and hit, miss and eviction counters.
+    """
+    return query_cache.stats()
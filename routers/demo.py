@@ -3,7 +3,8 @@ from fastapi import APIRouter, Depends
 from fastapi.responses import RedirectResponse
 
 from models import Item
-from database import insert_multiple_items
+from database import Storage, get_storage
+from utils.metrics import TimedRoute
 from utils.user_cookies import get_user, set_user
 
 
@@ -266,11 +267,12 @@ item_list = [
 router = APIRouter(
   prefix="/demo",
   tags=["Demo"],
+  route_class=TimedRoute,
   )
 
 
 @router.post("/insert/")
-async def create_multiple_items(user_id: str = Depends(get_user)):
+async def create_multiple_items(user_id: str = Depends(get_user), storage: Storage = Depends(get_storage)):
     """
     Insert multiple demo items into the database.
     """
@@ -282,7 +284,7 @@ async def create_multiple_items(user_id: str = Depends(get_user)):
         mod_item = Item(**item)
         new_item = mod_item.model_copy(update=update_fields)
         new_items.append(new_item)
-    await insert_multiple_items(new_items)
+    await storage.insert_multiple_items(new_items)
     
     response = RedirectResponse(url="/", status_code=303)
     await set_user(response, user_id)
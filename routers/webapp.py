@@ -1,98 +1,259 @@
+import asyncio
+import logging
+import os
 from datetime import datetime
+from os import getenv
 
-from fastapi import APIRouter, Request, Form, Depends
+from fastapi import APIRouter, Request, Form, Depends, HTTPException
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse, Response
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
+from jinja2 import FileSystemBytecodeCache
 
-from database import fetch_inventory_page, fetch_item, add_item, update_item, delete_item, search_items
+from database import Storage, get_storage, live, write_hooks
 from models import Item, UpdateItem, Input_Types
+from utils.etag import if_none_match, item_etag, list_tag, not_modified, tag_response, unchanged_item
+from utils.fragments import FragmentCache
+from utils.cache import MISSING
+from utils.inflight import Superseded, Supersede
+from utils.live import sse_event
+from utils.metrics import Snapshot, TimedRoute, TimedTemplate, registry
+from utils.pagination import PageKey, decode_cursor, next_cursor
+from utils.prefetch import PageBuffer
+from utils.streaming import stream_template
 from utils.user_cookies import get_user, set_user
 
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(
     prefix="/app",
     tags=["App"],
     include_in_schema=False,
+    route_class=TimedRoute,
 )
 
+# compiled templates persist across restarts, so workers do not compile them again on boot;
+# unset, Jinja keeps them in a private per-user directory under the system temp directory
+JINJA_CACHE_DIR = getenv("JINJA_CACHE_DIR")
+
+
+def bytecode_cache(directory: str | None) -> FileSystemBytecodeCache | None:
+    """
+    Jinja bytecode cache in `directory`, or in Jinja's own per-user temp directory if None.
+
+    Cached bytecode is run when loaded, so a configured directory is created private (0700) and
+    refused, leaving templates uncached, unless this user owns it and no one else can write to it.
+    """
+    if directory is None:
+        return FileSystemBytecodeCache()
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if hasattr(os, "getuid") and (info.st_uid != os.getuid() or info.st_mode & 0o022):
+        logger.warning("not caching compiled templates in %s: it must be owned by this user and "
+                       "not writable by others", directory)
+        return None
+    return FileSystemBytecodeCache(directory)
+
+
 templates = Jinja2Templates(directory="templates")
+templates.env.template_class = TimedTemplate
+templates.env.bytecode_cache = bytecode_cache(JINJA_CACHE_DIR)
 item_schema = Item.model_json_schema()
 
 ITEMS_PER_PAGE = 30
+# rendered view/edit rows; 0 turns the cache off
+FRAGMENT_CACHE_MAX_BYTES = int(getenv("FRAGMENT_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+# seconds a page read ahead for the infinite scroll is kept; 0 turns prefetching off
+PREFETCH_TTL = float(getenv("PREFETCH_TTL", 0))
+PREFETCH_MAX_PAGES = int(getenv("PREFETCH_MAX_PAGES", 256))
+# "on" sends the full page templates as they render, in chunks of STREAM_CHUNK_BYTES; "off" renders them whole
+TEMPLATE_STREAMING = getenv("TEMPLATE_STREAMING", "on")
+STREAM_CHUNK_BYTES = int(getenv("STREAM_CHUNK_BYTES", 8 * 1024))
+# seconds between comments sent on an idle live stream, so proxies keep it open
+LIVE_KEEPALIVE = float(getenv("LIVE_KEEPALIVE", 15))
+
+fragment_cache = FragmentCache(templates.env, FRAGMENT_CACHE_MAX_BYTES,
+                               {"item_schema": item_schema, "input_types": Input_Types})
+templates.env.globals["render_row"] = fragment_cache.render
+registry.register(Snapshot("fragment_cache_hits_total", "Rendered row cache hits.", "counter",
+                           lambda: fragment_cache.hits))
+registry.register(Snapshot("fragment_cache_misses_total", "Rendered row cache misses.", "counter",
+                           lambda: fragment_cache.misses))
+registry.register(Snapshot("fragment_cache_evictions_total", "Rendered row cache LRU evictions.", "counter",
+                           lambda: fragment_cache.evictions))
+registry.register(Snapshot("fragment_cache_bytes", "Size of the rendered row cache.", "gauge",
+                           lambda: fragment_cache.bytes))
+
+page_buffer = PageBuffer(PREFETCH_TTL, PREFETCH_MAX_PAGES)
+write_hooks.append(page_buffer.on_write)
+registry.register(Snapshot("prefetch_pages_total", "Pages read ahead for the infinite scroll.", "counter",
+                           lambda: page_buffer.prefetched))
+registry.register(Snapshot("prefetch_hits_total", "Page requests answered from a page read ahead.", "counter",
+                           lambda: page_buffer.hits))
+registry.register(Snapshot("prefetch_misses_total", "Page requests that found no page read ahead.", "counter",
+                           lambda: page_buffer.misses))
+registry.register(Snapshot("prefetch_wasted_total", "Pages read ahead that expired, were evicted or went stale unused.",
+                           "counter", lambda: page_buffer.wasted))
+
+# one active search per user: typing starts a new search and cancels the one still running
+searches = Supersede()
+registry.register(Snapshot("search_superseded_total", "Active searches cancelled by a newer search of the same user.",
+                           "counter", lambda: searches.superseded))
+
+
+def precompile_templates():
+    """
+    Load every template now, from the bytecode cache when it has them, instead of on first use.
+    """
+    for name in templates.env.list_templates():
+        templates.env.get_template(name)
+
+
+def page_response(request: Request, name: str, context: dict) -> Response:
+    """
+    Render one of the full page templates, streamed unless TEMPLATE_STREAMING is "off".
+    """
+    context = {"request": request, **context}
+    if TEMPLATE_STREAMING != "off":
+        return stream_template(templates.env, name, context, STREAM_CHUNK_BYTES)
+    return templates.TemplateResponse(name, context)
+
+
+async def read_page(storage: Storage, user_id: str, search: str, after: PageKey | None = None,
+                    version: int | None = None) -> list[dict]:
+    """
+    One page of the user's items, or of their search results when `search` is set, read for
+    the user's list `version`.
+    """
+    if search:
+        return await storage.search_items(search, ITEMS_PER_PAGE, user_id, after, version=version)
+    return await storage.fetch_inventory_page(ITEMS_PER_PAGE, user_id, after, version=version)
+
+
+async def read_ahead(storage: Storage, user_id: str, search: str, after: str, version: int | None) -> list[dict]:
+    items = await read_page(storage, user_id, search, decode_cursor(after), version)
+    # warm the row cache too, so serving the page only joins the rendered rows
+    for item in items:
+        fragment_cache.render("view_item_row.html", item)
+    return items
+
+
+def prefetch(storage: Storage, user_id: str, search: str, next_after: str | None, version: int | None):
+    """
+    Start reading the page after the one being served, when prefetching is on and there is one.
+
+    The page is buffered under the list `version` it was read for, so it is only served while
+    that is still the user's version.
+    """
+    if next_after is not None:
+        page_buffer.schedule((user_id, search, next_after, version),
+                             lambda: read_ahead(storage, user_id, search, next_after, version))
 
 
 @router.get("/")
-async def get_inventory(request: Request, page: int = 1, user_id: str = Depends(get_user)):
+async def get_inventory(request: Request, user_id: str = Depends(get_user),
+                        storage: Storage = Depends(get_storage)):
     """
-    Fetch a page of inventory items and render it using the 'base.html' template.
+    Fetch the first page of inventory items and render it using the 'base.html' template.
 
     Args:
         request (Request): The HTTP request object.
-        page (int, optional): The page number for pagination. Defaults to 1.
 
     Returns:
-        TemplateResponse: A template response with the current page of inventory items.
+        TemplateResponse: A template response with the first page of inventory items.
     """
-    items = await fetch_inventory_page(page, ITEMS_PER_PAGE, user_id)
-    response = templates.TemplateResponse("base.html", {"request": request,
-                                                    "item_schema": item_schema,
+    version, etag = await list_tag(storage, user_id)
+    if if_none_match(request, etag):
+        response = not_modified(etag)
+        await set_user(response, user_id)
+        return response
+    items = await read_page(storage, user_id, "", version=version)
+    next_after = next_cursor(items, ITEMS_PER_PAGE)
+    prefetch(storage, user_id, "", next_after, version)
+    response = page_response(request, "base.html", {"item_schema": item_schema,
                                                     "input_types": Input_Types,
                                                     "items": items,
-                                                    "current_page": 1,
+                                                    "next_after": next_after,
                                                     })
+    tag_response(response, etag)
     await set_user(response, user_id)
     return response
 
 
 @router.get("/items")
-async def more_inventory(request: Request, page: int, search: str, user_id: str = Depends(get_user)):
+async def more_inventory(request: Request, after: str, search: str = "", user_id: str = Depends(get_user),
+                         storage: Storage = Depends(get_storage)):
     """
-    Fetch a page of inventory items with an optional search query and render it using the 'more_rows.html' template.
+    Fetch the next page of inventory items with an optional search query and render it using the 'more_rows.html' template.
+
+    The page is taken from the prefetch buffer when it was read ahead, and the page after it is read ahead in turn.
 
     Args:
         request (Request): The HTTP request object.
-        page (int): The page number for pagination.
-        search (str, optional): Search query to filter items. Defaults to None.
+        after (str): The "after" token of the previous page.
+        search (str, optional): Search query to filter items. Defaults to "".
 
     Returns:
         TemplateResponse: A template response with a list of items matching the search query and pagination details.
+
+    Raises:
+        HTTPException: 400 error if the "after" token is invalid.
     """
-    clean_search = "" if search == "None" else search
-    if clean_search:
-        items = await search_items(clean_search, page, ITEMS_PER_PAGE, user_id)
-    else:
-        items = await fetch_inventory_page(page, ITEMS_PER_PAGE, user_id)
-        response = templates.TemplateResponse("more_rows.html", {"request": request,
-                                                         "item_schema": item_schema,
-                                                         "items": items,
-                                                         "current_page":page,
-                                                         "search": clean_search})
+    try:
+        after_key = decode_cursor(after)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    version, etag = await list_tag(storage, user_id)
+    if if_none_match(request, etag):
+        response = not_modified(etag)
         await set_user(response, user_id)
+        return response
+    clean_search = "" if search == "None" else search
+    items = await page_buffer.take((user_id, clean_search, after, version)) if page_buffer.enabled else MISSING
+    if items is MISSING:
+        items = await read_page(storage, user_id, clean_search, after_key, version)
+    next_after = next_cursor(items, ITEMS_PER_PAGE)
+    prefetch(storage, user_id, clean_search, next_after, version)
+    response = templates.TemplateResponse("more_rows.html", {"request": request,
+                                                     "item_schema": item_schema,
+                                                     "items": items,
+                                                     "next_after": next_after,
+                                                     "search": clean_search})
+    tag_response(response, etag)
+    await set_user(response, user_id)
     return response
 
 
 @router.get("/item/{item_id}")
-async def get_item(request: Request, item_id: str, user_id: str = Depends(get_user)):
+async def get_item(request: Request, item_id: str, user_id: str = Depends(get_user),
+                   storage: Storage = Depends(get_storage)):
     """
     Fetch a single item by its ID and render it using the 'view_item_row.html' template.
 
+    Rows are served from the rendered fragment cache when the item has not changed, and
+    not at all (304) when the request's If-None-Match still matches the item's ETag.
+
     Args:
         request (Request): The HTTP request object.
         item_id (str): The unique identifier of the item.
 
     Returns:
-        TemplateResponse: A template response with details of the requested item.
+        HTMLResponse: The rendered row of the requested item.
     """
-    item = await fetch_item(item_id)
-    response = templates.TemplateResponse("view_item_row.html", {"request": request,
-                                                            "item_schema": item_schema,
-                                                             "item": item})
+    etag = await unchanged_item(request, storage, item_id)
+    if etag:
+        response = not_modified(etag)
+    else:
+        item = await storage.fetch_item(item_id)
+        response = HTMLResponse(fragment_cache.render("view_item_row.html", item))
+        tag_response(response, item_etag(item) if item else None)
     await set_user(response, user_id)
     return response
 
 
 @router.post("/search")
-async def search_name(request: Request, search: str = Form(None), user_id: str = Depends(get_user)):
+async def search_name(request: Request, search: str = Form(None), user_id: str = Depends(get_user),
+                      storage: Storage = Depends(get_storage)):
     """
     Perform a search operation on inventory items and render the results using the 'inventory.html' template.
 
@@ -101,22 +262,30 @@ async def search_name(request: Request, search: str = Form(None), user_id: str =
         search (str, optional): The search query string. Defaults to None.
 
     Returns:
-        TemplateResponse: A template response with the search results.
+        TemplateResponse: A template response with the search results, or an empty 204 response
+        if a newer search from the same user replaced this one before it finished.
     """
-    if search:
-        items = await search_items(search, 1, ITEMS_PER_PAGE, user_id)
-    else: items = await fetch_inventory_page(1, ITEMS_PER_PAGE, user_id)
-    response = templates.TemplateResponse("inventory.html", {"request": request,
-                                                         "item_schema": item_schema,
+    version = await storage.list_version(user_id)
+    try:
+        items = await searches.run(user_id, read_page(storage, user_id, search, version=version))
+    except Superseded:
+        # the user typed on; htmx swaps nothing for a 204, the newer search fills the table
+        response = Response(status_code=204)
+        await set_user(response, user_id)
+        return response
+    next_after = next_cursor(items, ITEMS_PER_PAGE)
+    prefetch(storage, user_id, search or "", next_after, version)
+    response = page_response(request, "inventory.html", {"item_schema": item_schema,
                                                          "items": items,
-                                                         "current_page": 1,
+                                                         "next_after": next_after,
                                                          "search": search})
     await set_user(response, user_id)
     return response
 
 
 @router.get("/edit-item/{item_id}")
-async def edit_item_form(request: Request, item_id: str, user_id: str = Depends(get_user)):
+async def edit_item_form(request: Request, item_id: str, user_id: str = Depends(get_user),
+                         storage: Storage = Depends(get_storage)):
     """
     Fetch a single item by its ID for editing and render it using the 'edit_item_row.html' template.
 
@@ -125,12 +294,15 @@ async def edit_item_form(request: Request, item_id: str, user_id: str = Depends(
         item_id (str): The unique identifier of the item to edit.
 
     Returns:
-        TemplateResponse: A template response with the details of the item to be edited.
+        HTMLResponse: The rendered edit row of the item.
     """
-    item = await fetch_item(item_id)
-    response = templates.TemplateResponse("edit_item_row.html", {"request": request,
-                                                             "input_types": Input_Types,
-                                                             "item": item})
+    etag = await unchanged_item(request, storage, item_id)
+    if etag:
+        response = not_modified(etag)
+    else:
+        item = await storage.fetch_item(item_id)
+        response = HTMLResponse(fragment_cache.render("edit_item_row.html", item))
+        tag_response(response, item_etag(item) if item else None)
     await set_user(response, user_id)
     return response
 
@@ -141,7 +313,8 @@ async def create_item(name_in: str = Form(...),
                       drawing_in: str = Form(...), 
                       quantity_in: int = Form(...), 
                       status_in: str = Form(...),
-                      user_id: str = Depends(get_user)):
+                      user_id: str = Depends(get_user),
+                      storage: Storage = Depends(get_storage)):
     """
     Create a new item in the inventory.
 
@@ -163,24 +336,24 @@ async def create_item(name_in: str = Form(...),
                 user_id=user_id,
                 update_date=datetime.now(),
                 )
-    await add_item(new_item)
+    await storage.add_item(new_item)
     response = RedirectResponse(url="/", status_code=303)
     await set_user(response, user_id)
     return response
 
 
 @router.put("/update-item/{item_id}")
-async def update_item_edit(request: Request, item_id: str, 
+async def update_item_edit(item_id: str,
                            description_in: str = Form(...), 
                            drawing_in: str = Form(...), 
                            quantity_in: int = Form(...), 
                            status_in: str = Form(...),
-                           user_id: str = Depends(get_user)):
+                           user_id: str = Depends(get_user),
+                           storage: Storage = Depends(get_storage)):
     """
     Update an existing item in the inventory.
 
     Args:
-        request (Request): The HTTP request object.
         item_id (str): The unique identifier of the item to be updated.
         description_in (str): The new description of the item.
         drawing_in (str): The new drawing reference for the item.
@@ -188,7 +361,10 @@ async def update_item_edit(request: Request, item_id: str,
         status_in (str): The new status of the item.
 
     Returns:
-        TemplateResponse: A template response with updated details of the item.
+        HTMLResponse: The rendered row of the updated item.
+
+    Raises:
+        HTTPException: 404 error if the user has no item with this ID.
     """
     up_item = UpdateItem(description=description_in,
                          drawing=drawing_in,
@@ -197,17 +373,18 @@ async def update_item_edit(request: Request, item_id: str,
                          user_id=user_id,
                          update_date=datetime.now(),
                          )
-    await update_item(item_id, up_item)
-    item = await fetch_item(item_id)
-    response = templates.TemplateResponse("view_item_row.html", {"request": request, 
-                                                             "item_schema": item_schema,
-                                                             "item": item})
+    item = await storage.update_item(item_id, up_item, user_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="item not found")
+    response = HTMLResponse(fragment_cache.render("view_item_row.html", item))
+    tag_response(response, item_etag(item))
     await set_user(response, user_id)
     return response
 
 
 @router.delete("/delete-item/{item_id}")
-async def delete_item_edit(item_id: str, user_id: str = Depends(get_user)):
+async def delete_item_edit(item_id: str, user_id: str = Depends(get_user),
+                           storage: Storage = Depends(get_storage)):
     """
     Delete an item from the inventory.
 
@@ -217,7 +394,62 @@ async def delete_item_edit(item_id: str, user_id: str = Depends(get_user)):
     Returns:
         Response: An empty response indicating successful deletion.
     """
-    await delete_item(item_id)
+    await storage.delete_item(item_id)
     response = Response()
     await set_user(response, user_id)
     return response
+
+
+@router.get("/summary")
+async def get_summary(request: Request, user_id: str = Depends(get_user), storage: Storage = Depends(get_storage)):
+    """
+    Render the user's item count and total quantity per status using the 'summary.html' template.
+
+    Returns:
+        TemplateResponse: The summary bar, empty when the storage does not keep summaries.
+    """
+    summary = await storage.get_summary(user_id)
+    response = templates.TemplateResponse("summary.html", {"request": request, "summary": summary})
+    await set_user(response, user_id)
+    return response
+
+
+@router.get("/live")
+async def live_rows(user_id: str = Depends(get_user)):
+    """
+    Stream changes to the user's items as Server-Sent Events for htmx's SSE extension.
+
+    A changed item is sent as its rendered 'view_item_row.html' row in an `item-<id>` event, which
+    the row with that id swaps itself for; a deleted item as an empty `item-<id>` event. New items
+    also come as an `item-added` event, which the end of a fully loaded, unfiltered table appends.
+    A `resync` event asks the page to reload the table, after the stream fell too far behind.
+
+    Returns:
+        StreamingResponse: The `text/event-stream`, open until the client goes away.
+    """
+    async def events():
+        queue = live.subscribe(user_id)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    kind, item = await asyncio.wait_for(queue.get(), LIVE_KEEPALIVE)
+                except TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if kind == "resync":
+                    yield sse_event("resync")
+                elif kind == "delete":
+                    yield sse_event(f"item-{item['_id']}")
+                else:
+                    row = str(fragment_cache.render("view_item_row.html", item))
+                    yield sse_event(f"item-{item['_id']}", row)
+                    if kind == "insert":
+                        yield sse_event("item-added", row)
+        finally:
+            live.unsubscribe(user_id, queue)
+
+    response = StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    await set_user(response, user_id)
+    return response
@@ -1,6 +1,36 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from bson import ObjectId
+from pydantic import TypeAdapter
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.testclient import TestClient
+from jinja2 import DictLoader, Environment
+import database
+from database import TOMBSTONE_DAYS, MemoryStorage, get_storage, query_cache
 from main import app
+from models import BulkOperation, Item, UpdateItem
+from routers import api
+from routers.webapp import bytecode_cache
+from utils.cache import MISSING, QueryCache, cached
+from utils.coalesce import Coalescer
+from utils.compression import CompressionMiddleware
+from utils.inflight import SingleFlight, Superseded, Supersede
+from utils.live import LiveHub
+from utils.pagination import ChangeKey, encode_change_cursor
+from utils.prefetch import PageBuffer
+from utils.retention import Retention
+from utils.streaming import stream_template
+from utils.summary import NO_STATUS, summary_changes
+from utils.trigram import TrigramIndexes
 
+storage = MemoryStorage()
+app.dependency_overrides[get_storage] = lambda: storage
 client = TestClient(app)
 
 
@@ -30,3 +60,728 @@ def test_create_multiple_items_failure():
     invalid_items_data = [{"name": "item1"}, {"name": "item2"}]
     response = client.post("/api/insert/", json=invalid_items_data)
     assert response.status_code == 400
+
+def test_memory_storage_pages():
+    items_data = [{"name": f"bolt {i}", "description": "test item", "drawing": "b.dwg", "quantity": i, "status": "Active"}
+                  for i in range(5)]
+    client.post("/api/insert/?user_id=pager", json=items_data)
+    first = client.get("/api/items?user_id=pager&limit=3")
+    assert [item["quantity"] for item in first.json()] == [0, 1, 2]
+    after = first.headers["X-Next-After"]
+    second = client.get(f"/api/items?user_id=pager&limit=3&after={after}")
+    assert [item["quantity"] for item in second.json()] == [3, 4]
+    assert "X-Next-After" not in second.headers
+
+def test_import_reports_invalid_utf8_rows():
+    body = ("name,description,drawing,quantity,status\n"
+            "washer,ok,w.dwg,1,Active\n").encode() + b"caf\xe9,latin-1,c.dwg,2,Active\n"
+    response = client.post("/api/import?user_id=importer&format=csv", content=body)
+    assert response.status_code == 200
+    rows = response.json()["rows"]
+    assert "id" in rows[0]
+    assert rows[1]["row"] == 2 and "UTF-8" in rows[1]["error"]
+
+
+def stored_items(user_id, count, **fields):
+    return [{"name": f"item {i}", "description": "test item", "drawing": "i.dwg", "quantity": i,
+             "status": "Active", "user_id": user_id, "update_date": datetime.now(), **fields} for i in range(count)]
+
+
+def test_retention_deletes_in_chunks_past_items_edited_mid_chunk():
+    async def run():
+        store = MemoryStorage()
+        docs = stored_items("retention", 10, update_date=datetime.now() - timedelta(days=30))
+        await store.collection.insert_many(docs)
+        find_one_and_delete = store.collection.find_one_and_delete
+
+        async def edit_then_delete(filter, **kwargs):
+            # an edit lands between the first chunk's read and its deletes
+            if not job.batches:
+                await store.collection.update_one({"_id": docs[1]["_id"]}, {"$set": {"update_date": datetime.now()}})
+            return await find_one_and_delete(filter, **kwargs)
+
+        store.collection.find_one_and_delete = edit_then_delete
+        retention = Retention("batched", timedelta(days=14), 4, 1000)
+        job = await retention.start(store)
+        assert job.status == "pending"
+        await retention._task
+        remaining = await store.collection.find({}).to_list(None)
+        return job, remaining
+
+    job, remaining = asyncio.run(run())
+    assert (job.status, job.deleted, job.batches) == ("done", 9, 3)
+    assert [doc["name"] for doc in remaining] == ["item 1"]
+
+
+def test_lifespan_and_health_use_the_overridden_storage():
+    with TestClient(app) as lifespan_client:
+        response = lifespan_client.get("/health")
+    assert response.status_code == 200
+    assert response.json()["backend"] == "MemoryStorage"
+
+
+def test_bytecode_cache_refuses_a_directory_others_can_write(tmp_path):
+    private = bytecode_cache(str(tmp_path / "private"))
+    assert private.directory == str(tmp_path / "private")
+    assert os.stat(private.directory).st_mode & 0o777 == 0o700
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    assert bytecode_cache(str(shared)) is None
+
+
+def test_summary_counts_empty_and_missing_statuses_under_a_valid_field():
+    changes = summary_changes("insert", [{"user_id": "u", "status": "", "quantity": 2},
+                                         {"user_id": "u", "quantity": 3},
+                                         {"user_id": "u", "status": "None", "quantity": 4}])
+    # MongoDB rejects empty field names, so no path may have an empty segment
+    assert all("" not in field.split(".") for field in changes["u"])
+    assert changes["u"][f"summary.{NO_STATUS}.count"] == 2
+
+    async def run():
+        store = MemoryStorage()
+        await store.insert_multiple_items([Item(**{**doc, "status": status})
+                                           for doc, status in zip(stored_items("blank", 3), ["", "", "None"])])
+        counted = await store.get_summary("blank")
+        await store.rebuild_summary("blank")
+        return counted, await store.get_summary("blank")
+
+    counted, rebuilt = asyncio.run(run())
+    assert counted == rebuilt
+    assert counted["statuses"] == {"": {"count": 2, "quantity": 1}, "None": {"count": 1, "quantity": 2}}
+
+
+def test_updated_item_matches_the_stored_millisecond_date():
+    async def run():
+        store = MemoryStorage()
+        docs = stored_items("editor", 1)
+        await store.collection.insert_many(docs)
+        update = UpdateItem(description="changed", drawing="d.dwg", quantity=9, status="Active", user_id="editor",
+                            update_date=datetime(2024, 5, 1, 12, 0, 0, 123456))
+        return await store.update_item(str(docs[0]["_id"]), update, "editor")
+
+    item = asyncio.run(run())
+    assert item["update_date"] == datetime(2024, 5, 1, 12, 0, 0, 123000)
+
+
+def test_delta_sync_during_a_long_import_returns_rows_inserted_after_it(monkeypatch):
+    monkeypatch.setattr(api, "SYNC_SETTLE_SECONDS", 0.05)
+
+    async def run():
+        resume = asyncio.Event()
+
+        async def upload():
+            yield b'{"name": "early", "description": "d", "drawing": "e.dwg", "quantity": 1, "status": "Active"}\n'
+            await resume.wait()
+            yield b'{"name": "late", "description": "d", "drawing": "l.dwg", "quantity": 2, "status": "Active"}\n'
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            importing = asyncio.create_task(http.post("/api/import?user_id=syncer&batch_size=1", content=upload()))
+            await asyncio.sleep(0.3)
+            first = (await http.get("/api/changes?user_id=syncer")).json()
+            resume.set()
+            assert (await importing).json()["inserted"] == 2
+            await asyncio.sleep(0.1)
+            second = (await http.get(f"/api/changes?user_id=syncer&since={first['cursor']}")).json()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert [item["name"] for item in first["items"]] == ["early"]
+    assert [item["name"] for item in second["items"]] == ["late"]
+
+
+def test_bulk_writes_are_sent_and_stamped_chunk_by_chunk(monkeypatch):
+    monkeypatch.setattr(database, "SYNC_STAMP_BATCH_SIZE", 2)
+
+    async def run():
+        store = MemoryStorage()
+        ids = [str(item_id) for item_id in
+               await store.insert_multiple_items([Item(**doc) for doc in stored_items("chunked", 3)])]
+        bulk_write = store.collection.bulk_write
+        sent = []
+
+        async def slow_write(requests, **kwargs):
+            sent.append(len(requests))
+            await asyncio.sleep(0.01)
+            return await bulk_write(requests, **kwargs)
+
+        store.collection.bulk_write = slow_write
+        await store.bulk_write_items("chunked", [TypeAdapter(BulkOperation).validate_python(
+            {"op": "inc", "id": item_id, "quantity": 1}) for item_id in ids])
+        docs = await store.collection.find({"user_id": "chunked"}).to_list(None)
+        return sent, [doc["update_date"] for doc in docs]
+
+    sent, stamps = asyncio.run(run())
+    assert sent == [2, 1]
+    assert stamps[0] == stamps[1] < stamps[2]
+
+
+def test_trigram_index_follows_inserts_updates_and_deletes():
+    docs = stored_items("tri", 3)
+    for doc in docs:
+        doc["_id"] = ObjectId()
+
+    async def loader(user_id):
+        for doc in docs:
+            yield doc
+
+    async def run():
+        indexes = TrigramIndexes(10 ** 6)
+        index = await indexes.get("tri", loader)
+        assert index.search("ITEM", 10) == [doc["_id"] for doc in docs]
+        added = {**stored_items("tri", 1, name="hex nut")[0], "_id": ObjectId()}
+        indexes.on_write("insert", [added])
+        assert index.search("hex", 10) == [added["_id"]]
+        indexes.on_write("update", [{**docs[0], "name": "lock washer"}])
+        assert index.search("washer", 10) == [docs[0]["_id"]]
+        assert docs[0]["_id"] not in index.search("item 0", 10)
+        indexes.on_write("delete", [{"_id": docs[1]["_id"], "user_id": "tri"}])
+        assert index.search("item 1", 10) == []
+        # paging continues after the given id
+        assert index.search("test", 10, after=docs[0]["_id"]) == [docs[2]["_id"], added["_id"]]
+
+    asyncio.run(run())
+
+
+def test_trigram_indexes_evict_least_recently_used_and_reload_after_racing_writes():
+    loads = []
+
+    def loader_for(count):
+        async def loader(user_id):
+            loads.append(user_id)
+            for doc in stored_items(user_id, count):
+                yield {**doc, "_id": ObjectId()}
+                if user_id == "racing" and loads.count("racing") == 1:
+                    # a write landing while the index streams in makes the load start over
+                    indexes.on_write("insert", [{**doc, "_id": ObjectId()}])
+        return loader
+
+    indexes = TrigramIndexes(10 ** 6)
+
+    async def run():
+        await indexes.get("first", loader_for(50))
+        indexes.max_bytes = indexes.size + 1
+        await indexes.get("second", loader_for(50))
+        assert list(indexes.tenants) == ["second"]
+        indexes.max_bytes = 10 ** 7
+        await indexes.get("racing", loader_for(2))
+
+    asyncio.run(run())
+    assert loads.count("racing") == 2
+
+
+def test_trigram_indexes_reload_after_their_ttl_and_skip_oversized_users(monkeypatch):
+    docs = stored_items("aging", 2)
+    loads = []
+
+    async def loader(user_id):
+        loads.append(user_id)
+        for doc in docs:
+            yield {**doc, "_id": doc.setdefault("_id", ObjectId())}
+
+    async def run():
+        indexes = TrigramIndexes(10 ** 6, ttl=0.05)
+        assert (await indexes.get("aging", loader)).search("hex", 10) == []
+        # written by another worker, whose hooks this index never hears from
+        docs.append({**stored_items("aging", 1, name="hex nut")[0], "_id": ObjectId()})
+        await indexes.get("aging", loader)
+        await asyncio.sleep(0.06)
+        assert (await indexes.get("aging", loader)).search("hex", 10) == [docs[-1]["_id"]]
+
+        indexes.max_bytes = 100
+        indexes.tenants.clear()
+        assert await indexes.get("aging", loader) is None
+        assert await indexes.get("aging", loader) is None
+
+    asyncio.run(run())
+    assert loads == ["aging"] * 3
+
+    # a user too large to index is searched with the regex search
+    monkeypatch.setattr(database, "SEARCH_MODE", "trigram")
+    monkeypatch.setattr(database, "trigram_indexes", TrigramIndexes(100, ttl=60))
+
+    async def search():
+        store = MemoryStorage()
+        await store.insert_multiple_items([Item(**doc) for doc in stored_items("large", 3)])
+        return await store.search_items("item 1", 10, "large")
+
+    assert [item["name"] for item in asyncio.run(search())] == ["item 1"]
+    assert "large" in database.trigram_indexes.oversized
+
+
+def test_query_cache_invalidates_by_tag_and_skips_reads_that_raced_a_write():
+    cache = QueryCache(60, 100, 10 ** 6)
+    calls = []
+    release = asyncio.Event()
+
+    @cached(cache, lambda args, result: [f"user:{args['user_id']}"])
+    async def read(user_id, slow=False):
+        calls.append(user_id)
+        if slow:
+            await release.wait()
+        return [{"user_id": user_id, "n": len(calls)}]
+
+    async def run():
+        assert await read("a") == await read("a")
+        assert calls == ["a"]
+        cache.invalidate("user:a")
+        await read("a")
+        assert calls == ["a", "a"]
+        # a read started before a write must not cache what it read
+        racing = asyncio.create_task(read("b", slow=True))
+        await asyncio.sleep(0)
+        cache.invalidate("user:b")
+        release.set()
+        await racing
+        await read("b", slow=True)
+        assert calls.count("b") == 2
+        await read("b", slow=True)
+        assert calls.count("b") == 2
+
+    asyncio.run(run())
+    assert cache.invalidations == 1 and cache.hits == 2
+
+
+def test_storage_writes_invalidate_cached_pages(monkeypatch):
+    monkeypatch.setattr(query_cache, "ttl", 60)
+
+    async def run():
+        store = MemoryStorage()
+        await store.insert_multiple_items([Item(**doc) for doc in stored_items("cached", 2)])
+        first = await store.fetch_inventory_page(10, "cached")
+        assert await store.fetch_inventory_page(10, "cached") is first
+        await store.add_item(Item(**stored_items("cached", 1, name="added")[0]))
+        return await store.fetch_inventory_page(10, "cached")
+
+    assert [item["name"] for item in asyncio.run(run())] == ["item 0", "item 1", "added"]
+    query_cache.clear()
+
+
+def test_pages_and_items_answer_matching_etags_with_304():
+    client.post("/api/insert/?user_id=tagged", json=[{"name": "tag 0", "description": "test item",
+                                                      "drawing": "t.dwg", "quantity": 1, "status": "Active"}])
+    page = client.get("/api/items?user_id=tagged&limit=10")
+    etag = page.headers["ETag"]
+    assert client.get("/api/items?user_id=tagged&limit=10", headers={"If-None-Match": etag}).status_code == 304
+    item_id = str(asyncio.run(storage.collection.find_one({"user_id": "tagged"}))["_id"])
+    item = client.get(f"/api/item/{item_id}")
+    assert client.get(f"/api/item/{item_id}", headers={"If-None-Match": item.headers["ETag"]}).status_code == 304
+
+    client.put(f"/api/item/{item_id}?user_id=tagged", json={"description": "changed", "drawing": "t.dwg",
+                                                             "quantity": 2, "status": "Active"})
+    changed = client.get("/api/items?user_id=tagged&limit=10", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert client.get(f"/api/item/{item_id}", headers={"If-None-Match": item.headers["ETag"]}).status_code == 200
+
+
+def test_cached_pages_are_not_sent_under_a_newer_etag(monkeypatch):
+    monkeypatch.setattr(query_cache, "ttl", 60)
+    client.post("/api/insert/?user_id=elsewhere", json=[{"name": "old name", "description": "test item",
+                                                         "drawing": "e.dwg", "quantity": 1, "status": "Active"}])
+    first = client.get("/api/items?user_id=elsewhere&limit=10")
+
+    async def write_from_another_worker():
+        # a write this worker's hooks never see: only the item and the version change
+        await storage.collection.update_one({"user_id": "elsewhere"}, {"$set": {"name": "new name"}})
+        await storage.tenants.update_one({"_id": "elsewhere"}, {"$inc": {"version": 1}})
+
+    asyncio.run(write_from_another_worker())
+    second = client.get("/api/items?user_id=elsewhere&limit=10", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200 and second.headers["ETag"] != first.headers["ETag"]
+    assert [item["name"] for item in second.json()] == ["new name"]
+    query_cache.clear()
+
+
+def test_bulk_increments_add_up_and_errors_stay_per_operation():
+    items_data = [{"name": f"bin {i}", "description": "test item", "drawing": "b.dwg", "quantity": 10 * i,
+                   "status": "Active"} for i in range(3)]
+    client.post("/api/insert/?user_id=bulker", json=items_data)
+    client.post("/api/insert/?user_id=other-bulker", json=items_data[:1])
+    ids = [str(doc["_id"]) for doc in asyncio.run(storage.collection.find({"user_id": "bulker"}).to_list(None))]
+    foreign = str(asyncio.run(storage.collection.find_one({"user_id": "other-bulker"}))["_id"])
+    operations = [{"op": "inc", "id": ids[0], "quantity": 5},
+                  {"op": "inc", "id": ids[0], "quantity": -2},
+                  {"op": "set", "id": ids[1], "fields": {"status": "Inactive"}},
+                  {"op": "delete", "id": ids[2]},
+                  {"op": "inc", "id": "not-an-id", "quantity": 1},
+                  {"op": "delete", "id": foreign}]
+    response = client.post("/api/bulk?user_id=bulker", json=operations)
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["applied"], body["failed"]) == (4, 2)
+    assert [result.get("error") for result in body["results"]] == [None, None, None, None, "invalid item id",
+                                                                    "item not found"]
+    docs = {str(doc["_id"]): doc for doc in asyncio.run(storage.collection.find({"user_id": "bulker"}).to_list(None))}
+    assert docs[ids[0]]["quantity"] == 3
+    assert docs[ids[1]]["status"] == "Inactive" and docs[ids[1]]["name"] == "bin 1"
+    assert ids[2] not in docs
+    assert asyncio.run(storage.collection.find_one({"user_id": "other-bulker"})) is not None
+
+
+def test_bulk_reports_items_deleted_by_someone_else_and_counts_them_once():
+    async def run():
+        store = MemoryStorage()
+        ids = [str(item_id) for item_id in
+               await store.insert_multiple_items([Item(**doc) for doc in stored_items("vanishing", 3)])]
+        bulk_write = store.collection.bulk_write
+
+        async def delete_then_write(requests, **kwargs):
+            # another request deletes items 0 and 1 after the ownership read
+            await store.delete_item(ids[0])
+            await store.delete_item(ids[1])
+            return await bulk_write(requests, **kwargs)
+
+        store.collection.bulk_write = delete_then_write
+        errors = await store.bulk_write_items("vanishing", [
+            TypeAdapter(BulkOperation).validate_python(operation) for operation in [
+                {"op": "set", "id": ids[0], "fields": {"status": "Ordered"}},
+                {"op": "delete", "id": ids[1]},
+                {"op": "inc", "id": ids[2], "quantity": 5},
+            ]])
+        return errors, await store.get_summary("vanishing")
+
+    errors, summary = asyncio.run(run())
+    assert errors == ["item not found", "item not found", None]
+    # only item 2 is left, with 2 + 5
+    assert summary == {"count": 1, "quantity": 7, "statuses": {"Active": {"count": 1, "quantity": 7}}}
+
+
+def test_retention_reports_one_job_at_a_time_and_its_failure():
+    class FailingStorage(MemoryStorage):
+        async def delete_expired_batch(self, age, after, batch_size):
+            await asyncio.sleep(0.01)
+            raise ValueError("bad document")
+
+    async def run():
+        store = FailingStorage()
+        retention = Retention("batched", timedelta(days=14), 10, 1000)
+        job = await retention.start(store)
+        assert await retention.start(store) is job
+        await retention._task
+        # the lease is released, so the next job can start
+        assert await retention.start(store) is not None
+        await retention._task
+        return job, retention, await store.find_job(job.id)
+
+    job, retention, saved = asyncio.run(run())
+    report = job.report()
+    assert (report["status"], report["error"], report["deleted"]) == ("failed", "bad document", 0)
+    assert report["finished"] is not None
+    assert saved == report
+    assert len(retention.jobs) == 2
+
+
+def test_retention_runs_in_one_worker_and_reports_to_all():
+    async def run():
+        await storage.collection.insert_many(stored_items("cleaned", 5, update_date=datetime.now() - timedelta(days=30)))
+        # another worker's instance, sharing the database
+        other = Retention("batched", timedelta(days=14), 2, 1000)
+        job = await other.start(storage)
+        assert await api.retention.start(storage) is None
+        running = await api.retention.running(storage)
+        await other._task
+        return job, running
+
+    job, running = asyncio.run(run())
+    assert running["job_id"] == job.id
+    response = client.get(f"/api/cleanup/{job.id}")
+    assert response.status_code == 200
+    assert (response.json()["status"], response.json()["deleted"]) == ("done", 5)
+    assert client.get("/api/cleanup/unknown").status_code == 404
+
+
+def test_concurrent_cleanups_only_count_what_they_deleted():
+    async def run():
+        store = MemoryStorage()
+        await store.insert_multiple_items([Item(**doc) for doc in stored_items("raced", 6)])
+        await store.collection.update_many({}, {"$set": {"update_date": datetime.now() - timedelta(days=30)}})
+        age = datetime.now() - timedelta(days=14)
+        results = await asyncio.gather(store.delete_expired_batch(age, None, 10),
+                                       store.delete_expired_batch(age, None, 10))
+        return results, await store.get_summary("raced")
+
+    results, summary = asyncio.run(run())
+    assert sum(deleted for deleted, _ in results) == 6
+    assert summary["count"] == 0 and summary["quantity"] == 0
+
+
+def test_summary_counters_follow_every_write_and_match_a_rebuild():
+    async def run():
+        store = MemoryStorage()
+        ids = [ObjectId(item_id) for item_id in
+               await store.insert_multiple_items([Item(**doc) for doc in stored_items("counted", 4)])]
+        await store.add_item(Item(**stored_items("counted", 1, name="single", quantity=7, status="Ordered")[0]))
+        await store.update_item(str(ids[0]), UpdateItem(description="d", drawing="d", quantity=20, status="Ordered",
+                                                        user_id="counted"), "counted")
+        await store.delete_item(str(ids[1]))
+        await store.bulk_write_items("counted", [TypeAdapter(BulkOperation).validate_python(operation) for operation in [
+            {"op": "inc", "id": str(ids[2]), "quantity": 5},
+            {"op": "set", "id": str(ids[3]), "fields": {"status": "Ordered"}},
+        ]])
+        counted = await store.get_summary("counted")
+        await store.tenants.update_one({"_id": "counted"}, {"$set": {"summary": {}}})
+        await store.rebuild_summary()
+        return counted, await store.get_summary("counted")
+
+    counted, rebuilt = asyncio.run(run())
+    # item 2 (2 + 5) stays Active; item 0 (now 20), item 3 (3) and "single" (7) are Ordered
+    assert counted == {"count": 4, "quantity": 37,
+                       "statuses": {"Active": {"count": 1, "quantity": 7}, "Ordered": {"count": 3, "quantity": 30}}}
+    assert rebuilt == counted
+
+
+def test_ttl_cleanups_recount_summaries_once_a_day_after_the_quiet_hour():
+    async def run():
+        store = MemoryStorage()
+        await store.insert_multiple_items([Item(**doc) for doc in stored_items("expiring", 3)])
+        retention = Retention("ttl", timedelta(days=14), 10, 1000, rebuild_hour=3)
+        summaries = []
+        for _ in range(2):
+            # as if the TTL monitor had deleted an item behind the counters' back
+            await store.tenants.update_one({"_id": "expiring"}, {"$inc": {"summary.Active.count": 1}})
+            await retention.start(store)
+            await retention._task
+            summaries.append((await store.get_summary("expiring"))["count"])
+        return summaries
+
+    # only the first run rebuilds; the second one finds today's rebuild on the lease
+    assert asyncio.run(run()) == [3, 4]
+    retention = Retention("ttl", timedelta(days=14), 10, 1000, rebuild_hour=3)
+    now = datetime(2026, 10, 18, 10)
+    assert retention.rebuild_due(datetime(2026, 10, 17, 23), now)
+    assert not retention.rebuild_due(datetime(2026, 10, 18, 3, 30), now)
+    assert not retention.rebuild_due(datetime(2026, 10, 18, 4), datetime(2026, 10, 19, 2))
+
+
+def test_single_flight_shares_a_read_until_every_caller_gives_up():
+    group = SingleFlight()
+    started, cancelled = [], []
+    release = asyncio.Event()
+
+    async def read():
+        started.append(1)
+        try:
+            await release.wait()
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return "page"
+
+    async def run():
+        first = asyncio.create_task(group.run(("page",), read))
+        second = asyncio.create_task(group.run(("page",), read))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await second == "page"
+        assert first.cancelled() and not cancelled
+        release.clear()
+        alone = asyncio.create_task(group.run(("page",), read))
+        await asyncio.sleep(0)
+        alone.cancel()
+        await asyncio.gather(alone, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert (len(started), len(cancelled)) == (2, 1)
+    assert (group.leaders, group.followers) == (2, 1)
+
+
+def test_supersede_cancels_the_older_search_but_not_a_cancelled_caller():
+    searches = Supersede()
+
+    async def search(term):
+        await asyncio.sleep(0.05)
+        return term
+
+    async def run():
+        older = asyncio.create_task(searches.run("user", search("bo")))
+        await asyncio.sleep(0)
+        newer = asyncio.create_task(searches.run("user", search("bolt")))
+        assert await newer == "bolt"
+        with pytest.raises(Superseded):
+            await older
+        caller = asyncio.create_task(searches.run("user", search("nut")))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        assert caller.cancelled()
+        assert not searches.running
+
+    asyncio.run(run())
+    assert searches.superseded == 1
+
+
+def test_delta_sync_pages_changes_reports_deletes_and_expires_old_cursors(monkeypatch):
+    monkeypatch.setattr(api, "SYNC_SETTLE_SECONDS", 0)
+    items_data = [{"name": f"synced {i}", "description": "test item", "drawing": "s.dwg", "quantity": i,
+                   "status": "Active"} for i in range(3)]
+    ids = client.post("/api/insert/?user_id=delta", json=items_data).json()["item_ids"]
+    first = client.get("/api/changes?user_id=delta&limit=2").json()
+    assert [item["id"] for item in first["items"]] == ids[:2] and first["more"]
+    second = client.get(f"/api/changes?user_id=delta&since={first['cursor']}").json()
+    assert [item["id"] for item in second["items"]] == ids[2:] and not second["more"]
+    bulk = client.post("/api/bulk?user_id=delta", json=[{"op": "delete", "id": ids[0]},
+                                                        {"op": "inc", "id": ids[1], "quantity": 1}])
+    assert bulk.json()["applied"] == 2
+    third = client.get(f"/api/changes?user_id=delta&since={second['cursor']}").json()
+    assert third["deleted"] == [ids[0]]
+    assert [(item["id"], item["quantity"]) for item in third["items"]] == [(ids[1], 2)]
+    assert client.get(f"/api/changes?user_id=delta&since={third['cursor']}").json()["items"] == []
+
+    assert client.get("/api/changes?user_id=delta&since=garbage").status_code == 400
+    expired = encode_change_cursor(ChangeKey(datetime.now() - timedelta(days=TOMBSTONE_DAYS + 1), ObjectId()))
+    assert client.get(f"/api/changes?user_id=delta&since={expired}").status_code == 410
+
+
+def test_coalescer_sends_concurrent_writes_together_and_answers_each_caller():
+    batches = []
+
+    async def flush(payloads):
+        batches.append(payloads)
+        if "boom" in payloads:
+            raise PyMongoError("batch failed")
+        return [ValueError(payload) if payload.startswith("bad") else payload.upper() for payload in payloads]
+
+    async def run():
+        coalescer = Coalescer("test", flush, 0.01, 3)
+        results = await asyncio.gather(*(coalescer.submit(payload) for payload in ["a", "bad b", "c", "d"]),
+                                       return_exceptions=True)
+        failed = await asyncio.gather(coalescer.submit("boom"), coalescer.submit("e"), return_exceptions=True)
+        withdrawn = asyncio.create_task(coalescer.submit("withdrawn"))
+        await asyncio.sleep(0)
+        withdrawn.cancel()
+        assert await coalescer.submit("f") == "F"
+        return results, failed
+
+    results, failed = asyncio.run(run())
+    # the size cap sends the first three at once, the window the fourth
+    assert batches[:2] == [["a", "bad b", "c"], ["d"]]
+    assert results[0] == "A" and isinstance(results[1], ValueError) and results[2:] == ["C", "D"]
+    assert all(isinstance(result, PyMongoError) for result in failed)
+    assert batches[-1] == ["f"]
+
+
+def test_batched_storage_writes_return_their_own_results():
+    async def run():
+        store = MemoryStorage()
+        for coalescer in (store.inserts, store.updates):
+            coalescer.window = 0.005
+        ids = await asyncio.gather(*(store.add_item(Item(**doc)) for doc in stored_items("batched", 5)))
+        duplicate = {**await store.collection.find_one({"_id": ids[0]})}
+        inserted = await asyncio.gather(store.inserts.submit(duplicate),
+                                        store.add_item(Item(**stored_items("batched", 1, name="extra")[0])),
+                                        return_exceptions=True)
+        other = await store.add_item(Item(**stored_items("someone else", 1)[0]))
+
+        def update(quantity):
+            return UpdateItem(description="d", drawing="d", quantity=quantity, status="Active", user_id="batched")
+
+        updated = await asyncio.gather(store.update_item(str(ids[1]), update(100), "batched"),
+                                       store.update_item(str(ids[1]), update(200), "batched"),
+                                       store.update_item(str(other), update(1), "batched"))
+        stored = await store.collection.find_one({"_id": ids[1]})
+        counted = await store.get_summary("batched")
+        await store.rebuild_summary()
+        return ids, inserted, updated, stored, counted, await store.get_summary("batched")
+
+    ids, inserted, updated, stored, counted, rebuilt = asyncio.run(run())
+    assert len(set(ids)) == 5
+    assert isinstance(inserted[0], DuplicateKeyError) and isinstance(inserted[1], ObjectId)
+    # a second update of the same item in one batch sees the first
+    assert [item and item["quantity"] for item in updated] == [100, 200, None]
+    assert stored["quantity"] == 200
+    assert counted == rebuilt
+
+
+def test_page_buffer_serves_pages_read_ahead_until_their_owner_writes():
+    reads = []
+
+    async def read():
+        reads.append(1)
+        return ["row"]
+
+    async def run():
+        buffer = PageBuffer(60, 10)
+        buffer.schedule(("reader", "", "page-2", 1), read)
+        buffer.schedule(("reader", "", "page-2", 1), read)
+        assert await buffer.take(("reader", "", "page-2", 1)) == ["row"]
+        # scheduled twice, read once, and taken only once
+        assert len(reads) == 1
+        assert await buffer.take(("reader", "", "page-2", 1)) is MISSING
+        buffer.schedule(("reader", "", "page-3", 1), read)
+        buffer.schedule(("bystander", "", "page-3", 1), read)
+        buffer.on_write("update", [{"_id": ObjectId(), "user_id": "reader"}])
+        assert await buffer.take(("reader", "", "page-3", 1)) is MISSING
+        assert await buffer.take(("bystander", "", "page-3", 1)) == ["row"]
+        return buffer
+
+    buffer = asyncio.run(run())
+    assert (buffer.prefetched, buffer.hits, buffer.misses, buffer.wasted) == (3, 2, 2, 1)
+
+
+def test_compression_round_trips_large_and_streamed_bodies_only():
+    rows_template = "{% for i in range(200) %}<tr><td>row {{ i }}</td></tr>{% endfor %}"
+    env = Environment(loader=DictLoader({"rows.html": rows_template}))
+    compressed = FastAPI()
+    compressed.add_middleware(CompressionMiddleware, minimum_size=500)
+
+    @compressed.get("/large")
+    async def large():
+        return PlainTextResponse("inventory " * 100)
+
+    @compressed.get("/small")
+    async def small():
+        return PlainTextResponse("inventory")
+
+    @compressed.get("/rows")
+    async def rows():
+        return stream_template(env, "rows.html", {}, 1000)
+
+    @compressed.get("/events")
+    async def events():
+        return StreamingResponse(iter([b"data: one\n\n", b"data: two\n\n"]), media_type="text/event-stream")
+
+    with TestClient(compressed) as http:
+        gzip = {"Accept-Encoding": "gzip"}
+        response = http.get("/large", headers=gzip)
+        assert response.headers["content-encoding"] == "gzip" and response.text == "inventory " * 100
+        assert int(response.headers["content-length"]) < 1000
+        assert "content-encoding" not in http.get("/small", headers=gzip).headers
+        response = http.get("/rows", headers=gzip)
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.text == env.get_template("rows.html").render()
+        response = http.get("/events", headers=gzip)
+        assert "content-encoding" not in response.headers and response.text == "data: one\n\ndata: two\n\n"
+        assert "content-encoding" not in http.get("/large", headers={"Accept-Encoding": "identity"}).headers
+
+    async def chunks():
+        return [chunk async for chunk in stream_template(env, "rows.html", {}, 1000).body_iterator]
+
+    streamed = asyncio.run(chunks())
+    assert len(streamed) > 1 and all(len(chunk) >= 1000 for chunk in streamed[:-1])
+
+
+def test_live_hub_fans_changes_out_and_resyncs_subscribers_that_fall_behind():
+    async def run():
+        hub = LiveHub(2)
+        first, second = hub.subscribe("watcher"), hub.subscribe("watcher")
+        other = hub.subscribe("someone else")
+        hub.on_write("insert", [{"_id": 1, "user_id": "watcher"}])
+        assert first.get_nowait() == second.get_nowait() == ("insert", {"_id": 1, "user_id": "watcher"})
+        assert other.empty()
+        # `first` keeps up; `second` is not read and overflows
+        for item_id in range(2, 5):
+            hub.publish("watcher", "update", {"_id": item_id})
+            if item_id < 4:
+                assert first.get_nowait() == ("update", {"_id": item_id})
+        assert [second.get_nowait() for _ in range(second.qsize())] == [("resync", None)]
+        assert first.get_nowait() == ("update", {"_id": 4})
+        hub.unsubscribe("watcher", first)
+        hub.unsubscribe("watcher", second)
+        return hub
+
+    hub = asyncio.run(run())
+    assert (hub.count, hub.published, hub.resyncs) == (1, 8, 1)
+
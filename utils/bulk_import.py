@@ -0,0 +1,90 @@
+import csv
+import json
+from collections.abc import AsyncIterator
+
+
+INVALID_UTF8 = "not valid UTF-8; re-export the file as UTF-8"
+
+
+def _decode(line: bytes) -> tuple[str, bool]:
+    try:
+        return line.rstrip(b"\r").decode("utf-8"), True
+    except UnicodeDecodeError:
+        return line.rstrip(b"\r").decode("utf-8", errors="replace"), False
+
+
+async def text_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[str, bool]]:
+    """
+    Split a stream of UTF-8 byte chunks into lines, without the line endings.
+
+    Yields:
+        tuple: The line, and whether it was valid UTF-8. Invalid bytes (say, from a Latin-1
+        export) are replaced with U+FFFD rather than failing the whole upload.
+    """
+    # a newline byte never occurs inside a multi-byte UTF-8 sequence, so lines split before decoding
+    pending = b""
+    async for chunk in chunks:
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            yield _decode(line)
+    if pending:
+        yield _decode(pending)
+
+
+async def ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, dict | str]]:
+    """
+    Parse an NDJSON upload incrementally.
+
+    Yields:
+        tuple: The 1-based row number and either the decoded object or an error message.
+    """
+    row = 0
+    async for line, valid in text_lines(chunks):
+        if not line.strip():
+            continue
+        row += 1
+        if not valid:
+            yield row, INVALID_UTF8
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as err:
+            yield row, f"invalid JSON: {err}"
+            continue
+        yield row, record if isinstance(record, dict) else "expected a JSON object"
+
+
+async def csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, dict | str]]:
+    """
+    Parse a CSV upload with a header row incrementally. Quoted fields may span lines.
+
+    Yields:
+        tuple: The 1-based row number and either the row as a dict or an error message.
+    """
+    header = None
+    record = ""
+    record_valid = True
+    row = 0
+    async for line, valid in text_lines(chunks):
+        record = f"{record}\n{line}" if record else line
+        record_valid = record_valid and valid
+        # an odd number of quotes means a quoted field continues on the next line
+        if record.count('"') % 2:
+            continue
+        values, record = next(csv.reader([record]), []), ""
+        valid, record_valid = record_valid, True
+        if not values:
+            continue
+        if header is None:
+            header = values
+            continue
+        row += 1
+        if not valid:
+            yield row, INVALID_UTF8
+            continue
+        if len(values) != len(header):
+            yield row, f"expected {len(header)} columns, got {len(values)}"
+            continue
+        yield row, dict(zip(header, values))
+    if record:
+        yield row + 1, "unterminated quoted field"
@@ -0,0 +1,152 @@
+import inspect
+from collections import OrderedDict
+from collections.abc import Callable
+from functools import wraps
+from time import monotonic
+
+import bson
+
+
+MISSING = object()
+
+
+def estimate_size(value) -> int:
+    """
+    Approximate memory cost of a cached query result, using its BSON size.
+    """
+    if isinstance(value, dict):
+        return len(bson.encode(value))
+    if isinstance(value, (list, tuple)):
+        return 16 + sum(estimate_size(item) for item in value)
+    return 16
+
+
+class QueryCache:
+    """
+    LRU cache of query results with per-entry TTLs, bounded by entry count and estimated bytes.
+
+    Entries carry tags (for example the owning user) so that a write can drop every result it affects.
+    Cached values are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, tuple[float, int, object, tuple[str, ...]]] = OrderedDict()
+        self.tags: dict[str, set[tuple]] = {}
+        self.bytes = 0
+        # bumped on every invalidation, so a read that raced a write is not cached
+        self.generation = 0
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: tuple):
+        """
+        Return the cached value for `key`, or MISSING.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        if entry[0] <= monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def set(self, key: tuple, value, tags: list[str], ttl: float | None = None, generation: int | None = None):
+        """
+        Cache `value` under `key`. Skipped if the value alone exceeds the byte budget or if an
+        invalidation happened since `generation` was read.
+        """
+        if generation is not None and generation != self.generation:
+            return
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        self._drop(key)
+        self.entries[key] = (monotonic() + (ttl or self.ttl), size, value, tuple(tags))
+        self.bytes += size
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _drop(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[1]
+        for tag in entry[3]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, tag: str):
+        """
+        Drop every entry carrying `tag`.
+        """
+        self.generation += 1
+        for key in list(self.tags.get(tag, ())):
+            self._drop(key)
+            self.invalidations += 1
+
+    def clear(self):
+        self.generation += 1
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.tags.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                }
+
+
+def cached(cache: QueryCache, tags: Callable[[dict, object], list[str]], ttl: float | None = None):
+    """
+    Cache the results of an async read function, keyed on its name and arguments.
+
+    Args:
+        cache (QueryCache): The cache to store results in.
+        tags (Callable): Builds the entry's tags from the bound arguments and the result.
+        ttl (float, optional): Time to live for these entries, instead of the cache default.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not cache.enabled:
+                return await func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (func.__name__, *bound.arguments.values())
+            value = cache.get(key)
+            if value is not MISSING:
+                return value
+            generation = cache.generation
+            value = await func(*args, **kwargs)
+            cache.set(key, value, tags(bound.arguments, value), ttl, generation)
+            return value
+
+        return wrapper
+
+    return decorator
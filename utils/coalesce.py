@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from time import perf_counter
+
+from utils.metrics import WRITE_BATCH_SIZE, WRITE_BATCH_WAIT_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+
+class Coalescer:
+    """
+    Group commit for single-document writes: concurrent calls are collected for up to `window`
+    seconds, or until `max_batch` are waiting, and sent to the database together.
+
+    `flush` receives the payloads of a batch, in the order they were submitted, and returns one
+    result per payload; a result that is an exception is raised to that caller only. If `flush`
+    itself raises, every caller in the batch gets the error.
+    """
+
+    def __init__(self, name: str, flush, window: float, max_batch: int):
+        self.name = name
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        # [(payload, future, submitted)]
+        self.pending: list[tuple] = []
+        self.timer: asyncio.TimerHandle | None = None
+        # flushes still running, so their tasks are not garbage collected
+        self.flushing: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_batch > 1
+
+    async def submit(self, payload):
+        """
+        Queue one write and wait for its own result.
+
+        A caller cancelled before its batch is sent is taken out of the batch; once it is sent,
+        the write goes ahead whether or not anyone waits for it, as a single write would.
+        """
+        loop = asyncio.get_running_loop()
+        entry = (payload, loop.create_future(), perf_counter())
+        self.pending.append(entry)
+        if len(self.pending) >= self.max_batch:
+            self._send()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self._send)
+        try:
+            return await entry[1]
+        except asyncio.CancelledError:
+            if entry in self.pending:
+                self.pending.remove(entry)
+            raise
+
+    def _send(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self.flushing.add(task)
+            task.add_done_callback(self.flushing.discard)
+
+    async def _run(self, batch: list[tuple]):
+        started = perf_counter()
+        WRITE_BATCH_SIZE.observe(len(batch), kind=self.name)
+        for _, _, submitted in batch:
+            WRITE_BATCH_WAIT_SECONDS.observe(started - submitted, kind=self.name)
+        try:
+            results = await self.flush([payload for payload, _, _ in batch])
+        except Exception as err:
+            logger.warning("%s batch of %d writes failed: %s", self.name, len(batch), err)
+            results = [err] * len(batch)
+        for (_, future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def drain(self):
+        """
+        Send whatever is waiting and wait for every batch in flight. Called at shutdown.
+        """
+        self._send()
+        if self.flushing:
+            await asyncio.gather(*self.flushing, return_exceptions=True)
@@ -0,0 +1,141 @@
+import zlib
+
+from utils.metrics import RESPONSE_BYTES, RESPONSE_WIRE_BYTES
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/x-ndjson",
+                      "image/svg+xml")
+# streamed to the client event by event; compressing them would hold events back in the compressor
+UNCOMPRESSED_TYPES = ("text/event-stream",)
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    """
+    The best content coding the client accepts among those available: brotli (when the `brotli`
+    package is installed) over gzip, unless the client ranks gzip higher.
+    """
+    available = ("br", "gzip") if brotli is not None else ("gzip",)
+    ranked = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        ranked[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for name in available:
+        quality = ranked.get(name, ranked.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def _count(encoding: str, body: bytes, sent: bytes):
+    RESPONSE_BYTES.inc(len(body), encoding=encoding)
+    RESPONSE_WIRE_BYTES.inc(len(sent), encoding=encoding)
+
+
+class _Encoder:
+    """
+    Incremental compressor; `compress` output is flushed so each chunk can be decoded on arrival.
+    """
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._gzip = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._gzip.compress(data) + self._gzip.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.finish()
+        return self._gzip.flush()
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing text responses with the best coding the client accepts.
+
+    Whole bodies smaller than `minimum_size` are sent as they are. Streamed bodies are compressed
+    chunk by chunk and flushed after each, so a chunk reaches the client as soon as it is sent.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        encoding = choose_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        start = None
+        encoder = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, encoder, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                response_headers = {key.lower(): value for key, value in message.get("headers", [])}
+                media_type = response_headers.get(b"content-type", b"").decode("latin-1")
+                compressible = (media_type.startswith(COMPRESSIBLE_TYPES)
+                                and not media_type.startswith(UNCOMPRESSED_TYPES))
+                if compressible:
+                    start["headers"] = [*message.get("headers", []), (b"vary", b"Accept-Encoding")]
+                passthrough = (encoding is None or not compressible or b"content-encoding" in response_headers
+                               or message["status"] in (204, 304))
+                if passthrough:
+                    await send(start)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                if message["type"] == "http.response.body":
+                    _count("identity", message.get("body", b""), message.get("body", b""))
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start)
+                    _count("identity", body, body)
+                    await send(message)
+                    return
+                encoder = _Encoder(encoding, self.gzip_level, self.brotli_quality)
+                response_headers = [(key, value) for key, value in start["headers"]
+                                    if key.lower() != b"content-length"]
+                response_headers.append((b"content-encoding", encoding.encode()))
+                if not more_body:
+                    compressed = encoder.compress(body) + encoder.finish()
+                    response_headers.append((b"content-length", str(len(compressed)).encode()))
+                    await send({**start, "headers": response_headers})
+                    _count(encoding, body, compressed)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                await send({**start, "headers": response_headers})
+            compressed = encoder.compress(body) if body else b""
+            if not more_body:
+                compressed += encoder.finish()
+            _count(encoding, body, compressed)
+            await send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,77 @@
+from hashlib import blake2b
+
+from fastapi import Request, Response
+
+
+def item_etag(item: dict) -> str | None:
+    """
+    Weak ETag of a single item, from its `update_date`. None for items that were never stamped.
+    """
+    update_date = item.get("update_date")
+    if update_date is None:
+        return None
+    return f'W/"{item["_id"]}-{update_date.isoformat()}"'
+
+
+def list_etag(user_id: str, version: int) -> str:
+    """
+    Weak ETag of any list of a user's items, from their write version.
+
+    The user is part of the tag because the htmx pages pick the user from a cookie, not the URL.
+    """
+    owner = blake2b(str(user_id).encode(), digest_size=8).hexdigest()
+    return f'W/"{owner}-{version}"'
+
+
+def if_none_match(request: Request, etag: str | None) -> bool:
+    """
+    Whether the request's If-None-Match header matches `etag`, using the weak comparison.
+    """
+    header = request.headers.get("if-none-match")
+    if not header or etag is None:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    """
+    Empty 304 response for a matching conditional GET.
+    """
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+def tag_response(response: Response, etag: str | None) -> Response:
+    """
+    Set the ETag on a full response, asking clients to revalidate it before reuse.
+    """
+    if etag is not None:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+async def list_tag(storage, user_id: str) -> tuple[int | None, str | None]:
+    """
+    Current version and ETag of a user's lists, both None when the storage does not track list versions.
+
+    A list sent with the ETag must be read for that version (the `version` argument of the page
+    reads), so that a page cached or read ahead before a write, perhaps one by another worker, is
+    never sent under the newer tag.
+    """
+    version = await storage.list_version(user_id)
+    return version, None if version is None else list_etag(user_id, version)
+
+
+async def unchanged_item(request: Request, storage, item_id: str) -> str | None:
+    """
+    The item's ETag if the client's copy of it is current, else None.
+
+    Only `update_date` is fetched, and only for conditional requests, so a hit never loads the document.
+    """
+    if not request.headers.get("if-none-match"):
+        return None
+    stamp = await storage.fetch_item(item_id, ("update_date",))
+    etag = item_etag(stamp) if stamp else None
+    return etag if if_none_match(request, etag) else None
@@ -0,0 +1,90 @@
+import csv
+import json
+from collections.abc import AsyncIterator
+from datetime import datetime
+from io import StringIO
+
+from bson import ObjectId
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_default(value):
+    """
+    JSON encoder fallback for the BSON types stored on items.
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    """
+    Encode a value as compact JSON, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=json_default)
+    return json.dumps(value, default=json_default, separators=(",", ":")).encode()
+
+
+def select_fields(doc: dict, fields: list[str]) -> dict:
+    """
+    The given fields of a document, in that order, with None for any that are missing.
+    """
+    return {field: doc.get(field) for field in fields}
+
+
+async def json_array(docs: AsyncIterator[dict], fields: list[str], batch_size: int = 500) -> AsyncIterator[bytes]:
+    """
+    Encode documents as one JSON array, yielding one chunk per `batch_size` documents.
+    """
+    yield b"["
+    separator = b""
+    chunk = []
+    async for doc in docs:
+        chunk.append(dumps(select_fields(doc, fields)))
+        if len(chunk) >= batch_size:
+            yield separator + b",".join(chunk)
+            separator, chunk = b",", []
+    if chunk:
+        yield separator + b",".join(chunk)
+    yield b"]"
+
+
+async def ndjson_lines(docs: AsyncIterator[dict], batch_size: int = 500) -> AsyncIterator[bytes]:
+    """
+    Encode documents as newline-delimited JSON, yielding one chunk per `batch_size` documents.
+    """
+    chunk = []
+    async for doc in docs:
+        chunk.append(dumps(doc) + b"\n")
+        if len(chunk) >= batch_size:
+            yield b"".join(chunk)
+            chunk = []
+    if chunk:
+        yield b"".join(chunk)
+
+
+async def csv_lines(docs: AsyncIterator[dict], fields: list[str], batch_size: int = 500) -> AsyncIterator[str]:
+    """
+    Encode documents as CSV with a header row, yielding one chunk per `batch_size` documents.
+    """
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    writer.writeheader()
+    rows = 0
+    async for doc in docs:
+        writer.writerow({key: json_default(value) if isinstance(value, (ObjectId, datetime)) else value
+                         for key, value in doc.items()})
+        rows += 1
+        if rows % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+
+from jinja2 import Environment
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """
+    LRU cache of rendered item rows, keyed by (template, _id, update_date) and bounded by size.
+
+    Every write sets a new `update_date`, so a changed item gets a new key and its old fragments
+    simply age out of the cache; nothing has to be invalidated.
+    """
+
+    def __init__(self, env: Environment, max_bytes: int, context: dict | None = None):
+        """
+        Args:
+            env (Environment): The Jinja environment the row templates are loaded from.
+            max_bytes (int): Upper bound on the total size of the cached fragments. 0 turns the cache off.
+            context (dict, optional): Variables, other than `item`, that every row template needs.
+        """
+        self.env = env
+        self.max_bytes = max_bytes
+        self.context = context or {}
+        self.entries: OrderedDict[tuple, Markup] = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def render(self, name: str, item: dict | None) -> Markup:
+        """
+        Render the row template `name` for `item`, or return the copy rendered for the same item version.
+
+        Items without an `update_date` have no version to key on and are always rendered.
+        """
+        version = item.get("update_date") if item else None
+        if version is None or self.max_bytes <= 0:
+            return self._render(name, item)
+        key = (name, item["_id"], version)
+        html = self.entries.get(key)
+        if html is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return html
+        self.misses += 1
+        html = self._render(name, item)
+        if len(html) <= self.max_bytes:
+            self.entries[key] = html
+            self.bytes += len(html)
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+        return html
+
+    def _render(self, name: str, item: dict | None) -> Markup:
+        return Markup(self.env.get_template(name).render(item=item, **self.context))
@@ -0,0 +1,185 @@
+import logging
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, TEXT, IndexModel
+from pymongo.errors import PyMongoError
+
+
+logger = logging.getLogger(__name__)
+
+ITEM_INDEXES = [
+    # iter_items, fetch_inventory_page and search_items: filter on user_id, sort by _id
+    IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_id_1__id_1"),
+    # per-tenant retention and change tracking
+    IndexModel([("user_id", ASCENDING), ("update_date", ASCENDING)], name="user_id_1_update_date_1"),
+    # retention deletes across all tenants (given a TTL by ensure_indexes in the "ttl" retention mode)
+    IndexModel([("update_date", ASCENDING)], name="update_date_1"),
+    # search fields, so the regex filter is applied to index keys before documents are fetched
+    IndexModel([("user_id", ASCENDING), ("name", ASCENDING), ("description", ASCENDING), ("drawing", ASCENDING)],
+               name="user_id_1_name_1_description_1_drawing_1"),
+]
+
+# search_items in text mode; the user_id prefix keeps each lookup inside one tenant
+TEXT_INDEX = IndexModel([("user_id", ASCENDING), ("name", TEXT), ("description", TEXT), ("drawing", TEXT)],
+                        weights={"name": 10, "drawing": 5, "description": 1}, name="item_text")
+
+
+def ttl_index(seconds: int) -> IndexModel:
+    """
+    The update_date index with a TTL, so MongoDB deletes items `seconds` after their last update.
+    """
+    return IndexModel([("update_date", ASCENDING)], name="update_date_1", expireAfterSeconds=seconds)
+
+
+def tombstone_indexes(seconds: int) -> list[IndexModel]:
+    """
+    Indexes of the tombstone collection: the delta sync lookup, and a TTL that drops tombstones `seconds` after the delete.
+    """
+    return [IndexModel([("user_id", ASCENDING), ("update_date", ASCENDING)], name="user_id_1_update_date_1"),
+            IndexModel([("update_date", ASCENDING)], name="update_date_1", expireAfterSeconds=seconds)]
+
+
+def job_indexes(seconds: int) -> list[IndexModel]:
+    """
+    Indexes of the job collection: a TTL that drops job reports `seconds` after they were last
+    saved. Leases carry no `saved` date and are kept.
+    """
+    return [IndexModel([("saved", ASCENDING)], name="saved_1", expireAfterSeconds=seconds)]
+
+
+QUERY_SHAPES = {
+    "iter_items": ({"user_id": ""}, [("_id", ASCENDING)]),
+    "fetch_inventory_page": ({"user_id": "", "_id": {"$gt": ObjectId()}}, [("_id", ASCENDING)]),
+    "search_items": ({"$and": [{"$or": [{"name": {"$regex": "", "$options": "i"}},
+                                        {"description": {"$regex": "", "$options": "i"}},
+                                        {"drawing": {"$regex": "", "$options": "i"}}]},
+                               {"user_id": ""}]}, [("_id", ASCENDING)]),
+    "delete_expired_batch": ({"update_date": {"$lt": datetime.now()}, "_id": {"$gt": ObjectId()}},
+                             [("_id", ASCENDING)]),
+    "fetch_changes": ({"user_id": "", "update_date": {"$lt": datetime.now()},
+                       "$or": [{"update_date": {"$gt": datetime.now()}},
+                               {"update_date": datetime.now(), "_id": {"$gt": ObjectId()}}]},
+                      [("update_date", ASCENDING), ("_id", ASCENDING)]),
+}
+
+TEXT_QUERY_SHAPE = ({"user_id": "", "$text": {"$search": "x"}}, None)
+
+
+def _spec(index: dict) -> tuple:
+    """
+    Comparable form of an index definition: its key pattern plus the options that change its behaviour.
+    """
+    options = {opt: index[opt] for opt in ("unique", "sparse", "expireAfterSeconds", "weights",
+                                           "partialFilterExpression") if opt in index}
+    # text indexes are reported back as _fts/_ftsx keys, so compare their text fields through `weights`
+    key = [(field, order) for field, order in index["key"].items()
+           if order != TEXT and field not in ("_fts", "_ftsx")]
+    return key, options
+
+
+def _has_collscan(plan) -> bool:
+    """
+    Walk an explain plan and report whether any stage is a full collection scan.
+    """
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(value) for value in plan)
+    return False
+
+
+async def reconcile_indexes(collection, indexes: list[IndexModel]):
+    """
+    Create the declared indexes, rebuilding any that exist under the same name with a different definition.
+
+    Indexes that are not declared are left alone and only reported.
+
+    Returns:
+        list: The names of the indexes that were created or rebuilt.
+    """
+    existing = {index["name"]: index async for index in collection.list_indexes()}
+    missing = []
+    for model in indexes:
+        wanted = model.document
+        current = existing.pop(wanted["name"], None)
+        if current is not None and _spec(current) == _spec(wanted):
+            continue
+        if current is not None:
+            logger.warning("index %s changed definition, rebuilding", wanted["name"])
+            await collection.drop_index(wanted["name"])
+        missing.append(model)
+    existing.pop("_id_", None)
+    for name in existing:
+        logger.info("index %s is not declared in utils.indexes", name)
+    if missing:
+        await collection.create_indexes(missing)
+    return [model.document["name"] for model in missing]
+
+
+async def find_collection_scans(collection, shapes: dict) -> list[str]:
+    """
+    Explain every query shape and return the names of those whose plan is a collection scan.
+    """
+    scans = []
+    for name, (query, sort) in shapes.items():
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = await cursor.explain()
+        if _has_collscan(plan.get("queryPlanner", {}).get("winningPlan")):
+            scans.append(name)
+    return scans
+
+
+async def ensure_tombstone_indexes(tombstones, ttl: int):
+    """
+    Reconcile the tombstone indexes. Errors are logged, like `ensure_indexes`.
+    """
+    try:
+        created = await reconcile_indexes(tombstones, tombstone_indexes(ttl))
+        if created:
+            logger.info("created tombstone indexes: %s", ", ".join(created))
+    except PyMongoError as err:
+        logger.error("tombstone index reconciliation failed: %s", err)
+
+
+async def ensure_job_indexes(jobs, ttl: int):
+    """
+    Reconcile the job indexes. Errors are logged, like `ensure_indexes`.
+    """
+    try:
+        created = await reconcile_indexes(jobs, job_indexes(ttl))
+        if created:
+            logger.info("created job indexes: %s", ", ".join(created))
+    except PyMongoError as err:
+        logger.error("job index reconciliation failed: %s", err)
+
+
+async def ensure_indexes(collection, search_mode: str, ttl: int | None = None):
+    """
+    Reconcile the item indexes and log any query shape that would still fall back to a collection scan.
+
+    Meant to run as a background task from the app lifespan, so errors are logged instead of raised.
+
+    Args:
+        collection: The item collection.
+        search_mode (str): SEARCH_MODE; "text" adds the text index.
+        ttl (int, optional): Let MongoDB delete items this many seconds after their last update.
+    """
+    indexes, shapes = list(ITEM_INDEXES), dict(QUERY_SHAPES)
+    if ttl is not None:
+        indexes = [ttl_index(ttl) if model.document["name"] == "update_date_1" else model for model in indexes]
+    if search_mode == "text":
+        indexes.append(TEXT_INDEX)
+        shapes["search_items_text"] = TEXT_QUERY_SHAPE
+    try:
+        created = await reconcile_indexes(collection, indexes)
+        if created:
+            logger.info("created indexes: %s", ", ".join(created))
+        for name in await find_collection_scans(collection, shapes):
+            logger.warning("query %s falls back to a collection scan", name)
+    except PyMongoError as err:
+        logger.error("index reconciliation failed: %s", err)
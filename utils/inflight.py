@@ -0,0 +1,113 @@
+import asyncio
+import inspect
+from functools import wraps
+
+
+class Superseded(Exception):
+    """
+    Raised to a caller whose call was cancelled because a newer one for the same key started.
+    """
+
+
+class SingleFlight:
+    """
+    Runs identical concurrent calls once: callers asking for a key that is already being fetched
+    wait for that call instead of starting their own.
+
+    The shared call runs in its own task, so one caller giving up does not cancel it for the
+    others; it is cancelled once every caller has. `forget` makes later callers start a new call,
+    which writes use so that nobody joins a read that started before them.
+    """
+
+    def __init__(self):
+        self.calls: dict[tuple, list] = {}
+        self.leaders = self.followers = 0
+
+    async def run(self, key: tuple, factory):
+        """
+        Await the call running for `key`, starting it with `factory()` if there is none.
+        """
+        call = self.calls.get(key)
+        if call is None:
+            # [task, number of callers waiting for it]
+            call = self.calls[key] = [asyncio.create_task(factory()), 0]
+            call[0].add_done_callback(lambda task: self._finished(key, call))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        except asyncio.CancelledError:
+            if call[1] == 1 and not call[0].done():
+                self._finished(key, call)
+                call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+    def _finished(self, key: tuple, call: list):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    def forget(self):
+        self.calls.clear()
+
+
+def single_flight(group: SingleFlight):
+    """
+    Share concurrent calls of an async read function with the same arguments, keyed like `cached`.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (func.__name__, *bound.arguments.values())
+            return await group.run(key, lambda: func(*args, **kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+class Supersede:
+    """
+    Keeps at most one call running per key: starting a call cancels the previous one for that key,
+    whose caller gets `Superseded`.
+    """
+
+    def __init__(self):
+        self.running: dict[str, asyncio.Task] = {}
+        self.superseded = 0
+
+    async def run(self, key: str, coro):
+        previous = self.running.get(key)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.superseded += 1
+        task = self.running[key] = asyncio.create_task(coro)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                # the caller itself was cancelled, which cancelled the task too
+                raise
+            raise Superseded(key) from None
+        finally:
+            if self.running.get(key) is task:
+                del self.running[key]
+
+
+async def collect(cursor, length: int | None):
+    """
+    `cursor.to_list(length)`, closing the cursor if the read is cancelled so the server stops
+    producing batches nobody will read.
+    """
+    try:
+        return await cursor.to_list(length)
+    except asyncio.CancelledError:
+        await cursor.close()
+        raise
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+logger = logging.getLogger(__name__)
+
+# change streams need a replica set; a standalone server answers with this code
+CHANGE_STREAMS_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class LiveHub:
+    """
+    Fans item changes out to every open live view of their owner, within one worker.
+
+    Each subscriber has a queue of at most `queue_size` changes. A subscriber too slow to keep
+    up loses its queued changes and gets a single "resync" instead, telling it to reload.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers: dict[str, set[asyncio.Queue]] = {}
+        self.published = self.resyncs = 0
+
+    @property
+    def count(self) -> int:
+        return sum(len(queues) for queues in self.subscribers.values())
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        """
+        A queue receiving `(kind, item)` for each change of the user's items; kind is "insert",
+        "update", "delete" or "resync" (item None).
+        """
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+
+    def publish(self, user_id: str, kind: str, item: dict | None):
+        for queue in self.subscribers.get(user_id, ()):
+            self.published += 1
+            try:
+                queue.put_nowait((kind, item))
+            except asyncio.QueueFull:
+                self._resync(queue)
+
+    def resync_all(self):
+        """
+        Tell every subscriber to reload, for changes that cannot be told apart (or were missed).
+        """
+        for queues in self.subscribers.values():
+            for queue in queues:
+                self._resync(queue)
+
+    def _resync(self, queue: asyncio.Queue):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(("resync", None))
+        self.resyncs += 1
+
+    def on_write(self, op: str, docs: list[dict]):
+        """
+        Write hook publishing the app's own writes, for when change streams are not available.
+        """
+        if op == "cleanup":
+            self.resync_all()
+            return
+        for doc in docs:
+            if doc.get("user_id") is not None:
+                self.publish(doc["user_id"], op, doc)
+
+
+async def watch_changes(database, hub: LiveHub, items: str = "Item", tombstones: str = "Tombstone"):
+    """
+    Publish the changes of every worker, read from one change stream on the database.
+
+    Inserted, updated and replaced items come from the item collection. Deletes come from the
+    tombstone collection, whose documents (unlike a delete event) still say whose item it was.
+    The stream resumes where it stopped after an error; if it cannot, subscribers resync.
+
+    Raises:
+        OperationFailure: If the server does not support change streams (it is not a replica set).
+    """
+    pipeline = [{"$match": {"$or": [{"ns.coll": items, "operationType": {"$in": ["insert", "update", "replace"]}},
+                                    {"ns.coll": tombstones, "operationType": "insert"}]}}]
+    token = None
+    while True:
+        try:
+            async with database.watch(pipeline, full_document="updateLookup", resume_after=token) as stream:
+                async for change in stream:
+                    token = stream.resume_token
+                    item = change.get("fullDocument")
+                    if item is None or item.get("user_id") is None:
+                        # updated and deleted again before the lookup
+                        continue
+                    if change["ns"]["coll"] == tombstones:
+                        hub.publish(item["user_id"], "delete", item)
+                    else:
+                        hub.publish(item["user_id"], "insert" if change["operationType"] == "insert" else "update",
+                                    item)
+        except OperationFailure as err:
+            if err.code == CHANGE_STREAMS_UNSUPPORTED:
+                raise
+            if err.code == CHANGE_STREAM_HISTORY_LOST:
+                token = None
+            logger.warning("change stream failed, reopening: %s", err)
+            hub.resync_all()
+        except PyMongoError as err:
+            logger.warning("change stream interrupted, resuming: %s", err)
+        await asyncio.sleep(1)
+
+
+def sse_event(event: str, data: str = "") -> str:
+    """
+    One Server-Sent Event; every line of `data` gets its own `data:` field.
+    """
+    return f"event: {event}\n" + "".join(f"data: {line}\n" for line in data.split("\n")) + "\n"
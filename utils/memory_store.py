@@ -0,0 +1,493 @@
+import re
+from bisect import bisect_right, insort
+from collections.abc import AsyncIterator
+from datetime import datetime
+
+from bson import ObjectId
+from bson.regex import Regex
+from pymongo import DeleteOne, InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+
+def _type_rank(value) -> int:
+    # MongoDB's BSON comparison order, for the types items use
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, list):
+        return 4
+    if isinstance(value, ObjectId):
+        return 6
+    if isinstance(value, bool):
+        return 7
+    if isinstance(value, datetime):
+        return 8
+    return 9
+
+
+def sort_key(value):
+    return _type_rank(value), value
+
+
+def _compare(op: str, value, target) -> bool:
+    # like MongoDB, range operators only match values of the same type
+    if value is None or _type_rank(value) != _type_rank(target):
+        return False
+    if op == "$gt":
+        return value > target
+    if op == "$gte":
+        return value >= target
+    if op == "$lt":
+        return value < target
+    return value <= target
+
+
+def _regex(pattern, options: str = ""):
+    if isinstance(pattern, Regex):
+        return pattern.try_compile()
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    flags = re.IGNORECASE if "i" in options else 0
+    flags |= re.MULTILINE if "m" in options else 0
+    flags |= re.DOTALL if "s" in options else 0
+    return re.compile(pattern, flags)
+
+
+def _match_value(value, condition) -> bool:
+    if isinstance(condition, (re.Pattern, Regex)):
+        return isinstance(value, str) and _regex(condition).search(value) is not None
+    if not (isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition)):
+        return value == condition
+    for op, target in condition.items():
+        if op == "$eq" and value != target:
+            return False
+        if op == "$ne" and value == target:
+            return False
+        if op in ("$gt", "$gte", "$lt", "$lte") and not _compare(op, value, target):
+            return False
+        if op == "$in" and value not in target:
+            return False
+        if op == "$nin" and value in target:
+            return False
+        if op == "$exists" and (value is not None) != bool(target):
+            return False
+        if op == "$regex":
+            pattern = _regex(target, condition.get("$options", ""))
+            if not (isinstance(value, str) and pattern.search(value)):
+                return False
+        if op == "$not" and _match_value(value, target):
+            return False
+        if op not in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$exists", "$regex",
+                      "$options", "$not"):
+            raise OperationFailure(f"unknown operator: {op}", code=2)
+    return True
+
+
+def matches(doc: dict, query: dict | None) -> bool:
+    """
+    Evaluate a MongoDB query filter against a document.
+
+    Supports top-level fields with $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $exists,
+    $regex and $not, combined with $and, $or and $nor.
+    """
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$text":
+            raise OperationFailure("text index required for $text query", code=27)
+        elif key.startswith("$"):
+            raise OperationFailure(f"unknown top level operator: {key}", code=2)
+        elif not _match_value(doc.get(key), condition):
+            return False
+    return True
+
+
+def project(doc: dict, projection: dict | None) -> dict:
+    """
+    Apply an inclusion or exclusion projection, returning a copy of the document.
+    """
+    if not projection:
+        return dict(doc)
+    include_id = projection.get("_id", 1)
+    fields = {key: value for key, value in projection.items() if key != "_id"}
+    if fields and all(fields.values()):
+        result = {key: doc[key] for key in fields if key in doc}
+        if include_id and "_id" in doc:
+            result = {"_id": doc["_id"], **result}
+        return result
+    result = {key: value for key, value in doc.items() if key not in fields}
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def _sort_spec(key_or_list, direction=None) -> list[tuple[str, int]]:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+
+def sort_docs(docs: list[dict], spec: list[tuple[str, int]]) -> list[dict]:
+    for key, direction in reversed(spec):
+        docs.sort(key=lambda doc: sort_key(doc.get(key)), reverse=direction < 0)
+    return docs
+
+
+def _conditions(query: dict, field: str):
+    """
+    Yield the conditions on `field` that every match must satisfy (top level and inside $and).
+    """
+    for key, condition in query.items():
+        if key == field:
+            yield condition
+        elif key == "$and":
+            for sub in condition:
+                yield from _conditions(sub, field)
+
+
+class MemoryCursor:
+    """
+    The part of Motor's cursor API the app uses: sort, skip, limit, batch_size, to_list, close and async iteration.
+    """
+
+    def __init__(self, collection: "MemoryCollection", query: dict | None, projection: dict | None):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int):
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        return self
+
+    def _results(self) -> list[dict]:
+        docs = self.collection._select(self.query, self._sort, self._skip, self._limit)
+        return [project(doc, self.projection) for doc in docs]
+
+    async def to_list(self, length: int | None = None) -> list[dict]:
+        results = self._results()
+        return results[:length] if length else results
+
+    async def close(self):
+        pass
+
+    async def __aiter__(self) -> AsyncIterator[dict]:
+        for doc in self._results():
+            yield doc
+
+
+def _parent(doc: dict, path: str) -> tuple[dict, str]:
+    """
+    The embedded document holding the last field of a dotted path, created as needed, and that field's name.
+    """
+    *parents, name = path.split(".")
+    for key in parents:
+        doc = doc.setdefault(key, {})
+    return doc, name
+
+
+def _expression(doc: dict, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        return doc.get(expression[1:])
+    if isinstance(expression, dict):
+        return {key: _expression(doc, value) for key, value in expression.items()}
+    return expression
+
+
+def group(docs: list[dict], spec: dict) -> list[dict]:
+    """
+    The $group stage, with `$sum` as the only accumulator.
+    """
+    groups = {}
+    for doc in docs:
+        key = _expression(doc, spec["_id"])
+        hashable = tuple(key.items()) if isinstance(key, dict) else key
+        result = groups.get(hashable)
+        if result is None:
+            result = groups[hashable] = {"_id": key, **{field: 0 for field in spec if field != "_id"}}
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            (op, expression), = accumulator.items()
+            if op != "$sum":
+                raise OperationFailure(f"unsupported accumulator: {op}", code=15952)
+            value = _expression(doc, expression)
+            # like MongoDB, $sum skips values that are not numbers
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                result[field] += value
+    return list(groups.values())
+
+
+class MemoryAggregate:
+    """
+    Aggregation cursor supporting the $match, $sort, $skip, $limit, $project and $group stages.
+    """
+
+    def __init__(self, collection: "MemoryCollection", pipeline: list[dict]):
+        self.collection = collection
+        self.pipeline = pipeline
+
+    def _results(self) -> list[dict]:
+        docs = [dict(doc) for doc in self.collection._docs.values()]
+        for stage in self.pipeline:
+            (name, spec), = stage.items()
+            if name == "$match":
+                docs = [doc for doc in docs if matches(doc, spec)]
+            elif name == "$sort":
+                docs = sort_docs(docs, _sort_spec(spec))
+            elif name == "$skip":
+                docs = docs[spec:]
+            elif name == "$limit":
+                docs = docs[:spec]
+            elif name == "$project":
+                docs = [project(doc, spec) for doc in docs]
+            elif name == "$group":
+                docs = group(docs, spec)
+            else:
+                raise OperationFailure(f"unsupported pipeline stage: {name}", code=40324)
+        return docs
+
+    async def to_list(self, length: int | None = None) -> list[dict]:
+        results = self._results()
+        return results[:length] if length else results
+
+    async def close(self):
+        pass
+
+    async def __aiter__(self) -> AsyncIterator[dict]:
+        for doc in self._results():
+            yield doc
+
+
+class MemoryCollection:
+    """
+    In-process stand-in for a Motor collection, for tests and benchmarks without a MongoDB server.
+
+    Documents are kept in a dict keyed by `_id`, with a sorted `_id` list per `user_id` so the
+    app's keyset pages are served without scanning other tenants or earlier pages.
+    """
+
+    def __init__(self):
+        self._docs: dict = {}
+        self._ids: list = []
+        self._user_ids: dict[str, list] = {}
+
+    def _scope(self, query: dict) -> list:
+        for condition in _conditions(query, "user_id"):
+            if isinstance(condition, str):
+                return self._user_ids.get(condition, [])
+        return self._ids
+
+    def _select(self, query: dict, sort: list | None, skip: int = 0, limit: int = 0) -> list[dict]:
+        for condition in _conditions(query, "_id"):
+            if not isinstance(condition, dict):
+                ids = [condition]
+                break
+            if "$in" in condition:
+                ids = sorted(condition["$in"], key=sort_key)
+                break
+        else:
+            ids = self._scope(query)
+            if sort in (None, [("_id", 1)]):
+                # walk the sorted ids from the keyset bound and stop once the page is full
+                for condition in _conditions(query, "_id"):
+                    if isinstance(condition, dict) and "$gt" in condition:
+                        ids = ids[bisect_right(ids, sort_key(condition["$gt"]), key=sort_key):]
+                docs = []
+                for item_id in ids:
+                    doc = self._docs[item_id]
+                    if matches(doc, query):
+                        docs.append(doc)
+                        if limit and len(docs) >= skip + limit:
+                            break
+                return docs[skip:]
+        docs = [self._docs[item_id] for item_id in ids if item_id in self._docs and matches(self._docs[item_id], query)]
+        if sort:
+            docs = sort_docs(docs, sort)
+        docs = docs[skip:]
+        return docs[:limit] if limit else docs
+
+    def _add(self, doc: dict):
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self._docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error dup key: {{ _id: {doc['_id']!r} }}", code=11000)
+        stored = dict(doc)
+        self._docs[stored["_id"]] = stored
+        insort(self._ids, stored["_id"], key=sort_key)
+        insort(self._user_ids.setdefault(stored.get("user_id"), []), stored["_id"], key=sort_key)
+
+    def _remove(self, doc: dict):
+        del self._docs[doc["_id"]]
+        self._ids.remove(doc["_id"])
+        user_ids = self._user_ids[doc.get("user_id")]
+        user_ids.remove(doc["_id"])
+        if not user_ids:
+            del self._user_ids[doc.get("user_id")]
+
+    def _apply(self, doc: dict, update: dict):
+        for op, fields in update.items():
+            if op not in ("$set", "$inc", "$unset"):
+                raise OperationFailure(f"unsupported update operator: {op}", code=9)
+        if "user_id" in update.get("$set", {}) and update["$set"]["user_id"] != doc.get("user_id"):
+            # keep the per-user index in step with the new owner
+            self._remove(doc)
+            doc["user_id"] = update["$set"]["user_id"]
+            self._add(doc)
+            doc = self._docs[doc["_id"]]
+        for key, value in update.get("$set", {}).items():
+            parent, name = _parent(doc, key)
+            parent[name] = value
+        for key, delta in update.get("$inc", {}).items():
+            parent, name = _parent(doc, key)
+            parent[name] = parent.get(name, 0) + delta
+        for key in update.get("$unset", {}):
+            parent, name = _parent(doc, key)
+            parent.pop(name, None)
+
+    def _replace(self, doc: dict, replacement: dict):
+        self._remove(doc)
+        self._add({**{key: value for key, value in replacement.items() if key != "_id"}, "_id": doc["_id"]})
+
+    def find(self, filter: dict | None = None, projection: dict | None = None, **kwargs) -> MemoryCursor:
+        return MemoryCursor(self, filter, projection)
+
+    async def find_one(self, filter: dict | None = None, projection: dict | None = None, **kwargs) -> dict | None:
+        docs = self._select(filter or {}, None, limit=1)
+        return project(docs[0], projection) if docs else None
+
+    def aggregate(self, pipeline: list[dict], **kwargs) -> MemoryAggregate:
+        return MemoryAggregate(self, pipeline)
+
+    async def insert_one(self, document: dict, **kwargs) -> InsertOneResult:
+        self._add(document)
+        return InsertOneResult(document["_id"], True)
+
+    async def insert_many(self, documents: list[dict], ordered: bool = True, **kwargs) -> InsertManyResult:
+        errors = []
+        for index, document in enumerate(documents):
+            document.setdefault("_id", ObjectId())
+            try:
+                self._add(document)
+            except DuplicateKeyError as err:
+                errors.append({"index": index, "code": 11000, "errmsg": str(err), "op": document})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(documents) - len(errors)})
+        return InsertManyResult([document["_id"] for document in documents], True)
+
+    def _upsert(self, filter: dict, update: dict):
+        # like MongoDB, the new document starts from the filter's equality conditions
+        doc = {key: value for key, value in filter.items() if not key.startswith("$") and not isinstance(value, dict)}
+        self._add(doc)
+        self._apply(self._docs[doc["_id"]], update)
+        return doc["_id"]
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        docs = self._select(filter, None, limit=1)
+        if docs:
+            self._apply(docs[0], update)
+        elif upsert:
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": self._upsert(filter, update)}, True)
+        return UpdateResult({"n": len(docs), "nModified": len(docs)}, True)
+
+    async def update_many(self, filter: dict, update: dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        docs = self._select(filter, None)
+        for doc in docs:
+            self._apply(doc, update)
+        if not docs and upsert:
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": self._upsert(filter, update)}, True)
+        return UpdateResult({"n": len(docs), "nModified": len(docs)}, True)
+
+    async def bulk_write(self, requests: list, ordered: bool = True, **kwargs) -> BulkWriteResult:
+        counts = {"nInserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "nUpserted": 0, "upserted": []}
+        errors = []
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    request._doc.setdefault("_id", ObjectId())
+                    self._add(request._doc)
+                    counts["nInserted"] += 1
+                    continue
+                if not isinstance(request, (ReplaceOne, UpdateOne, DeleteOne)):
+                    raise OperationFailure(f"unsupported bulk operation: {type(request).__name__}", code=9)
+                docs = self._select(request._filter, None, limit=1)
+                if isinstance(request, DeleteOne):
+                    for doc in docs:
+                        self._remove(doc)
+                    counts["nRemoved"] += len(docs)
+                    continue
+                for doc in docs:
+                    if isinstance(request, ReplaceOne):
+                        self._replace(doc, request._doc)
+                    else:
+                        self._apply(doc, request._doc)
+                counts["nMatched"] += len(docs)
+                counts["nModified"] += len(docs)
+            except (DuplicateKeyError, OperationFailure) as err:
+                errors.append({"index": index, "code": err.code, "errmsg": str(err), "op": request})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, **counts})
+        return BulkWriteResult(counts, True)
+
+    async def delete_one(self, filter: dict, **kwargs) -> DeleteResult:
+        docs = self._select(filter, None, limit=1)
+        for doc in docs:
+            self._remove(doc)
+        return DeleteResult({"n": len(docs)}, True)
+
+    async def delete_many(self, filter: dict, **kwargs) -> DeleteResult:
+        docs = self._select(filter, None)
+        for doc in docs:
+            self._remove(doc)
+        return DeleteResult({"n": len(docs)}, True)
+
+    async def find_one_and_update(self, filter: dict, update: dict, projection: dict | None = None,
+                                  return_document: bool = ReturnDocument.BEFORE, **kwargs) -> dict | None:
+        docs = self._select(filter, None, limit=1)
+        if not docs:
+            return None
+        before = dict(docs[0])
+        self._apply(docs[0], update)
+        after = self._docs[before["_id"]]
+        return project(after if return_document == ReturnDocument.AFTER else before, projection)
+
+    async def find_one_and_delete(self, filter: dict, projection: dict | None = None, **kwargs) -> dict | None:
+        docs = self._select(filter, None, limit=1)
+        if not docs:
+            return None
+        self._remove(docs[0])
+        return project(docs[0], projection)
+
+    async def count_documents(self, filter: dict, **kwargs) -> int:
+        return len(self._select(filter, None))
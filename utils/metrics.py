@@ -0,0 +1,273 @@
+from collections.abc import Callable
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+from time import perf_counter
+
+from fastapi.routing import APIRoute
+from jinja2 import Template
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class Histogram:
+    """
+    Prometheus histogram with a fixed set of label names.
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.series.items()):
+            pairs = list(zip(self.label_names, key))
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(pairs + [('le', bound)])} {bucket}")
+            lines.append(f"{self.name}_bucket{_labels(pairs + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_labels(pairs)} {total}")
+            lines.append(f"{self.name}_count{_labels(pairs)} {count}")
+        return lines
+
+
+class Counter:
+    """
+    Prometheus counter with a fixed set of label names.
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.series: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{_labels(list(zip(self.label_names, key)))} {value}")
+        return lines
+
+
+class Snapshot:
+    """
+    Metric read from a callback at scrape time, for state that other objects already keep.
+    """
+
+    def __init__(self, name: str, help: str, type: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.read = read
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", f"{self.name} {self.read()}"]
+
+
+class Registry:
+    """
+    The metrics served at /metrics.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(Histogram(
+    "http_request_duration_seconds", "Time to serve a request, by route template.", ("method", "route", "status")))
+HANDLER_OVERHEAD_SECONDS = registry.register(Histogram(
+    "http_handler_overhead_seconds",
+    "Time spent in a route outside its endpoint function: dependencies, request validation and response serialization.",
+    ("route",)))
+DB_SECONDS = registry.register(Histogram(
+    "db_operation_duration_seconds", "Time spent in each storage operation.", ("operation",)))
+DB_DOCUMENTS = registry.register(Counter(
+    "db_documents_returned_total", "Documents returned by each storage operation.", ("operation",)))
+TEMPLATE_SECONDS = registry.register(Histogram(
+    "template_render_duration_seconds", "Time to render each top level Jinja template.", ("template",)))
+POOL_CHECKOUT_SECONDS = registry.register(Histogram(
+    "mongo_pool_checkout_seconds", "Time waiting to check a connection out of the MongoDB pool.", ()))
+FIRST_BYTE_SECONDS = registry.register(Histogram(
+    "http_time_to_first_byte_seconds", "Time from receiving a request to sending the first byte of its body.",
+    ("route",)))
+RESPONSE_BYTES = registry.register(Counter(
+    "http_response_body_bytes_total", "Response body bytes before compression, by content coding.", ("encoding",)))
+RESPONSE_WIRE_BYTES = registry.register(Counter(
+    "http_response_wire_bytes_total", "Response body bytes sent, after compression, by content coding.",
+    ("encoding",)))
+WRITE_BATCH_SIZE = registry.register(Histogram(
+    "db_write_batch_size", "Single-document writes sent together by the write coalescer, by kind.", ("kind",),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)))
+WRITE_BATCH_WAIT_SECONDS = registry.register(Histogram(
+    "db_write_batch_wait_seconds", "Time a write waited for its batch to be sent, by kind.", ("kind",)))
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request latency and time to first byte, labelled by the matched route template.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = perf_counter()
+        status = 500
+        first_byte = True
+
+        async def send_status(message):
+            nonlocal status, first_byte
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and first_byte and message.get("body"):
+                first_byte = False
+                route = scope.get("route")
+                FIRST_BYTE_SECONDS.observe(perf_counter() - started, route=getattr(route, "path_format", "unmatched"))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(perf_counter() - started, method=scope["method"],
+                                    route=getattr(route, "path_format", "unmatched"), status=status)
+
+
+def timed_operation(func):
+    """
+    Record the duration and number of documents returned of an async storage operation.
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        finally:
+            DB_SECONDS.observe(perf_counter() - started, operation=func.__name__)
+        if isinstance(result, list):
+            DB_DOCUMENTS.inc(len(result), operation=func.__name__)
+        elif isinstance(result, dict):
+            DB_DOCUMENTS.inc(1, operation=func.__name__)
+        return result
+
+    return wrapper
+
+
+class TimedTemplate(Template):
+    """
+    Jinja template class that records its render time. Set it as an Environment's `template_class`.
+    """
+
+    def render(self, *args, **kwargs) -> str:
+        started = perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            TEMPLATE_SECONDS.observe(perf_counter() - started, template=self.name)
+
+    def generate(self, *args, **kwargs):
+        # only the time spent producing output counts, not the time the consumer holds each chunk
+        spent = 0.0
+        chunks = super().generate(*args, **kwargs)
+        try:
+            while True:
+                started = perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    spent += perf_counter() - started
+                yield chunk
+        finally:
+            TEMPLATE_SECONDS.observe(spent, template=self.name)
+
+
+_endpoint_seconds: ContextVar[list[float]] = ContextVar("endpoint_seconds")
+
+
+class TimedRoute(APIRoute):
+    """
+    APIRoute that records how long the route spends outside its endpoint function.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        # include_router builds the route again from the already wrapped endpoint
+        if iscoroutinefunction(endpoint) and not getattr(endpoint, "timed", False):
+            endpoint = self._time_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    @staticmethod
+    def _time_endpoint(endpoint: Callable) -> Callable:
+        @wraps(endpoint)
+        async def timed_endpoint(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                spent = _endpoint_seconds.get(None)
+                if spent is not None:
+                    spent[0] += perf_counter() - started
+
+        timed_endpoint.timed = True
+        return timed_endpoint
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        route = self.path_format
+
+        async def timed_handler(request):
+            spent = [0.0]
+            token = _endpoint_seconds.set(spent)
+            started = perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                HANDLER_OVERHEAD_SECONDS.observe(perf_counter() - started - spent[0], route=route)
+                _endpoint_seconds.reset(token)
+
+        return timed_handler
@@ -0,0 +1,89 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from datetime import datetime, timedelta
+from struct import error as StructError, pack, unpack
+from typing import NamedTuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class PageKey(NamedTuple):
+    """
+    The sort key of the last item on a page: its `_id`, and its relevance score for ranked searches.
+    """
+    id: ObjectId
+    score: float | None = None
+
+
+def encode_cursor(item_id: ObjectId, score: float | None = None) -> str:
+    """
+    Encode the sort key of the last item on a page as an opaque "after" token.
+    """
+    raw = ObjectId(item_id).binary
+    if score is not None:
+        raw += pack(">d", score)
+    return urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str | None) -> PageKey | None:
+    """
+    Decode an "after" token produced by encode_cursor.
+
+    Raises:
+        ValueError: If the token is malformed.
+    """
+    if not token:
+        return None
+    try:
+        raw = urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        score = unpack(">d", raw[12:])[0] if len(raw) > 12 else None
+        return PageKey(ObjectId(raw[:12]), score)
+    except (DecodeError, InvalidId, StructError, TypeError) as err:
+        raise ValueError("invalid pagination token") from err
+
+
+def next_cursor(items: list[dict], items_per_page: int) -> str | None:
+    """
+    Return the token for the page after `items`, or None when this was the last page.
+    """
+    if len(items) < items_per_page:
+        return None
+    return encode_cursor(items[-1]["_id"], items[-1].get("score"))
+
+
+class ChangeKey(NamedTuple):
+    """
+    The position of the last change a delta sync returned: its `update_date`, then its `_id`.
+    """
+    stamp: datetime
+    id: ObjectId
+
+
+def encode_change_cursor(key: ChangeKey) -> str:
+    """
+    Encode a change position as an opaque cursor. The stamp is kept to the microsecond, without a time zone.
+    """
+    raw = pack(">q", (key.stamp - EPOCH) // timedelta(microseconds=1)) + ObjectId(key.id).binary
+    return urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_change_cursor(token: str | None) -> ChangeKey | None:
+    """
+    Decode a cursor produced by encode_change_cursor.
+
+    Raises:
+        ValueError: If the token is malformed.
+    """
+    if not token:
+        return None
+    try:
+        raw = urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        if len(raw) != 20:
+            raise ValueError("invalid sync cursor")
+        return ChangeKey(EPOCH + timedelta(microseconds=unpack(">q", raw[:8])[0]), ObjectId(raw[8:]))
+    except (DecodeError, InvalidId, StructError, TypeError, OverflowError) as err:
+        raise ValueError("invalid sync cursor") from err
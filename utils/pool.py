@@ -0,0 +1,92 @@
+from threading import Lock
+
+from pymongo import monitoring
+
+from utils.metrics import POOL_CHECKOUT_SECONDS
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener keeping live connection counts and checkout wait times per server.
+
+    PyMongo calls it from its own threads, so every update happens under a lock.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.servers: dict[str, dict] = {}
+
+    def _server(self, address: tuple) -> dict:
+        name = f"{address[0]}:{address[1]}"
+        server = self.servers.get(name)
+        if server is None:
+            server = self.servers[name] = {"open": 0, "in_use": 0, "waiting": 0, "checkouts": 0,
+                                           "checkout_failures": 0, "wait_seconds_total": 0.0,
+                                           "wait_seconds_max": 0.0, "cleared": 0}
+        return server
+
+    def _update(self, address: tuple, **deltas):
+        with self._lock:
+            server = self._server(address)
+            for key, delta in deltas.items():
+                server[key] += delta
+
+    def pool_created(self, event):
+        with self._lock:
+            self._server(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._update(event.address, cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._update(event.address, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._update(event.address, open=-1)
+
+    def connection_check_out_started(self, event):
+        self._update(event.address, waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._update(event.address, waiting=-1, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        wait = event.duration or 0.0
+        with self._lock:
+            server = self._server(event.address)
+            server["waiting"] -= 1
+            server["in_use"] += 1
+            server["checkouts"] += 1
+            server["wait_seconds_total"] += wait
+            server["wait_seconds_max"] = max(server["wait_seconds_max"], wait)
+            POOL_CHECKOUT_SECONDS.observe(wait)
+
+    def connection_checked_in(self, event):
+        self._update(event.address, in_use=-1)
+
+    def total(self, key: str) -> float:
+        """
+        Sum of one counter over every server.
+        """
+        with self._lock:
+            return sum(server[key] for server in self.servers.values())
+
+    def snapshot(self) -> dict:
+        """
+        Copy of the per-server counters, with the mean checkout wait.
+        """
+        with self._lock:
+            servers = {name: dict(server) for name, server in self.servers.items()}
+        for server in servers.values():
+            checkouts = server["checkouts"]
+            server["wait_seconds_mean"] = server["wait_seconds_total"] / checkouts if checkouts else 0.0
+        return servers
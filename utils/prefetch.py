@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from time import monotonic
+
+from utils.cache import MISSING
+
+
+logger = logging.getLogger(__name__)
+
+
+class PageBuffer:
+    """
+    Pages read ahead of the request for them: after a page is served, the next one is fetched in
+    the background, so the infinite scroll's request for it is answered from memory.
+
+    Pages are kept per worker, for `ttl` seconds, and at most `max_pages` of them (oldest dropped
+    first). A page that is dropped, expires or is made stale by a write before anyone asks for it
+    counts as wasted.
+    """
+
+    def __init__(self, ttl: float, max_pages: int):
+        self.ttl = ttl
+        self.max_pages = max_pages
+        # (user_id, *page) -> (expiry, task)
+        self.pages: OrderedDict[tuple, tuple[float, asyncio.Task]] = OrderedDict()
+        self.prefetched = self.hits = self.misses = self.wasted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_pages > 0
+
+    def schedule(self, key: tuple, factory):
+        """
+        Start fetching the page for `key` with `factory()` unless it is already buffered.
+
+        Args:
+            key (tuple): The owning user first, then whatever identifies the page.
+            factory (Callable): Returns the coroutine reading the page.
+        """
+        if not self.enabled or key in self.pages:
+            return
+        now = monotonic()
+        # every entry lives for the same ttl, so the oldest expire first
+        while self.pages and next(iter(self.pages.values()))[0] <= now:
+            self._discard(next(iter(self.pages)))
+        task = asyncio.create_task(factory())
+        task.add_done_callback(self._done)
+        self.pages[key] = (now + self.ttl, task)
+        self.prefetched += 1
+        while len(self.pages) > self.max_pages:
+            self._discard(next(iter(self.pages)))
+
+    async def take(self, key: tuple):
+        """
+        The buffered page for `key`, waiting for it if it is still being read, or MISSING.
+        """
+        entry = self.pages.pop(key, None)
+        if entry is None or entry[0] <= monotonic():
+            if entry is not None:
+                self._cancel(entry[1])
+            self.misses += 1
+            return MISSING
+        try:
+            items = await entry[1]
+        except Exception:
+            # logged by _done; the caller reads the page itself
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        return items
+
+    def _discard(self, key: tuple):
+        expiry, task = self.pages.pop(key)
+        self._cancel(task)
+
+    def _cancel(self, task: asyncio.Task):
+        task.cancel()
+        self.wasted += 1
+
+    def _done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("prefetching a page failed: %s", task.exception())
+
+    def on_write(self, op: str, docs: list[dict]):
+        """
+        Write hook that drops the buffered pages of every user touched by a write.
+        """
+        users = None if op == "cleanup" else {doc.get("user_id") for doc in docs}
+        for key in [key for key in self.pages if users is None or key[0] in users]:
+            self._discard(key)
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import monotonic
+from uuid import uuid4
+
+from pymongo.errors import PyMongoError
+
+
+logger = logging.getLogger(__name__)
+
+LEASE = "retention"
+# a running job renews its lease after every chunk; if its worker dies, another may start a job
+# once the lease has run out
+LEASE_SECONDS = 300
+
+
+class CleanupJob:
+    """
+    Progress of one retention run.
+    """
+
+    def __init__(self, age: datetime):
+        self.id = uuid4().hex
+        self.age = age
+        self.status = "pending"
+        self.deleted = 0
+        self.batches = 0
+        # the last _id handled; ids grow with creation time, so this shows how far the run has come
+        self.position = None
+        self.started = datetime.now()
+        self.finished = None
+        self.error = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("pending", "running")
+
+    def report(self) -> dict:
+        return {"job_id": self.id,
+                "status": self.status,
+                "older_than": self.age.isoformat(),
+                "deleted": self.deleted,
+                "batches": self.batches,
+                "position": str(self.position) if self.position else None,
+                "started": self.started.isoformat(),
+                "finished": self.finished.isoformat() if self.finished else None,
+                "error": self.error,
+                }
+
+
+class Retention:
+    """
+    Deletes items that have not been updated for `max_age`, one background job at a time across
+    every worker sharing the database: a job only starts in the worker that takes the storage's
+    retention lease, and its report is saved to the storage so any worker can answer for it.
+
+    In "batched" mode a job walks the expired items in `_id` order and deletes them in chunks of
+    `batch_size`, at most `batches_per_second` chunks a second, so a large cleanup never holds a
+    request open or hits the database in one burst. In "ttl" mode MongoDB's TTL monitor deletes
+    them; a job then only tells the write hooks, which never see those deletes, to drop what they
+    hold, and once a day, on its first run from `rebuild_hour` on, recounts the summaries they
+    also never reach.
+    """
+
+    def __init__(self, mode: str, max_age: timedelta, batch_size: int, batches_per_second: float,
+                 history: int = 20, rebuild_hour: int = 3):
+        self.mode = mode
+        self.rebuild_hour = rebuild_hour
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.batches_per_second = batches_per_second
+        self.history = history
+        self.jobs: OrderedDict[str, CleanupJob] = OrderedDict()
+        self._current: CleanupJob | None = None
+        self._task: asyncio.Task | None = None
+        self._starting = asyncio.Lock()
+        self._last_start: float | None = None
+        # when this worker last rebuilt the summaries, for storages that keep no lease to record it
+        self._rebuilt: datetime | None = None
+        # made on first use, after the fork of a preloaded app, so every worker has its own
+        self.owner: str | None = None
+
+    async def start(self, storage, idle: float = 0) -> CleanupJob | None:
+        """
+        Start a cleanup job in the background, unless one is running already.
+
+        Args:
+            storage (Storage): Where the items are deleted, the lease taken and the report saved.
+            idle (float, optional): Also do nothing if a job started less than this many seconds ago.
+
+        Returns:
+            CleanupJob: The started job, or the one running in this worker. None if another worker
+            runs one, or one started too recently.
+        """
+        async with self._starting:
+            if self._current is not None and self._current.active:
+                return self._current
+            if idle and self._last_start is not None and monotonic() - self._last_start < idle:
+                return None
+            self.owner = self.owner or uuid4().hex
+            job = CleanupJob(datetime.now() - self.max_age)
+            lease = await storage.acquire_lease(LEASE, self.owner, LEASE_SECONDS, idle, job_id=job.id)
+            if lease is None:
+                return None
+            try:
+                await storage.save_job(job.report())
+            except PyMongoError:
+                await storage.release_lease(LEASE, self.owner)
+                raise
+            self._last_start = monotonic()
+            self._current = job
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+            self._task = asyncio.create_task(self._run(storage, job, lease.get("rebuilt") or self._rebuilt))
+            return job
+
+    async def running(self, storage) -> dict | None:
+        """
+        The report of the job running in any worker, or None.
+        """
+        if self._current is not None and self._current.active:
+            return self._current.report()
+        lease = await storage.read_lease(LEASE)
+        if not lease or not lease.get("job_id") or lease["expires"] <= datetime.now():
+            return None
+        return await storage.find_job(lease["job_id"])
+
+    async def report(self, storage, job_id: str) -> dict | None:
+        """
+        The report of a job started by any worker, or None if it is unknown or too old.
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.report()
+        return await storage.find_job(job_id)
+
+    def rebuild_due(self, rebuilt: datetime | None, now: datetime) -> bool:
+        """
+        Whether the summaries were last rebuilt before the most recent `rebuild_hour`.
+        """
+        quiet = now.replace(hour=self.rebuild_hour, minute=0, second=0, microsecond=0)
+        if quiet > now:
+            quiet -= timedelta(days=1)
+        return rebuilt is None or rebuilt < quiet
+
+    async def _run(self, storage, job: CleanupJob, rebuilt: datetime | None):
+        job.status = "running"
+        released = {}
+        try:
+            if self.mode == "ttl":
+                now = datetime.now()
+                rebuild = self.rebuild_due(rebuilt, now)
+                await storage.expired_by_server(rebuild)
+                if rebuild:
+                    released["rebuilt"] = self._rebuilt = now
+            else:
+                while True:
+                    started = monotonic()
+                    deleted, after = await storage.delete_expired_batch(job.age, job.position, self.batch_size)
+                    job.deleted += deleted
+                    job.batches += 1
+                    if after is None:
+                        break
+                    job.position = after
+                    await storage.renew_lease(LEASE, self.owner, LEASE_SECONDS)
+                    await storage.save_job(job.report())
+                    await asyncio.sleep(max(0.0, 1 / self.batches_per_second - (monotonic() - started)))
+            job.status = "done"
+            logger.info("cleanup %s deleted %d items in %d batches", job.id, job.deleted, job.batches)
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except Exception as err:
+            # whatever the failure, the job must not be left "running", which would block new ones
+            job.status = "failed"
+            job.error = str(err) or type(err).__name__
+            logger.exception("cleanup %s failed", job.id)
+        finally:
+            job.finished = datetime.now()
+            try:
+                await storage.save_job(job.report())
+                await storage.release_lease(LEASE, self.owner, **released)
+            except PyMongoError as err:
+                logger.warning("cleanup %s could not save its report or release its lease: %s", job.id, err)
+
+    async def schedule(self, storage, interval: float):
+        """
+        Run a cleanup job about every `interval` seconds, in whichever worker gets to it first. Every
+        worker checks at least once a minute, and starts a job only if none started in the last
+        `interval` seconds. Runs until cancelled.
+        """
+        while True:
+            await asyncio.sleep(min(interval, 60))
+            try:
+                job = await self.start(storage, idle=interval)
+            except PyMongoError as err:
+                logger.warning("could not start the scheduled cleanup: %s", err)
+                continue
+            if job is not None:
+                await asyncio.wait([self._task])
+
+    async def stop(self):
+        """
+        Cancel the running job, if any, and wait for it to stop.
+        """
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
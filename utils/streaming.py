@@ -0,0 +1,26 @@
+from fastapi.responses import StreamingResponse
+from jinja2 import Environment
+
+
+def stream_template(env: Environment, name: str, context: dict, chunk_bytes: int) -> StreamingResponse:
+    """
+    Render a template with Jinja's `generate` and send the output as it is produced, in chunks of
+    about `chunk_bytes`, so the top of the page reaches the client while the rest still renders.
+
+    Rendering stays on the event loop, between the sends of the chunks, so template globals
+    (such as the fragment cache) are never used from another thread.
+    """
+    template = env.get_template(name)
+
+    async def chunks():
+        buffered, size = [], 0
+        for text in template.generate(context):
+            buffered.append(text)
+            size += len(text)
+            if size >= chunk_bytes:
+                yield "".join(buffered).encode()
+                buffered, size = [], 0
+        if buffered:
+            yield "".join(buffered).encode()
+
+    return StreamingResponse(chunks(), media_type="text/html; charset=utf-8")
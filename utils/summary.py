@@ -0,0 +1,66 @@
+# the summary key of items with an empty or missing status; no encoded status starts with "%n"
+NO_STATUS = "%none"
+
+
+def summary_key(status) -> str:
+    """
+    Field name of a status in the summary document. Statuses are free text, and MongoDB field
+    names cannot be empty, hold "." or start with "$", so those characters are percent-encoded
+    and items without a status are counted under NO_STATUS.
+    """
+    if status is None or status == "":
+        return NO_STATUS
+    return str(status).replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def summary_status(key: str) -> str:
+    if key == NO_STATUS:
+        return ""
+    return key.replace("%24", "$").replace("%2E", ".").replace("%25", "%")
+
+
+def summary_changes(op: str, docs: list[dict], before: list[dict] | None = None) -> dict[str, dict]:
+    """
+    The `$inc` of each user's summary counters for a write.
+
+    Args:
+        op (str): "insert", "update" or "delete".
+        docs (list[dict]): The inserted documents, the updated documents as they are now, or the
+            deleted documents. Each needs its `user_id`, `status` and `quantity`.
+        before (list[dict], optional): For updates, the same documents as they were before.
+
+    Returns:
+        dict: `{user_id: {"summary.<status>.count": delta, "summary.<status>.quantity": delta}}`.
+    """
+    changes = {}
+
+    def count(doc: dict, sign: int):
+        user_id = doc.get("user_id")
+        if user_id is None:
+            return
+        inc = changes.setdefault(user_id, {})
+        field = f"summary.{summary_key(doc.get('status'))}"
+        inc[f"{field}.count"] = inc.get(f"{field}.count", 0) + sign
+        quantity = doc.get("quantity")
+        if isinstance(quantity, (int, float)) and not isinstance(quantity, bool):
+            inc[f"{field}.quantity"] = inc.get(f"{field}.quantity", 0) + sign * quantity
+
+    if op == "update":
+        for doc in before or []:
+            count(doc, -1)
+    for doc in docs:
+        count(doc, -1 if op == "delete" else 1)
+    return {user_id: {field: delta for field, delta in inc.items() if delta}
+            for user_id, inc in changes.items()}
+
+
+def read_summary(summary: dict) -> dict:
+    """
+    The API form of a stored summary: item count and quantity per status, and overall.
+    """
+    statuses = {summary_status(key): {"count": value.get("count", 0), "quantity": value.get("quantity", 0)}
+                for key, value in sorted(summary.items()) if value.get("count", 0)}
+    return {"count": sum(value["count"] for value in statuses.values()),
+            "quantity": sum(value["quantity"] for value in statuses.values()),
+            "statuses": statuses,
+            }
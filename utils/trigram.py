@@ -0,0 +1,201 @@
+import asyncio
+from collections import OrderedDict, defaultdict
+from collections.abc import AsyncIterator, Callable
+from time import monotonic
+
+from bson import ObjectId
+
+
+SEARCH_FIELDS = ("name", "description", "drawing")
+
+# rough per-entry costs used to keep the memory estimate cheap to maintain
+DOC_OVERHEAD = 200
+POSTING_OVERHEAD = 40
+
+
+def trigrams(text: str) -> set[str]:
+    """
+    Return the set of three character substrings of `text`.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TenantIndex:
+    """
+    Trigram index over the search fields of one user's items.
+
+    Matches are case-insensitive substrings of any one field, like the regex search,
+    but the term is taken literally.
+    """
+
+    def __init__(self):
+        self.fields: dict[ObjectId, dict[str, str]] = {}
+        self.grams: dict[str, set[ObjectId]] = defaultdict(set)
+        self.size = 0
+        self.loaded = monotonic()
+
+    def _doc_grams(self, fields: dict[str, str]) -> set[str]:
+        return set().union(*(trigrams(value) for value in fields.values()))
+
+    def _doc_size(self, fields: dict[str, str], grams: set[str]) -> int:
+        return DOC_OVERHEAD + sum(len(value) for value in fields.values()) + POSTING_OVERHEAD * len(grams)
+
+    def add(self, doc: dict):
+        """
+        Index a document, replacing any previous version of it.
+        """
+        item_id = doc["_id"]
+        fields = dict(self.fields.get(item_id, {}))
+        fields.update({key: str(doc[key]).lower() for key in SEARCH_FIELDS if key in doc})
+        self.remove(item_id)
+        grams = self._doc_grams(fields)
+        for gram in grams:
+            self.grams[gram].add(item_id)
+        self.fields[item_id] = fields
+        self.size += self._doc_size(fields, grams)
+
+    def remove(self, item_id: ObjectId) -> bool:
+        """
+        Drop a document from the index. Returns False if it was not indexed.
+        """
+        fields = self.fields.pop(item_id, None)
+        if fields is None:
+            return False
+        grams = self._doc_grams(fields)
+        for gram in grams:
+            postings = self.grams[gram]
+            postings.discard(item_id)
+            if not postings:
+                del self.grams[gram]
+        self.size -= self._doc_size(fields, grams)
+        return True
+
+    def search(self, term: str, limit: int, after: ObjectId | None = None) -> list[ObjectId]:
+        """
+        Return up to `limit` matching ids in `_id` order, starting after `after`.
+        """
+        term = term.lower()
+        grams = trigrams(term)
+        if grams:
+            postings = sorted((self.grams.get(gram, set()) for gram in grams), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            candidates = self.fields.keys()
+        matches = sorted(item_id for item_id in candidates
+                         if (after is None or item_id > after)
+                         and any(term in value for value in self.fields[item_id].values()))
+        return matches[:limit]
+
+
+class TrigramIndexes:
+    """
+    Per-user trigram indexes, loaded on first search and evicted whole, least recently used first,
+    once their estimated size passes `max_bytes`.
+
+    The write hook only sees this worker's writes, so an index is loaded again once it is `ttl`
+    seconds old (0 keeps it until evicted), which bounds how long other workers' writes go unseen.
+    A user whose index alone would pass `max_bytes` gets none until the ttl has passed again.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.tenants: OrderedDict[str, TenantIndex] = OrderedDict()
+        # users with too many items to index -> when to try again
+        self.oversized: dict[str, float] = {}
+        self._loading: dict[str, asyncio.Task] = {}
+        self._stale: set[str] = set()
+
+    @property
+    def size(self) -> int:
+        return sum(index.size for index in self.tenants.values())
+
+    async def get(self, user_id: str, loader: Callable[[str], AsyncIterator[dict]]) -> TenantIndex | None:
+        """
+        Return the index for `user_id`, building it from `loader` if it is not in memory or too old.
+
+        Returns None for a user whose index alone would pass `max_bytes`; search their items some other way.
+        """
+        now = monotonic()
+        if self.oversized.get(user_id, now) > now:
+            return None
+        index = self.tenants.get(user_id)
+        if index is not None and self.ttl and now - index.loaded >= self.ttl:
+            del self.tenants[user_id]
+            index = None
+        if index is not None:
+            self.tenants.move_to_end(user_id)
+            return index
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._load(user_id, loader))
+            self._loading[user_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id: str, loader: Callable[[str], AsyncIterator[dict]]) -> TenantIndex | None:
+        # a write that lands while the documents stream in may be missed, so load again
+        for _ in range(3):
+            self._stale.discard(user_id)
+            index = TenantIndex()
+            async for doc in loader(user_id):
+                index.add(doc)
+                if index.size > self.max_bytes:
+                    break
+            if index.size > self.max_bytes:
+                # kept, it would push out every other index and then itself, and be loaded on every search
+                self.oversized[user_id] = monotonic() + self.ttl if self.ttl else float("inf")
+                return None
+            if user_id not in self._stale:
+                self.tenants[user_id] = index
+                self._evict()
+                return index
+        self._stale.discard(user_id)
+        return index
+
+    def _evict(self):
+        total = self.size
+        while self.tenants and total > self.max_bytes:
+            _, index = self.tenants.popitem(last=False)
+            total -= index.size
+
+    def discard(self, user_id: str | None = None):
+        """
+        Forget one user's index, or every index when `user_id` is None.
+        """
+        if user_id is None:
+            self.tenants.clear()
+            self._stale.update(self._loading)
+        else:
+            self.tenants.pop(user_id, None)
+            if user_id in self._loading:
+                self._stale.add(user_id)
+
+    def on_write(self, op: str, docs: list[dict]):
+        """
+        Database write hook that keeps the loaded indexes current.
+        """
+        if op == "cleanup":
+            self.discard()
+            return
+        for doc in docs:
+            user_id, item_id = doc.get("user_id"), doc["_id"]
+            if op == "insert" and user_id is not None:
+                if user_id in self._loading:
+                    self._stale.add(user_id)
+                if user_id in self.tenants:
+                    self.tenants[user_id].add(doc)
+                continue
+            # updates and deletes may touch an item that sits in any user's index
+            self._stale.update(self._loading)
+            owner = self.tenants.get(user_id) if op == "update" else None
+            for index in self.tenants.values():
+                if index is not owner:
+                    index.remove(item_id)
+            if owner is not None:
+                if item_id in owner.fields:
+                    owner.add(doc)
+                else:
+                    # the index never saw this item, so it lacks fields the update does not carry
+                    self.discard(user_id)
+        self._evict()